@@ -1,6 +1,23 @@
 from _facebook import FacebookGraphMixin
 from _foursquare import FoursquareMixin
-from _stripe import Stripe
-from _twitter import Twitter
+from _stripe import Stripe, StripeError, StripeRegistry
+from _webhooks import StripeWebhookHandler, StripeEventPipeline, verify_stripe_signature
+from _twitter import Twitter, TwitterStream
+from _httpclient import HTTPClientPool, configure_httpclient
+from _breaker import CircuitBreaker, CircuitOpenError
+from _cassette import Cassette, CassetteMiss
+from _cache import ResponseCache, MemoryCache, RedisCache
+from _session import SessionStore
+from _codec import use_codec as use_json_codec
+from _metrics import add_metrics_hook, remove_metrics_hook, MetricsHook, InMemoryMetrics, PrometheusMetrics, StatsdMetrics
 
-__all__ = ['FoursquareMixin', 'FacebookGraphMixin', 'Twitter', 'Stripe']
\ No newline at end of file
+__all__ = [
+    'FoursquareMixin', 'FacebookGraphMixin', 'Twitter', 'TwitterStream', 'Stripe', 'StripeError', 'StripeRegistry',
+    'StripeWebhookHandler', 'StripeEventPipeline', 'verify_stripe_signature',
+    'HTTPClientPool', 'configure_httpclient', 'CircuitBreaker', 'CircuitOpenError',
+    'Cassette', 'CassetteMiss',
+    'ResponseCache', 'MemoryCache', 'RedisCache',
+    'SessionStore',
+    'use_json_codec',
+    'add_metrics_hook', 'remove_metrics_hook', 'MetricsHook', 'InMemoryMetrics', 'PrometheusMetrics', 'StatsdMetrics'
+]
\ No newline at end of file
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Didip Kerabat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+import collections
+
+from tornado import httpclient
+
+CLOSED    = 'closed'
+OPEN      = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(httpclient.HTTPError):
+    """
+    Raised instead of sending a request to a host whose circuit is open.
+    Like connection errors it carries the code 599.
+    """
+    def __init__(self, host, retry_after, response=None):
+        httpclient.HTTPError.__init__(self, 599, 'Circuit open for %s' % host, response)
+        self.host        = host
+        self.retry_after = retry_after
+
+
+class HostCircuit(object):
+    """
+    Circuit of one upstream host: the outcome and latency of its recent
+    requests, and whether new requests may go out.
+    """
+    def __init__(self, breaker, host):
+        self.breaker   = breaker
+        self.host      = host
+        self.state     = CLOSED
+        self.opened_at = None
+        self.probes    = 0
+
+        self.outcomes  = collections.deque(maxlen=breaker.window)
+        self.latencies = collections.deque(maxlen=breaker.latency_window)
+        self._lock     = threading.Lock()
+
+
+    def allow(self):
+        '''
+        Raises CircuitOpenError when the request must not be sent.
+        Once open_seconds have passed, lets half_open_probes requests through to test the host.
+        '''
+        with self._lock:
+            if self.state == OPEN:
+                retry_after = self.opened_at + self.breaker.open_seconds - time.time()
+                if retry_after > 0:
+                    raise CircuitOpenError(self.host, retry_after)
+                self.state  = HALF_OPEN
+                self.probes = 0
+
+            if self.state == HALF_OPEN:
+                if self.probes >= self.breaker.half_open_probes:
+                    raise CircuitOpenError(self.host, 0)
+                self.probes += 1
+
+
+    def record(self, ok, elapsed):
+        breaker = self.breaker
+        if ok:
+            self.latencies.append(elapsed)
+        if breaker.slow_call is not None and elapsed > breaker.slow_call:
+            ok = False
+
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.probes = max(self.probes - 1, 0)
+                if ok:
+                    self.state = CLOSED
+                    self.outcomes.clear()
+                else:
+                    self._open()
+                return
+
+            self.outcomes.append(ok)
+            if breaker.failure_rate is None or len(self.outcomes) < breaker.min_requests:
+                return
+
+            failures = self.outcomes.count(False)
+            if failures >= breaker.failure_rate * len(self.outcomes):
+                self._open()
+
+
+    def percentile(self, q):
+        '''
+        Latency of successful requests at percentile q, or None before min_samples requests.
+        '''
+        values = sorted(self.latencies)
+        if len(values) < self.breaker.min_samples:
+            return None
+        return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+
+    def _open(self):
+        self.state     = OPEN
+        self.opened_at = time.time()
+        self.outcomes.clear()
+
+
+class CircuitBreaker(object):
+    """
+    Per-host circuit breaker for the shared HTTP client pool.
+
+    A host's circuit opens once at least failure_rate of its last `window`
+    requests failed (with at least min_requests recorded). Connection
+    errors, timeouts, 429 and 5xx responses count as failures, and so do
+    requests slower than slow_call seconds when it is set. While open,
+    requests fail at once with CircuitOpenError. After open_seconds the
+    circuit is half-open: half_open_probes requests go through, and the
+    first outcome closes or reopens it. failure_rate=None only tracks
+    latencies, e.g. for hedged requests.
+
+    Example:
+        tornado_api.configure_httpclient(circuit_breaker=tornado_api.CircuitBreaker(failure_rate=0.5, open_seconds=10))
+    """
+    def __init__(self, window=50, min_requests=20, failure_rate=0.5, slow_call=None, open_seconds=30,
+                 half_open_probes=1, latency_window=200, min_samples=20):
+        self.window           = window
+        self.min_requests     = min_requests
+        self.failure_rate     = failure_rate
+        self.slow_call        = slow_call
+        self.open_seconds     = open_seconds
+        self.half_open_probes = half_open_probes
+        self.latency_window   = latency_window
+        self.min_samples      = min_samples
+
+        self._circuits = {}
+        self._lock     = threading.Lock()
+
+
+    def circuit(self, host):
+        circuit = self._circuits.get(host)
+        if circuit is None:
+            with self._lock:
+                circuit = self._circuits.setdefault(host, HostCircuit(self, host))
+        return circuit
+
+
+    def state(self, host):
+        return self.circuit(host).state
+
+
+def failed(response):
+    '''
+    Whether a response (or HTTPError) counts against its host: no response, 429 or 5xx.
+    '''
+    return response is None or response.code == 429 or response.code >= 500
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Didip Kerabat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import hashlib
+import collections
+
+from _routes import quote_value
+
+
+class MemoryCache(object):
+    """
+    In-process LRU cache with per-entry TTL.
+
+    Entries are evicted least-recently-used first once either max_entries
+    or max_bytes (the summed length of the cached bodies) is exceeded.
+    """
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes   = max_bytes
+        self.size        = 0
+
+        self._entries = collections.OrderedDict()
+
+
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        if expires_at < time.time():
+            self.size -= len(value)
+            return None
+
+        self._entries[key] = entry
+        return value
+
+
+    def set(self, key, value, ttl):
+        self.delete(key)
+        if len(value) > self.max_bytes:
+            return
+
+        self._entries[key] = (value, time.time() + ttl)
+        self.size += len(value)
+
+        while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCache(object):
+    """
+    Cache backend on top of a Redis client (e.g. redis.StrictRedis).
+
+    Any client exposing get(key), set(key, value, ex=seconds) and
+    delete(key) works. Expiry is left to Redis.
+    """
+    def __init__(self, client, prefix='tornado_api:'):
+        self.client = client
+        self.prefix = prefix
+
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, value, ex=max(int(ttl), 1))
+
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class ResponseCache(object):
+    """
+    Opt-in cache of raw GET response bodies.
+
+    Keys are built from the path, the sorted query arguments and the access
+    token, and hashed so tokens never end up in a shared backend in clear text.
+    ttls maps path prefixes to TTLs in seconds; the longest matching prefix
+    wins and a TTL of 0 disables caching for that prefix.
+
+    Example:
+        class MainHandler(tornado.web.RequestHandler, tornado_api.FacebookGraphMixin):
+            facebook_cache = tornado_api.ResponseCache(tornado_api.MemoryCache(max_bytes=16 * 1024 * 1024),
+                                                       default_ttl=60, ttls={'/me': 300, '/me/feed': 0})
+    """
+    def __init__(self, backend=None, default_ttl=60, ttls=None):
+        self.backend     = backend if backend is not None else MemoryCache()
+        self.default_ttl = default_ttl
+        self.ttls        = sorted((ttls or {}).items(), key=lambda item: len(item[0]), reverse=True)
+
+
+    def key(self, path, args, access_token=None):
+        # Quoted as UTF-8, so unicode arguments hash like their encoded form.
+        parts = [quote_value(path), quote_value(access_token or '')]
+        parts.extend(quote_value(name) + '=' + quote_value(value) for name, value in sorted(args.items()))
+        return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+
+    def ttl(self, path):
+        for prefix, ttl in self.ttls:
+            if path.startswith(prefix):
+                return ttl
+        return self.default_ttl
+
+
+    def get(self, key):
+        return self.backend.get(key)
+
+
+    def set(self, key, body, ttl):
+        self.backend.set(key, body, ttl)
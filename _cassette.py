@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Didip Kerabat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Recording and replay of upstream HTTP traffic.
+
+A cassette file is laid out as:
+
+    magic | records | index | footer
+
+Each record is a response: status code, request time, header lines and
+body. The index has one fixed-size entry per record, sorted by request
+key and occurrence, so a replayed request is found by binary search over
+the memory-mapped file without loading it.
+"""
+
+import os
+import mmap
+import struct
+import urllib
+import urlparse
+import hashlib
+import cStringIO
+import threading
+import collections
+
+from tornado import httpclient, httputil
+
+MAGIC = 'TACASS1\n'
+
+_RECORD = struct.Struct('!HdII')     # code, request time, header bytes, body bytes
+_ENTRY  = struct.Struct('!20sIQ')    # request key, occurrence, record offset
+_FOOTER = struct.Struct('!QI')       # index offset, entries
+
+# Query and form parameters that change on every request, like OAuth nonces.
+VOLATILE_PARAMS = frozenset(['oauth_nonce', 'oauth_timestamp', 'oauth_signature'])
+
+
+class CassetteMiss(httpclient.HTTPError):
+    """
+    Raised when a replayed request was never recorded. Carries the code 599.
+    """
+    def __init__(self, request, response=None):
+        httpclient.HTTPError.__init__(self, 599, 'No recorded response for %s %s' % (request.method, request.url), response)
+
+
+class Recording(collections.namedtuple('Recording', 'code request_time headers body')):
+    def response(self, request):
+        '''
+        Builds the HTTPResponse of request. Like a live fetch, header_callback
+        and streaming_callback are called, and streamed bodies are not buffered.
+        '''
+        headers = httputil.HTTPHeaders.parse(self.headers)
+
+        if request.header_callback is not None:
+            request.header_callback('HTTP/1.1 %d %s\r\n' % (self.code, httputil.responses.get(self.code, 'Unknown')))
+            for name, value in headers.get_all():
+                request.header_callback('%s: %s\r\n' % (name, value))
+            request.header_callback('\r\n')
+
+        if request.streaming_callback is not None:
+            if self.body:
+                request.streaming_callback(self.body)
+            buffer = cStringIO.StringIO()
+        else:
+            buffer = cStringIO.StringIO(self.body)
+
+        return httpclient.HTTPResponse(request, self.code, headers=headers, buffer=buffer,
+                                       effective_url=request.url, request_time=self.request_time)
+
+
+class Cassette(object):
+    """
+    Records the responses of every request made through an HTTPClientPool,
+    or replays them without touching the network.
+
+    Requests are matched on method, URL, body and match_headers, with query
+    and form parameters sorted and ignore_params (OAuth nonces and
+    signatures by default) left out. A request made several times replays its recorded
+    responses in order, then keeps replaying the last one. With
+    keep_latency, replayed responses arrive after their recorded request
+    time; otherwise as fast as possible.
+
+    Example:
+        cassette = tornado_api.Cassette('fixtures/stripe.cassette', mode='record')
+        tornado_api.configure_httpclient(cassette=cassette)
+        ...
+        cassette.save()
+
+        tornado_api.configure_httpclient(cassette=tornado_api.Cassette('fixtures/stripe.cassette', keep_latency=True))
+    """
+    def __init__(self, path, mode='replay', keep_latency=False, ignore_params=VOLATILE_PARAMS, match_headers=('Stripe-Account',)):
+        if mode not in ('record', 'replay'):
+            raise ValueError("Unknown cassette mode '%s'" % mode)
+
+        self.path          = path
+        self.mode          = mode
+        self.keep_latency  = keep_latency
+        self.ignore_params = frozenset(ignore_params)
+        self.match_headers = tuple(match_headers)
+
+        self._occurrences = collections.defaultdict(int)
+        self._records     = []
+        self._lock        = threading.Lock()
+        self._file        = None
+        self._map         = None
+
+        if mode == 'replay':
+            self._open()
+
+
+    @property
+    def recording(self):
+        return self.mode == 'record'
+
+
+    def key(self, request):
+        '''
+        Digest identifying a request across runs.
+        '''
+        url = request.url
+        scheme, netloc, path, query, _ = urlparse.urlsplit(url)
+        if query:
+            url = urlparse.urlunsplit((scheme, netloc, path, self._normalize(query), ''))
+
+        body = request.body or ''
+        if body and request.headers.get('Content-Type', 'application/x-www-form-urlencoded') == 'application/x-www-form-urlencoded':
+            body = self._normalize(body)
+
+        headers = '\n'.join(request.headers.get(name, '') for name in self.match_headers)
+        return hashlib.sha1('%s\n%s\n%s\n%s' % (request.method, url, headers, body)).digest()
+
+
+    def record(self, request, response, chunks=None):
+        '''
+        Adds the response of request. For streamed responses, chunks holds the body as received.
+        '''
+        body = ''.join(chunks) if chunks is not None else response.body or ''
+        headers = ''.join('%s: %s\r\n' % (name, value) for name, value in (response.headers or httputil.HTTPHeaders()).get_all())
+        record  = _RECORD.pack(response.code, response.request_time or 0.0, len(headers), len(body)) + headers + body
+
+        key = self.key(request)
+        with self._lock:
+            self._records.append((key, self._occurrences[key], record))
+            self._occurrences[key] += 1
+
+
+    def replay(self, request):
+        '''
+        Returns the Recording of request. Raises CassetteMiss, with a 599 response attached, when there is none.
+        '''
+        key = self.key(request)
+        with self._lock:
+            occurrence = self._occurrences[key]
+            self._occurrences[key] += 1
+
+        offset = self._find(key, occurrence)
+        if offset is None:
+            error = CassetteMiss(request)
+            error.response = httpclient.HTTPResponse(request, 599, error=error, request_time=0)
+            raise error
+
+        code, request_time, headers_length, body_length = _RECORD.unpack_from(self._map, offset)
+        start = offset + _RECORD.size
+        headers = self._map[start:start + headers_length]
+        body    = self._map[start + headers_length:start + headers_length + body_length]
+        return Recording(code, request_time, headers, body)
+
+
+    def save(self):
+        '''
+        Writes the recorded responses to path, replacing the file atomically.
+        '''
+        with self._lock:
+            records = list(self._records)
+
+        index  = []
+        offset = len(MAGIC)
+        tmp    = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(MAGIC)
+            for key, occurrence, record in records:
+                f.write(record)
+                index.append(_ENTRY.pack(key, occurrence, offset))
+                offset += len(record)
+
+            index.sort()
+            f.write(''.join(index))
+            f.write(_FOOTER.pack(offset, len(index)))
+        os.rename(tmp, self.path)
+
+
+    def close(self):
+        '''
+        Saves a recording cassette, or unmaps a replaying one.
+        '''
+        if self.recording:
+            self.save()
+        elif self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+
+    def _open(self):
+        self._file = open(self.path, 'rb')
+        self._map  = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError('%s is not a cassette file' % self.path)
+
+        self._index, self._entries = _FOOTER.unpack_from(self._map, len(self._map) - _FOOTER.size)
+
+
+    def _find(self, key, occurrence):
+        '''
+        Offset of the record of key's occurrence, or of its last recorded occurrence.
+        '''
+        # Index entries sort as (key, occurrence), so the first entry at or above
+        # (key, occurrence + 1) follows the one wanted.
+        target = key + struct.pack('!I', min(occurrence + 1, 0xffffffff))
+        low, high = 0, self._entries
+        while low < high:
+            middle = (low + high) // 2
+            start  = self._index + middle * _ENTRY.size
+            if self._map[start:start + 24] < target:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low == 0:
+            return None
+        entry_key, _, offset = _ENTRY.unpack_from(self._map, self._index + (low - 1) * _ENTRY.size)
+        return offset if entry_key == key else None
+
+
+    def _normalize(self, query):
+        params = [(name, value) for name, value in urlparse.parse_qsl(query, keep_blank_values=True) if name not in self.ignore_params]
+        return urllib.urlencode(sorted(params))
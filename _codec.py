@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Didip Kerabat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+JSON codec used to decode every API response.
+
+The fastest installed library is picked at import time: orjson, then
+ujson, then the standard library. Response bodies are decoded straight
+from bytes, skipping the unicode conversion tornado.escape.json_decode
+does first. Switch codecs with use_codec().
+"""
+
+import json
+
+
+def _orjson():
+    import orjson
+    return orjson.loads, lambda obj: orjson.dumps(obj)
+
+
+def _ujson():
+    import ujson
+    return ujson.loads, ujson.dumps
+
+
+def _stdlib():
+    return json.loads, json.dumps
+
+
+CODECS = [('orjson', _orjson), ('ujson', _ujson), ('json', _stdlib)]
+
+name  = None
+loads = None
+dumps = None
+
+
+def available_codecs():
+    '''
+    Names of the codecs that can be imported here, fastest first.
+    '''
+    names = []
+    for codec_name, factory in CODECS:
+        try:
+            factory()
+        except ImportError:
+            continue
+        names.append(codec_name)
+    return names
+
+
+def use_codec(codec_name=None):
+    '''
+    Switches the codec used by every tornado_api module.
+    With no name, picks the fastest installed codec.
+    '''
+    global name, loads, dumps
+
+    for candidate, factory in CODECS:
+        if codec_name is not None and candidate != codec_name:
+            continue
+        try:
+            loads, dumps = factory()
+        except ImportError:
+            if codec_name is not None:
+                raise
+            continue
+        name = candidate
+        return name
+
+    raise ValueError('Unknown JSON codec: %s' % codec_name)
+
+
+use_codec()
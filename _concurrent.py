@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Didip Kerabat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+
+
+def with_callback(future, callback=None):
+    '''
+    Returns future, and also calls callback with its result once it resolves.
+    Lets every entry point be used with yield/gen.multi as well as with the
+    older callback style.
+    '''
+    if callback is not None:
+        IOLoop.current().add_future(future, lambda f: callback(f.result()))
+    return future
+
+
+def resolved(result):
+    '''
+    Returns a Future that already holds result.
+    '''
+    future = Future()
+    future.set_result(result)
+    return future
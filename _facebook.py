@@ -14,11 +14,18 @@
 
 import logging
 import urllib
+import functools
 
-from tornado import httpclient
-from tornado import escape
+from tornado import escape, gen
 from tornado.httputil import url_concat
 
+import _codec
+from _concurrent import with_callback, resolved
+from _httpclient import shared_pool
+from _jsonstream import fetch_json_items
+from _routes import route, quote, query_string
+from _singleflight import SingleFlight
+
 class FacebookGraphMixin(object):
     """Facebook authentication using the new Graph API and OAuth2."""
 
@@ -27,9 +34,22 @@ class FacebookGraphMixin(object):
 
     _BASE_URL = "https://graph.facebook.com"
 
+    # Maximum number of operations Facebook accepts in one batch request.
+    _BATCH_SIZE = 50
+
+    # Opt-in GET response cache, see tornado_api.ResponseCache.
+    facebook_cache = None
+
+    # Identical GETs in flight at the same time share one upstream request
+    # and one decoded result. Set to None to disable.
+    facebook_inflight = SingleFlight()
+
+    # Opt-in store of logged in sessions, see tornado_api.SessionStore.
+    facebook_sessions = None
+
     @property
     def httpclient_instance(self):
-        return httpclient.AsyncHTTPClient()
+        return shared_pool()
 
 
     def authorize_redirect(self, redirect_uri=None, client_id=None, **kwargs):
@@ -49,31 +69,68 @@ class FacebookGraphMixin(object):
         self.redirect(url_concat(self._OAUTH_AUTHORIZE_URL, args))
 
 
-    def get_authenticated_user(self, redirect_uri, client_id, client_secret, code, callback):
-        """Handles the login for the Facebook user, returning a user object. Example usage::
+    def get_authenticated_user(self, redirect_uri, client_id, client_secret, code, callback=None, session_key=None, prefetch=None):
+        """Handles the login for the Facebook user, returning a Future of the user object.
 
-          class FacebookGraphLoginHandler(LoginHandler, tornado.auth.FacebookGraphMixin):
-              @tornado.web.asynchronous
+        callback, when given, is also called with the user object.
+
+        prefetch is a list of Graph paths, e.g. ["/me/friends", "/me/permissions"],
+        requested together with the profile once the token is available. Their
+        results end up in user["prefetched"], keyed by path.
+
+        When facebook_sessions is set and a session_key is given (any stable
+        identifier of the visitor, e.g. a secure cookie), the user is kept in
+        the session store. The code is always exchanged for a token; when it
+        is the token of the stored session, the stored profile is returned
+        instead of fetching /me again. See get_session_user() to resume a
+        session without a code. Example usage::
+
+          class FacebookGraphLoginHandler(LoginHandler, tornado_api.FacebookGraphMixin):
+              @tornado.gen.coroutine
               def get(self):
                   if self.get_argument("code", False):
-                      self.get_authenticated_user(
+                      user = yield self.get_authenticated_user(
                           redirect_uri='/auth/facebookgraph/',
                           client_id=self.settings["facebook_api_key"],
                           client_secret=self.settings["facebook_secret"],
                           code=self.get_argument("code"),
-                          callback=self.async_callback(self._on_login)
+                          prefetch=["/me/friends", "/me/permissions"]
                       )
+                      logging.error(user)
+                      self.finish()
                       return
                   self.authorize_redirect(
                       redirect_uri='/auth/facebookgraph/',
                       client_id=self.settings["facebook_api_key"],
                       scope="read_stream,offline_access"
                   )
-
-              def _on_login(self, user):
-                  logging.error(user)
-                  self.finish()
         """
+        return with_callback(self._get_authenticated_user(redirect_uri, client_id, client_secret, code, session_key, prefetch), callback)
+
+
+    def get_session_user(self, session_key, client_id=None, client_secret=None):
+        '''
+        Returns the user stored in facebook_sessions for session_key, or None
+        when there is no valid session. No request is made; given client_id
+        and client_secret, a token close to expiry is exchanged for a fresh
+        one in the background.
+        '''
+        sessions = self.facebook_sessions
+        stored = sessions.get("facebook", session_key) if sessions is not None else None
+        if stored is None:
+            return None
+
+        if client_id and client_secret and sessions.needs_refresh(stored):
+            sessions.refresh("facebook", session_key, functools.partial(
+                self._refresh_facebook_session, session_key, stored, client_id, client_secret
+            ))
+        return stored["user"]
+
+
+    @gen.coroutine
+    def _get_authenticated_user(self, redirect_uri, client_id, client_secret, code, session_key=None, prefetch=None):
+        sessions = self.facebook_sessions if session_key is not None else None
+
         args = {
             "redirect_uri": redirect_uri,
             "code": code,
@@ -81,43 +138,87 @@ class FacebookGraphMixin(object):
             "client_secret": client_secret,
         }
 
-        self.httpclient_instance.fetch(
-            url_concat(self._OAUTH_ACCESS_TOKEN_URL, args),
-            self.async_callback(self._on_access_token, redirect_uri, client_id, client_secret, callback)
+        response = yield self.httpclient_instance.fetch(
+            url_concat(self._OAUTH_ACCESS_TOKEN_URL, args), raise_error=False, endpoint=("facebook", "/oauth/access_token")
+        )
+
+        session = self._on_access_token(response)
+        if session is None:
+            raise gen.Return(None)
+
+        # The profile is only fetched when the token is not the stored session's.
+        stored = sessions and sessions.get("facebook", session_key)
+        if stored is not None and stored["access_token"] != session["access_token"]:
+            stored = None
+
+        # The profile and every prefetched path are requested at once.
+        paths = (["/me"] if stored is None else []) + list(prefetch or [])
+        results = yield [self.facebook_request(path=path, access_token=session["access_token"]) for path in paths]
+
+        profile = results.pop(0) if stored is None else stored["user"]
+        user = self._on_get_user_info(session, profile)
+        if user is not None:
+            user.pop("prefetched", None)
+            if prefetch:
+                user["prefetched"] = dict(zip(prefetch, results))
+
+        if sessions is not None and user is not None:
+            sessions.set("facebook", session_key, session["access_token"], self._expires_in(session), user)
+        raise gen.Return(user)
+
+
+    @gen.coroutine
+    def _refresh_facebook_session(self, session_key, stored, client_id, client_secret):
+        args = {
+            "grant_type": "fb_exchange_token",
+            "client_id": client_id,
+            "client_secret": client_secret,
+            "fb_exchange_token": stored["access_token"],
+        }
+
+        response = yield self.httpclient_instance.fetch(
+            url_concat(self._OAUTH_ACCESS_TOKEN_URL, args), raise_error=False, endpoint=("facebook", "/oauth/access_token")
         )
 
+        session = self._on_access_token(response)
+        if session is not None:
+            user = self._on_get_user_info(session, stored["user"])
+            self.facebook_sessions.set("facebook", session_key, session["access_token"], self._expires_in(session), user)
+
 
-    def _on_access_token(self, redirect_uri, client_id, client_secret, callback, response):
+    def _on_access_token(self, response):
         if response.error:
             logging.warning('Facebook auth error: %s' % str(response))
-            callback(None)
-            return
+            return None
 
         args = escape.parse_qs_bytes(escape.native_str(response.body))
-        session = {
+        return {
             "access_token": args["access_token"][-1],
             "expires": args.get("expires")
         }
 
-        self.facebook_request(
-            path="/me",
-            callback=self.async_callback(self._on_get_user_info, callback, session),
-            access_token=session["access_token"]
-        )
 
+    def _expires_in(self, session):
+        expires = session.get("expires")
+        return int(expires[-1]) if expires else None
 
-    def _on_get_user_info(self, callback, session, user):
+
+    def _on_get_user_info(self, session, user):
         if user is None:
-            callback(None)
-            return
+            return None
 
+        # /me may be shared with other in-flight callers, so never update it in place.
+        user = dict(user)
         user.update({"access_token": session.get("access_token"), "session_expires": session.get("expires")})
-        callback(user)
+        return user
 
 
-    def facebook_request(self, path, callback, access_token=None, post_args=None, **args):
+    def facebook_request(self, path, callback=None, access_token=None, post_args=None, **args):
         """Fetches the given relative API path, e.g., "/btaylor/picture"
 
+        Returns a Future of the decoded response, or of None if the request
+        failed. callback, when given, is also called with that result.
+
         If the request is a POST, post_args should be provided. Query
         string arguments should be given as keyword arguments.
 
@@ -130,17 +231,15 @@ class FacebookGraphMixin(object):
         attribute that can be used to make authenticated requests via
         this method. Example usage::
 
-            class MainHandler(tornado.web.RequestHandler, tornado.auth.FacebookGraphMixin):
+            class MainHandler(tornado.web.RequestHandler, tornado_api.FacebookGraphMixin):
                 @tornado.web.authenticated
-                @tornado.web.asynchronous
+                @tornado.gen.coroutine
                 def get(self):
-                    self.facebook_request(
+                    new_entry = yield self.facebook_request(
                         "/me/feed",
                         post_args={"message": "I am posting from my Tornado application!"},
-                        access_token=self.current_user["access_token"],
-                        callback=self.async_callback(self._on_post))
+                        access_token=self.current_user["access_token"])
 
-                def _on_post(self, new_entry):
                     if not new_entry:
                         # Call failed; perhaps missing permission?
                         self.authorize_redirect()
@@ -148,25 +247,143 @@ class FacebookGraphMixin(object):
                     self.finish("Posted a message!")
 
         """
-        url = self.__class__._BASE_URL + path
+        url, endpoint = self._facebook_url(path, access_token, args)
+
+        cache_key = cache_ttl = None
+        cache = self.facebook_cache
+        if cache is not None and post_args is None:
+            cache_ttl = cache.ttl(path)
+            if cache_ttl > 0:
+                cache_key = cache.key(path, args, access_token)
+                body = cache.get(cache_key)
+                if body is not None:
+                    return with_callback(resolved(_codec.loads(body)), callback)
 
-        all_args = {}
-        if access_token:
-            all_args["access_token"] = access_token
-            all_args.update(args)
+        if post_args is not None:
+            return with_callback(self._facebook_fetch(url, method="POST", body=urllib.urlencode(post_args), endpoint=endpoint), callback)
 
-        if all_args: url += "?" + urllib.urlencode(all_args)
+        fetch = functools.partial(self._facebook_fetch, url, cache_key=cache_key, cache_ttl=cache_ttl, endpoint=endpoint)
+        inflight = self.facebook_inflight
+        future = inflight.do(url, fetch) if inflight is not None else fetch()
+
+        return with_callback(future, callback)
 
-        callback = self.async_callback(self._on_facebook_request, callback)
-        if post_args is not None:
-            self.httpclient_instance.fetch(url, method="POST", body=urllib.urlencode(post_args), callback=callback)
-        else:
-            self.httpclient_instance.fetch(url, callback=callback)
 
+    def _facebook_url(self, path, access_token, args):
+        '''
+        Returns the request URL and the metrics endpoint of path.
+        Query arguments are only sent along with an access token.
+        '''
+        url, endpoint = route("facebook", self.__class__._BASE_URL, path)
+        if not access_token:
+            return url, endpoint
 
-    def _on_facebook_request(self, callback, response):
+        query = "access_token=" + quote(access_token)
+        if args:
+            query += "&" + query_string(args)
+        return url + "?" + query, endpoint
+
+
+    @gen.coroutine
+    def _facebook_fetch(self, url, cache_key=None, cache_ttl=None, **kwargs):
+        response = yield self.httpclient_instance.fetch(url, raise_error=False, **kwargs)
+        raise gen.Return(self._parse_facebook_response(response, cache_key, cache_ttl))
+
+
+    def facebook_stream_request(self, path, item_callback, callback=None, access_token=None, items_path=("data",), **args):
+        """Fetches a Graph list, e.g. "/me/feed", passing each item to item_callback
+        while the response is still downloading.
+
+        items_path is the chain of keys leading to the list in the response.
+        Only the item being received is held in memory. Returns a Future of
+        the number of items streamed, or of None if the request failed.
+        """
+        url, endpoint = self._facebook_url(path, access_token, args)
+
+        return with_callback(self._facebook_stream(url, endpoint, items_path, item_callback), callback)
+
+
+    @gen.coroutine
+    def _facebook_stream(self, url, endpoint, items_path, item_callback):
+        response, _, items = yield fetch_json_items(self.httpclient_instance, url, items_path, item_callback, endpoint=endpoint)
         if response.error:
             logging.warning("Error response %s fetching %s", response.error, response.request.url)
-            callback(None)
-            return
-        callback(escape.json_decode(response.body))
+            raise gen.Return(None)
+        raise gen.Return(items)
+
+
+    def _parse_facebook_response(self, response, cache_key=None, cache_ttl=None):
+        if response.error:
+            logging.warning("Error response %s fetching %s", response.error, response.request.url)
+            return None
+        if cache_key:
+            self.facebook_cache.set(cache_key, response.body, cache_ttl)
+        return _codec.loads(response.body)
+
+
+    def facebook_batch_request(self, operations, callback=None, access_token=None):
+        """Runs many Graph API calls through Facebook's batch endpoint.
+
+        Each operation is either a relative path, fetched with GET, or a dict
+        with "method", "relative_url" and optionally "body" (a dict of POST
+        arguments). Operations are split into batches of 50 that are sent
+        concurrently. Returns a Future of the decoded results in the order of
+        the operations, with None for every operation that failed.
+
+        Example usage::
+
+            me, friends, post = yield self.facebook_batch_request(
+                ["/me", "/me/friends?limit=50", {"method": "POST", "relative_url": "/me/feed", "body": {"message": "Hi"}}],
+                access_token=self.current_user["access_token"])
+        """
+        batch = [self._facebook_batch_operation(operation) for operation in operations]
+        return with_callback(self._facebook_batch(batch, access_token), callback)
+
+
+    def _facebook_batch_operation(self, operation):
+        if isinstance(operation, basestring):
+            operation = {"method": "GET", "relative_url": operation}
+
+        batch_operation = {
+            "method": operation.get("method", "GET").upper(),
+            "relative_url": operation["relative_url"].lstrip("/")
+        }
+        if operation.get("body"):
+            batch_operation["body"] = urllib.urlencode(operation["body"])
+
+        return batch_operation
+
+
+    @gen.coroutine
+    def _facebook_batch(self, batch, access_token):
+        size   = self.__class__._BATCH_SIZE
+        chunks = yield [self._facebook_batch_chunk(batch[i:i + size], access_token) for i in range(0, len(batch), size)]
+        raise gen.Return([result for chunk in chunks for result in chunk])
+
+
+    @gen.coroutine
+    def _facebook_batch_chunk(self, chunk, access_token):
+        post_args = {"batch": _codec.dumps(chunk)}
+        if access_token:
+            post_args["access_token"] = access_token
+
+        response = yield self.httpclient_instance.fetch(
+            self.__class__._BASE_URL, method="POST", body=urllib.urlencode(post_args), raise_error=False, endpoint=("facebook", "/batch")
+        )
+
+        results = self._parse_facebook_response(response)
+        if results is None:
+            raise gen.Return([None] * len(chunk))
+
+        raise gen.Return([self._parse_facebook_batch_result(operation, result) for operation, result in zip(chunk, results)])
+
+
+    def _parse_facebook_batch_result(self, operation, result):
+        # Facebook returns null for operations that did not complete in time.
+        if result is None or result.get("code") != 200:
+            logging.warning(
+                "Error response %s in batch operation %s %s",
+                result and result.get("code"), operation["method"], operation["relative_url"]
+            )
+            return None
+        return _codec.loads(result["body"])
@@ -16,11 +16,18 @@
 
 import logging
 import urllib
+import functools
 
-from tornado import httpclient
-from tornado import escape
+from tornado import gen
 from tornado.httputil import url_concat
 
+import _codec
+from _concurrent import with_callback, resolved
+from _httpclient import shared_pool
+from _jsonstream import fetch_json_items
+from _routes import route, quote, query_string
+from _singleflight import SingleFlight
+
 class FoursquareMixin(object):
     """Foursquare API using Oauth2"""
 
@@ -30,9 +37,22 @@ class FoursquareMixin(object):
 
     _BASE_URL = "https://api.foursquare.com/v2"
 
+    # Maximum number of requests Foursquare accepts in one /multi call.
+    _MULTI_SIZE = 5
+
+    # Opt-in GET response cache, see tornado_api.ResponseCache.
+    foursquare_cache = None
+
+    # Identical GETs in flight at the same time share one upstream request
+    # and one decoded result. Set to None to disable.
+    foursquare_inflight = SingleFlight()
+
+    # Opt-in store of logged in sessions, see tornado_api.SessionStore.
+    foursquare_sessions = None
+
     @property
     def httpclient_instance(self):
-        return httpclient.AsyncHTTPClient()
+        return shared_pool()
 
 
     def authorize_redirect(self, redirect_uri=None, client_id=None, **kwargs):
@@ -53,34 +73,62 @@ class FoursquareMixin(object):
         self.redirect(url_concat(self._OAUTH_AUTHENTICATE_URL, args))       # Why _OAUTH_AUTHORIZE_URL fails?
 
 
-    def get_authenticated_user(self, redirect_uri, client_id, client_secret, code, callback):
+    def get_authenticated_user(self, redirect_uri, client_id, client_secret, code, callback=None, session_key=None, prefetch=None):
         """
-        Handles the login for the Foursquare user, returning a user object.
+        Handles the login for the Foursquare user, returning a Future of the user object.
+        callback, when given, is also called with the user object.
+
+        prefetch is a list of paths, e.g. ["/users/self/checkins"], requested
+        together with the profile once the token is available. Their results
+        end up in user["prefetched"], keyed by path.
+
+        When foursquare_sessions is set and a session_key is given (any stable
+        identifier of the visitor, e.g. a secure cookie), the user is kept in
+        the session store. The code is always exchanged for a token; when it
+        is the token of the stored session, the stored profile is returned
+        instead of fetching /users/self again. Foursquare tokens do not
+        expire; sessions are kept for the store's max_age. See
+        get_session_user() to resume a session without a code.
 
         Example usage::
 
           class FoursquareLoginHandler(LoginHandler, FoursquareMixin):
-              @tornado.web.asynchronous
+              @tornado.gen.coroutine
               def get(self):
                   if self.get_argument("code", False):
-                      self.get_authenticated_user(
+                      user = yield self.get_authenticated_user(
                           redirect_uri='/auth/foursquare/connect',
                           client_id=self.settings["foursquare_client_id"],
                           client_secret=self.settings["foursquare_client_secret"],
                           code=self.get_argument("code"),
-                          callback=self.async_callback(self._on_login)
+                          prefetch=["/users/self/checkins", "/users/self/friends"]
                       )
+                      logging.error(user)
+                      self.finish()
                       return
 
                   self.authorize_redirect(
                       redirect_uri='/auth/foursquare/connect',
                       client_id=self.settings["foursquare_api_key"]
                   )
-
-              def _on_login(self, user):
-                  logging.error(user)
-                  self.finish()
         """
+        return with_callback(self._get_authenticated_user(redirect_uri, client_id, client_secret, code, session_key, prefetch), callback)
+
+
+    def get_session_user(self, session_key):
+        '''
+        Returns the user stored in foursquare_sessions for session_key, or
+        None when there is no valid session. No request is made.
+        '''
+        sessions = self.foursquare_sessions
+        stored = sessions.get("foursquare", session_key) if sessions is not None else None
+        return stored["user"] if stored is not None else None
+
+
+    @gen.coroutine
+    def _get_authenticated_user(self, redirect_uri, client_id, client_secret, code, session_key=None, prefetch=None):
+        sessions = self.foursquare_sessions if session_key is not None else None
+
         args = {
             "redirect_uri": redirect_uri,
             "code": code,
@@ -89,72 +137,223 @@ class FoursquareMixin(object):
             "grant_type": "authorization_code"
         }
 
-        self.httpclient_instance.fetch(
-            url_concat(self._OAUTH_ACCESS_TOKEN_URL, args),
-            self.async_callback(self._on_access_token, redirect_uri, client_id, client_secret, callback)
+        response = yield self.httpclient_instance.fetch(
+            url_concat(self._OAUTH_ACCESS_TOKEN_URL, args), raise_error=False, endpoint=("foursquare", "/oauth/access_token")
         )
 
+        session = self._on_access_token(response)
+        if session is None:
+            raise gen.Return(None)
+
+        # The profile is only fetched when the token is not the stored session's.
+        stored = sessions and sessions.get("foursquare", session_key)
+        if stored is not None and stored["access_token"] != session["access_token"]:
+            stored = None
+
+        # The profile and every prefetched path are requested at once.
+        paths = (["/users/self"] if stored is None else []) + list(prefetch or [])
+        results = yield [self.foursquare_request(path=path, access_token=session["access_token"]) for path in paths]
+
+        profile = results.pop(0) if stored is None else stored["user"]
+        user = self._on_get_user_info(session, profile)
+        if user is not None:
+            user.pop("prefetched", None)
+            if prefetch:
+                user["prefetched"] = dict(zip(prefetch, results))
 
-    def _on_access_token(self, redirect_uri, client_id, client_secret, callback, response):
+        if sessions is not None and user is not None:
+            sessions.set("foursquare", session_key, session["access_token"], None, user)
+        raise gen.Return(user)
+
+
+    def _on_access_token(self, response):
         if response.error:
             logging.warning('Foursquare auth error: %s' % str(response))
-            callback(None)
-            return
+            return None
 
-        session = escape.json_decode(response.body)
-
-        self.foursquare_request(
-            path="/users/self",
-            callback=self.async_callback(self._on_get_user_info, callback, session),
-            access_token=session["access_token"]
-        )
+        return _codec.loads(response.body)
 
 
-    def _on_get_user_info(self, callback, session, user):
+    def _on_get_user_info(self, session, user):
         if user is None:
-            callback(None)
-            return
+            return None
 
+        # /users/self may be shared with other in-flight callers, so never update it in place.
+        user = dict(user)
         user.update({
             'first_name': user.get('firstName'),
             'last_name': user.get('lastName'),
             'home_city': user.get('homeCity'),
             'access_token': session['access_token']
         })
-        callback(user)
+        return user
 
 
-    def foursquare_request(self, path, callback, access_token=None, post_args=None, **args):
+    def foursquare_request(self, path, callback=None, access_token=None, post_args=None, **args):
         """
         If the request is a POST, post_args should be provided. Query
         string arguments should be given as keyword arguments.
 
+        Returns a Future of the decoded response, or of None if the request
+        failed. callback, when given, is also called with that result.
+
         See: https://developer.foursquare.com/docs/
         """
-        url = self.__class__._BASE_URL + path
+        url, endpoint = self._foursquare_url(path, access_token, args)
+
+        cache_key = cache_ttl = None
+        cache = self.foursquare_cache
+        if cache is not None and post_args is None:
+            cache_ttl = cache.ttl(path)
+            if cache_ttl > 0:
+                cache_key = cache.key(path, args, access_token)
+                body = cache.get(cache_key)
+                if body is not None:
+                    return with_callback(resolved(_codec.loads(body)), callback)
+
+        if post_args is not None:
+            return with_callback(self._foursquare_fetch(url, method="POST", body=urllib.urlencode(post_args), endpoint=endpoint), callback)
 
-        all_args = {}
-        if access_token:
-            all_args["access_token"] = access_token
-            all_args["oauth_token"] = access_token
-            all_args.update(args)
+        fetch = functools.partial(self._foursquare_fetch, url, cache_key=cache_key, cache_ttl=cache_ttl, endpoint=endpoint)
+        inflight = self.foursquare_inflight
+        future = inflight.do(url, fetch) if inflight is not None else fetch()
 
-        if all_args: url += "?" + urllib.urlencode(all_args)
+        return with_callback(future, callback)
 
-        callback = self.async_callback(self._on_foursquare_request, callback)
-        if post_args is not None:
-            self.httpclient_instance.fetch(url, method="POST", body=urllib.urlencode(post_args), callback=callback)
-        else:
-            self.httpclient_instance.fetch(url, callback=callback)
+
+    def _foursquare_url(self, path, access_token, args):
+        '''
+        Returns the request URL and the metrics endpoint of path.
+        Query arguments are only sent along with an access token.
+        '''
+        url, endpoint = route("foursquare", self.__class__._BASE_URL, path)
+        if not access_token:
+            return url, endpoint
+
+        token = quote(access_token)
+        query = "access_token=" + token + "&oauth_token=" + token
+        if args:
+            query += "&" + query_string(args)
+        return url + "?" + query, endpoint
+
+
+    @gen.coroutine
+    def _foursquare_fetch(self, url, cache_key=None, cache_ttl=None, **kwargs):
+        response = yield self.httpclient_instance.fetch(url, raise_error=False, **kwargs)
+        raise gen.Return(self._parse_foursquare_response(response, cache_key, cache_ttl))
+
+
+    def foursquare_multi_request(self, requests, callback=None, access_token=None):
+        """
+        Runs many Foursquare GETs through the /multi endpoint.
+
+        Each request is either a path or a (path, args) tuple. Requests are
+        sent 5 per /multi call, and the calls are made concurrently. Returns a
+        Future of the decoded responses in the order of the requests, each
+        shaped like a foursquare_request() result, with None for every
+        request that failed.
+
+        Example usage::
+
+            venue, tips, photos = yield self.foursquare_multi_request(
+                ["/venues/%s" % venue_id, ("/venues/%s/tips" % venue_id, {"limit": 5}), "/venues/%s/photos" % venue_id],
+                access_token=self.current_user["access_token"])
+        """
+        requests = [self._foursquare_multi_operation(request) for request in requests]
+        return with_callback(self._foursquare_multi(requests, access_token), callback)
+
+
+    def _foursquare_multi_operation(self, request):
+        if isinstance(request, basestring):
+            return request
+        path, args = request
+        return path + "?" + urllib.urlencode(args) if args else path
+
+
+    @gen.coroutine
+    def _foursquare_multi(self, requests, access_token):
+        size   = self.__class__._MULTI_SIZE
+        chunks = yield [self._foursquare_multi_chunk(requests[i:i + size], access_token) for i in range(0, len(requests), size)]
+        raise gen.Return([result for chunk in chunks for result in chunk])
+
+
+    @gen.coroutine
+    def _foursquare_multi_chunk(self, chunk, access_token):
+        url, endpoint = self._foursquare_url("/multi", access_token, {})
+
+        response = yield self.httpclient_instance.fetch(
+            url, method="POST", body=urllib.urlencode({"requests": ",".join(chunk)}), raise_error=False, endpoint=endpoint
+        )
+
+        body = self._parse_foursquare_response(response)
+        if body is None:
+            raise gen.Return([None] * len(chunk))
+
+        # Requests Foursquare did not answer count as failed.
+        responses = list((body.get("response") or {}).get("responses") or [])
+        responses += [None] * (len(chunk) - len(responses))
+        raise gen.Return([self._parse_foursquare_multi_result(request, result) for request, result in zip(chunk, responses)])
+
+
+    def _parse_foursquare_multi_result(self, request, result):
+        meta = (result or {}).get("meta", {})
+        if meta.get("code") != 200:
+            logging.warning(
+                "Foursquare Error(%s) in multi request %s :: Detail: %s, Message: %s",
+                meta.get("code"), request, meta.get("errorDetail"), meta.get("errorMessage")
+            )
+            return None
+        return result
+
+
+    def foursquare_stream_request(self, path, item_callback, items_path, callback=None, access_token=None, **args):
+        """
+        Fetches a Foursquare list, passing each item to item_callback while the
+        response is still downloading.
+
+        items_path is the chain of keys leading to the list in the response,
+        e.g. ("response", "venues") for /venues/search. Only the item being
+        received is held in memory. Returns a Future of the number of items
+        streamed, or of None if the request failed.
+        """
+        url, endpoint = self._foursquare_url(path, access_token, args)
+
+        return with_callback(self._foursquare_stream(url, endpoint, items_path, item_callback), callback)
+
+
+    @gen.coroutine
+    def _foursquare_stream(self, url, endpoint, items_path, item_callback):
+        response, error_body, items = yield fetch_json_items(self.httpclient_instance, url, items_path, item_callback, endpoint=endpoint)
+        if response.error:
+            meta = self._error_meta(error_body)
+            logging.warning(
+                "Foursquare Error(%s) :: Detail: %s, Message: %s, URL: %s",
+                response.error, meta.get("errorDetail"), meta.get("errorMessage"), response.request.url
+            )
+            raise gen.Return(None)
+        raise gen.Return(items)
 
 
-    def _on_foursquare_request(self, callback, response):
-        response_body = escape.json_decode(response.body)
+    def _parse_foursquare_response(self, response, cache_key=None, cache_ttl=None):
         if response.error:
+            meta = self._error_meta(response.body)
             logging.warning(
                 "Foursquare Error(%s) :: Detail: %s, Message: %s, URL: %s",
-                response.error, response_body["meta"]["errorDetail"], response_body["meta"]["errorMessage"], response.request.url
+                response.error, meta.get("errorDetail"), meta.get("errorMessage"), response.request.url
             )
-            callback(None)
-            return
-        callback(response_body)
+            return None
+        if cache_key:
+            self.foursquare_cache.set(cache_key, response.body, cache_ttl)
+        return _codec.loads(response.body)
+
+
+    def _error_meta(self, body):
+        '''
+        The meta of an error response body, or {} for connection errors,
+        open circuits and error pages that are not Foursquare JSON.
+        '''
+        try:
+            decoded = _codec.loads(body) if body else None
+        except ValueError:
+            return {}
+        return decoded.get("meta") or {} if isinstance(decoded, dict) else {}
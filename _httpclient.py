@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Didip Kerabat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import time
+import urlparse
+import threading
+import weakref
+import datetime
+
+from tornado import httpclient, httputil, gen, locks
+from tornado.ioloop import IOLoop
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+
+from _breaker import CircuitBreaker, CircuitOpenError, failed
+from _cassette import CassetteMiss
+from _concurrent import with_callback
+from _metrics import RequestTimer
+
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    CurlAsyncHTTPClient = None
+
+
+class HTTPClientPool(object):
+    """
+    HTTP client shared by every tornado_api module.
+
+    One AsyncHTTPClient is kept per IOLoop and one blocking HTTPClient per
+    thread, so connections are reused across calls instead of building a
+    client per request. On top of the global max_clients limit, requests
+    are queued per host so one slow upstream cannot take every slot.
+
+    The curl backend keeps connections alive between requests; the simple
+    backend opens a new connection per request. By default curl is used
+    when pycurl is installed.
+
+    circuit_breaker, a CircuitBreaker, makes requests to a failing host
+    fail fast. With hedge_gets, a non-streaming GET still unanswered after
+    the host's hedge_percentile latency is sent a second time, and the
+    first response wins. Hedging tracks latencies through the circuit
+    breaker; one that never opens is created when none is given.
+
+    With a Cassette, responses are recorded as they are fetched, or
+    replayed from the cassette instead of fetched.
+    """
+    def __init__(self, backend=None, max_clients=100, max_clients_per_host=50, connect_timeout=10, request_timeout=30,
+                 circuit_breaker=None, hedge_gets=False, hedge_percentile=95, cassette=None, **defaults):
+        if backend is None:
+            backend = 'curl' if CurlAsyncHTTPClient is not None else 'simple'
+
+        if backend == 'curl':
+            if CurlAsyncHTTPClient is None:
+                raise ValueError('The curl backend requires pycurl')
+            self.client_class = CurlAsyncHTTPClient
+        elif backend == 'simple':
+            self.client_class = SimpleAsyncHTTPClient
+        else:
+            raise ValueError('Unknown HTTP client backend: %s' % backend)
+
+        self.backend              = backend
+        self.max_clients          = max_clients
+        self.max_clients_per_host = max_clients_per_host
+
+        if hedge_gets and circuit_breaker is None:
+            circuit_breaker = CircuitBreaker(failure_rate=None)
+        self.circuit_breaker  = circuit_breaker
+        self.hedge_gets       = hedge_gets
+        self.hedge_percentile = hedge_percentile
+        self.cassette         = cassette
+
+        self.defaults = dict(connect_timeout=connect_timeout, request_timeout=request_timeout)
+        self.defaults.update(defaults)
+
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._local         = threading.local()
+
+
+    def async_client(self):
+        '''
+        Returns the AsyncHTTPClient of the current IOLoop, along with its per-host semaphores.
+        '''
+        io_loop = IOLoop.current()
+        state   = self._async_clients.get(io_loop)
+
+        if state is None:
+            client = self.client_class(io_loop, force_instance=True, max_clients=self.max_clients, defaults=self.defaults)
+            state  = self._async_clients[io_loop] = (client, {})
+
+        return state
+
+
+    def blocking_client(self):
+        '''
+        Returns the blocking HTTPClient of the current thread.
+        '''
+        client = getattr(self._local, 'client', None)
+
+        if client is None:
+            client = self._local.client = httpclient.HTTPClient(self.client_class, max_clients=self.max_clients, defaults=self.defaults)
+
+        return client
+
+
+    def fetch(self, request, callback=None, raise_error=True, endpoint=None, **kwargs):
+        '''
+        Non-blocking fetch returning a Future of the HTTPResponse.
+        Like AsyncHTTPClient.fetch(), HTTP errors are not raised when a callback is given.
+        endpoint is the (service, endpoint) pair reported to metrics hooks.
+        '''
+        if not isinstance(request, httpclient.HTTPRequest):
+            request = httpclient.HTTPRequest(request, **kwargs)
+
+        return with_callback(self._fetch(request, raise_error and callback is None, endpoint), callback)
+
+
+    def fetch_blocking(self, request, endpoint=None, **kwargs):
+        if not isinstance(request, httpclient.HTTPRequest):
+            request = httpclient.HTTPRequest(request, **kwargs)
+
+        if self.cassette is not None and not self.cassette.recording:
+            return self._replay_blocking(request, endpoint)
+
+        circuit = self._allow(request)
+        chunks  = self._capture(request)
+
+        timer   = RequestTimer.start(request, endpoint)
+        started = time.time()
+        try:
+            response = self.blocking_client().fetch(request)
+        except httpclient.HTTPError, e:
+            if circuit: circuit.record(not failed(e), time.time() - started)
+            if timer: timer.finish(e.response, e)
+            if e.response is not None and self.cassette is not None:
+                self.cassette.record(request, e.response, chunks)
+            raise
+        except IOError, e:
+            # The simple backend raises connection errors as they are; report
+            # them like curl and the non-blocking clients do, as a 599.
+            if circuit: circuit.record(False, time.time() - started)
+            if timer: timer.finish(None, e)
+            error = httpclient.HTTPError(599, str(e) or e.__class__.__name__)
+            error.response = httpclient.HTTPResponse(request, 599, error=e, request_time=time.time() - started)
+            raise error
+        except Exception, e:
+            if circuit: circuit.record(False, time.time() - started)
+            if timer: timer.finish(None, e)
+            raise
+
+        if circuit: circuit.record(True, time.time() - started)
+        if timer: timer.finish(response)
+        if self.cassette is not None:
+            self.cassette.record(request, response, chunks)
+        return response
+
+
+    def _replay_blocking(self, request, endpoint):
+        timer = RequestTimer.start(request, endpoint)
+        try:
+            recording = self.cassette.replay(request)
+        except CassetteMiss, e:
+            if timer: timer.finish(e.response, e)
+            raise
+
+        if self.cassette.keep_latency:
+            time.sleep(recording.request_time)
+
+        response = recording.response(request)
+        if timer: timer.finish(response)
+        response.rethrow()
+        return response
+
+
+    @gen.coroutine
+    def _replay(self, request, endpoint):
+        timer = RequestTimer.start(request, endpoint)
+        try:
+            recording = self.cassette.replay(request)
+        except CassetteMiss, e:
+            response = e.response
+        else:
+            if self.cassette.keep_latency:
+                yield gen.sleep(recording.request_time)
+            response = recording.response(request)
+
+        if timer: timer.finish(response)
+        raise gen.Return(response)
+
+
+    def _capture(self, request):
+        '''
+        When recording a streamed response, returns the list its chunks are collected in.
+        '''
+        if self.cassette is None or request.streaming_callback is None:
+            return None
+
+        chunks = []
+        streaming_callback = request.streaming_callback
+        def on_chunk(chunk):
+            chunks.append(chunk)
+            streaming_callback(chunk)
+        request.streaming_callback = on_chunk
+        return chunks
+
+
+    def _allow(self, request):
+        '''
+        Returns the circuit of the request's host, or None without a circuit breaker.
+        Raises CircuitOpenError, with a 599 response attached, when the circuit is open.
+        '''
+        if self.circuit_breaker is None:
+            return None
+
+        circuit = self.circuit_breaker.circuit(self._host(request))
+        try:
+            circuit.allow()
+        except CircuitOpenError, e:
+            e.response = httpclient.HTTPResponse(request, 599, error=e, request_time=0)
+            raise
+        return circuit
+
+
+    def _host(self, request):
+        return urlparse.urlsplit(request.url).netloc.rpartition('@')[2]
+
+
+    @gen.coroutine
+    def _fetch(self, request, raise_error, endpoint):
+        if self.cassette is not None and not self.cassette.recording:
+            response = yield self._replay(request, endpoint)
+            if raise_error and response.error:
+                raise response.error
+            raise gen.Return(response)
+
+        client, semaphores = self.async_client()
+
+        try:
+            circuit = self._allow(request)
+        except CircuitOpenError, e:
+            if raise_error:
+                raise
+            raise gen.Return(e.response)
+
+        chunks = self._capture(request)
+
+        host = self._host(request)
+        semaphore = semaphores.get(host)
+        if semaphore is None:
+            semaphore = semaphores[host] = locks.Semaphore(self.max_clients_per_host)
+
+        with (yield semaphore.acquire()):
+            timer   = RequestTimer.start(request, endpoint)
+            started = time.time()
+            try:
+                response = yield self._send(client, request, circuit)
+            except Exception, e:
+                if circuit: circuit.record(False, time.time() - started)
+                if timer: timer.finish(None, e)
+                raise
+
+        if circuit: circuit.record(not failed(response), time.time() - started)
+        if timer: timer.finish(response)
+        if self.cassette is not None:
+            self.cassette.record(request, response, chunks)
+
+        if raise_error and response.error:
+            raise response.error
+        raise gen.Return(response)
+
+
+    def _send(self, client, request, circuit):
+        delay = None
+        if self.hedge_gets and request.method == 'GET' and request.streaming_callback is None:
+            delay = circuit.percentile(self.hedge_percentile)
+
+        if delay is None:
+            return client.fetch(request, raise_error=False)
+        return self._hedged(client, request, delay)
+
+
+    @gen.coroutine
+    def _hedged(self, client, request, delay):
+        '''
+        Sends a copy of request when no response arrived within delay seconds.
+        The first response wins; the other one is dropped when it arrives.
+        '''
+        first = client.fetch(request, raise_error=False)
+        try:
+            response = yield gen.with_timeout(datetime.timedelta(seconds=delay), first)
+        except gen.TimeoutError:
+            hedge = copy.copy(request)
+            hedge.headers = httputil.HTTPHeaders(request.headers)
+            response = yield gen.WaitIterator(first, client.fetch(hedge, raise_error=False)).next()
+
+        raise gen.Return(response)
+
+
+_shared_pool = None
+
+def shared_pool():
+    global _shared_pool
+    if _shared_pool is None:
+        _shared_pool = HTTPClientPool()
+    return _shared_pool
+
+
+def configure_httpclient(**kwargs):
+    '''
+    Replaces the shared HTTP client pool used by every tornado_api module.
+    Example:
+        tornado_api.configure_httpclient(backend='curl', max_clients=200, max_clients_per_host=50,
+                                         connect_timeout=3, request_timeout=15,
+                                         circuit_breaker=tornado_api.CircuitBreaker(), hedge_gets=True)
+    '''
+    global _shared_pool
+    _shared_pool = HTTPClientPool(**kwargs)
+    return _shared_pool
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Didip Kerabat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+
+from tornado import gen
+
+import _codec
+
+_TOKEN      = re.compile(r'[{}\[\],:"]')
+_STRING_END = re.compile(r'(?:[^"\\]|\\.)*"', re.S)
+
+
+class JSONArrayStreamer(object):
+    """
+    Incremental parser that yields the items of one array inside a JSON document.
+
+    path is the chain of object keys leading to the array, e.g. ('data',)
+    for {"object": "list", "data": [...]} or () for a top-level array.
+    feed() accepts the document in arbitrary chunks and calls on_item with
+    every complete item as soon as it has been received. Only the item
+    currently being received is buffered, so memory stays flat no matter
+    how large the document is.
+    """
+    def __init__(self, path, on_item):
+        self.path    = tuple(path)
+        self.on_item = on_item
+        self.items   = 0
+
+        self._buf        = ''
+        self._pos        = 0
+        self._stack      = []       # [container, last key] per open container
+        self._expect_key = False
+        self._target     = None     # stack depth of the target array once entered
+        self._item_start = None
+        self._done       = False
+
+
+    def feed(self, chunk):
+        if self._done:
+            return
+
+        self._buf += chunk
+        buf   = self._buf
+        pos   = self._pos
+        stack = self._stack
+
+        while True:
+            match = _TOKEN.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+
+            token, start = match.group(), match.start()
+
+            if token == '"':
+                end = _STRING_END.match(buf, start + 1)
+                if end is None:
+                    pos = start     # incomplete string, wait for more data
+                    break
+                pos = end.end()
+                if self._expect_key and self._target is None:
+                    stack[-1][1] = _codec.loads(buf[start:pos])
+                continue
+
+            pos = start + 1
+
+            if self._target is not None and len(stack) == self._target and token in ',]':
+                self._emit(buf[self._item_start:start])
+                self._item_start = pos
+                if token == ']':
+                    self._target = self._item_start = None
+                    self._done = True
+                    break
+                continue
+
+            if token == '{':
+                stack.append(['{', None])
+                self._expect_key = True
+            elif token == '[':
+                entering = self._target is None and self._at_path()
+                stack.append(['[', None])
+                self._expect_key = False
+                if entering:
+                    self._target     = len(stack)
+                    self._item_start = pos
+            elif token in '}]':
+                stack.pop()
+                self._expect_key = False
+            elif token == ':':
+                self._expect_key = False
+            elif token == ',':
+                self._expect_key = bool(stack) and stack[-1][0] == '{'
+
+        # Drop everything that has been fully consumed.
+        keep_from = pos if self._item_start is None else min(pos, self._item_start)
+        self._buf = buf[keep_from:]
+        self._pos = pos - keep_from
+        if self._item_start is not None:
+            self._item_start -= keep_from
+
+
+    def close(self):
+        self._buf = ''
+        self._pos = 0
+
+
+    def _at_path(self):
+        if len(self._stack) != len(self.path):
+            return False
+        for (container, key), expected in zip(self._stack, self.path):
+            if container != '{' or key != expected:
+                return False
+        return True
+
+
+    def _emit(self, raw):
+        raw = raw.strip()
+        if raw:
+            self.items += 1
+            self.on_item(_codec.loads(raw))
+
+
+@gen.coroutine
+def fetch_json_items(http, url, path, on_item, **kwargs):
+    '''
+    Fetches url through http (an HTTPClientPool), passing every item of the
+    array at path to on_item while the body is still downloading.
+
+    Error responses are not streamed; their body is buffered and returned so
+    callers can report the API error. Returns (response, error_body, items).
+    '''
+    streamer   = JSONArrayStreamer(path, on_item)
+    status     = [None]
+    error_body = []
+
+    def on_header(line):
+        if line.startswith('HTTP/'):
+            status[0] = int(line.split(' ', 2)[1])
+
+    def on_chunk(chunk):
+        if status[0] is not None and status[0] >= 300:
+            error_body.append(chunk)
+        else:
+            streamer.feed(chunk)
+
+    response = yield http.fetch(url, streaming_callback=on_chunk, header_callback=on_header, raise_error=False, **kwargs)
+    streamer.close()
+
+    raise gen.Return((response, ''.join(error_body), streamer.items))
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Didip Kerabat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-endpoint instrumentation of every request made by tornado_api.
+
+Register hooks with add_metrics_hook(). Every request going through the
+shared HTTP client pool reports to them: when it starts, and a
+RequestSample with timings, sizes, status and error class when it ends.
+Stripe also reports its retries.
+"""
+
+import re
+import time
+import threading
+import collections
+import urlparse
+
+_hooks     = []
+_in_flight = collections.defaultdict(int)
+_lock      = threading.Lock()
+
+_ID_SEGMENT = re.compile(r'^[^/]*\d[^/]*$')
+
+
+def add_metrics_hook(hook):
+    _hooks.append(hook)
+
+
+def remove_metrics_hook(hook):
+    _hooks.remove(hook)
+
+
+def endpoint_name(path):
+    '''
+    Collapses path segments that look like IDs (anything containing a digit)
+    into ":id", so "/venues/4b5f.../tips" reports as "/venues/:id/tips".
+    '''
+    return '/'.join(':id' if _ID_SEGMENT.match(segment) else segment for segment in path.split('/'))
+
+
+def default_endpoint(url):
+    parts = urlparse.urlsplit(url)
+    return parts.netloc.rpartition('@')[2], endpoint_name(parts.path)
+
+
+class RequestSample(object):
+    """
+    Outcome of one HTTP request.
+
+    Times are in seconds. connect_time and ttfb (time to first byte) are
+    None when the HTTP backend does not report them. error is None on
+    success, "http_4xx" / "http_5xx" for error statuses, or the name of the
+    exception class for timeouts and connection failures.
+    """
+    __slots__ = ('service', 'endpoint', 'method', 'code', 'connect_time', 'ttfb', 'total_time', 'request_bytes', 'response_bytes', 'error')
+
+    def __init__(self, service, endpoint, method, code, connect_time, ttfb, total_time, request_bytes, response_bytes, error):
+        self.service        = service
+        self.endpoint       = endpoint
+        self.method         = method
+        self.code           = code
+        self.connect_time   = connect_time
+        self.ttfb           = ttfb
+        self.total_time     = total_time
+        self.request_bytes  = request_bytes
+        self.response_bytes = response_bytes
+        self.error          = error
+
+
+class RequestTimer(object):
+    """
+    Measures one request and reports it to the registered hooks.
+    Returns None from start() when no hook is registered, so
+    uninstrumented processes pay nothing.
+    """
+    @classmethod
+    def start(cls, request, endpoint=None):
+        if not _hooks:
+            return None
+        return cls(request, endpoint)
+
+
+    def __init__(self, request, endpoint):
+        self.service, self.endpoint = endpoint or default_endpoint(request.url)
+        self.request        = request
+        self.started        = time.time()
+        self.first_byte     = None
+        self.response_bytes = 0
+
+        # Time to first byte for backends that do not report it themselves.
+        header_callback = request.header_callback
+        def on_header(line):
+            if self.first_byte is None:
+                self.first_byte = time.time()
+            if header_callback is not None:
+                header_callback(line)
+        request.header_callback = on_header
+
+        streaming_callback = request.streaming_callback
+        if streaming_callback is not None:
+            def on_chunk(chunk):
+                self.response_bytes += len(chunk)
+                streaming_callback(chunk)
+            request.streaming_callback = on_chunk
+
+        key = (self.service, self.endpoint)
+        with _lock:
+            _in_flight[key] += 1
+            in_flight = _in_flight[key]
+
+        for hook in _hooks:
+            hook.request_started(self.service, self.endpoint, in_flight)
+
+
+    def finish(self, response, exception=None):
+        with _lock:
+            _in_flight[(self.service, self.endpoint)] -= 1
+
+        code = response.code if response is not None else None
+        time_info = getattr(response, 'time_info', None) or {}
+
+        total_time = time_info.get('total', time.time() - self.started)
+        ttfb = time_info.get('starttransfer')
+        if ttfb is None and self.first_byte is not None:
+            ttfb = self.first_byte - self.started
+
+        if response is not None and response.buffer is not None:
+            self.response_bytes = len(response.body or '')
+
+        error = None
+        if code is not None and 400 <= code < 599:
+            error = 'http_%dxx' % (code // 100)
+        elif code == 599 or response is None:
+            failure = exception if response is None else response.error
+            error = failure.__class__.__name__ if failure is not None else 'unknown'
+
+        sample = RequestSample(
+            self.service, self.endpoint, self.request.method, code,
+            time_info.get('connect'), ttfb, total_time,
+            len(self.request.body or ''), self.response_bytes, error
+        )
+        for hook in _hooks:
+            hook.request_finished(sample)
+
+
+def report_retry(service, endpoint, attempt, delay):
+    for hook in _hooks:
+        hook.request_retried(service, endpoint, attempt, delay)
+
+
+class MetricsHook(object):
+    """Base class of metrics hooks. Override the events you need."""
+    def request_started(self, service, endpoint, in_flight):
+        pass
+
+
+    def request_finished(self, sample):
+        pass
+
+
+    def request_retried(self, service, endpoint, attempt, delay):
+        pass
+
+
+class InMemoryMetrics(MetricsHook):
+    """
+    Keeps the most recent samples in memory, for tests and debugging.
+    """
+    def __init__(self, max_samples=10000):
+        self.samples   = collections.deque(maxlen=max_samples)
+        self.in_flight = {}
+        self.retries   = collections.defaultdict(int)
+        self.errors    = collections.defaultdict(int)
+
+
+    def request_started(self, service, endpoint, in_flight):
+        self.in_flight[(service, endpoint)] = in_flight
+
+
+    def request_finished(self, sample):
+        key = (sample.service, sample.endpoint)
+        self.in_flight[key] = self.in_flight.get(key, 1) - 1
+        self.samples.append(sample)
+        if sample.error:
+            self.errors[key + (sample.error,)] += 1
+
+
+    def request_retried(self, service, endpoint, attempt, delay):
+        self.retries[(service, endpoint)] += 1
+
+
+    def percentile(self, service, endpoint, q, field='total_time'):
+        values = sorted(
+            getattr(sample, field) for sample in self.samples
+            if sample.service == service and sample.endpoint == endpoint and getattr(sample, field) is not None
+        )
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+
+class PrometheusMetrics(MetricsHook):
+    """
+    Exports latency histograms, byte counters, error and retry counters and
+    in-flight gauges through prometheus_client.
+    """
+    def __init__(self, registry=None, namespace='tornado_api', buckets=None):
+        import prometheus_client
+
+        kwargs = {'namespace': namespace}
+        if registry is not None:
+            kwargs['registry'] = registry
+
+        labels = ['service', 'endpoint']
+        histogram_kwargs = dict(kwargs, buckets=buckets) if buckets else kwargs
+
+        self.latency   = prometheus_client.Histogram('request_seconds', 'Upstream request latency by phase', labels + ['phase'], **histogram_kwargs)
+        self.sent      = prometheus_client.Counter('request_bytes_total', 'Request body bytes sent', labels, **kwargs)
+        self.received  = prometheus_client.Counter('response_bytes_total', 'Response body bytes received', labels, **kwargs)
+        self.errors    = prometheus_client.Counter('request_errors_total', 'Failed requests by error class', labels + ['error'], **kwargs)
+        self.retries   = prometheus_client.Counter('request_retries_total', 'Retried requests', labels, **kwargs)
+        self.in_flight = prometheus_client.Gauge('requests_in_flight', 'Requests currently in flight', labels, **kwargs)
+
+
+    def request_started(self, service, endpoint, in_flight):
+        self.in_flight.labels(service, endpoint).set(in_flight)
+
+
+    def request_finished(self, sample):
+        service, endpoint = sample.service, sample.endpoint
+        self.in_flight.labels(service, endpoint).dec()
+
+        for phase, value in (('connect', sample.connect_time), ('ttfb', sample.ttfb), ('total', sample.total_time)):
+            if value is not None:
+                self.latency.labels(service, endpoint, phase).observe(value)
+
+        self.sent.labels(service, endpoint).inc(sample.request_bytes)
+        self.received.labels(service, endpoint).inc(sample.response_bytes)
+        if sample.error:
+            self.errors.labels(service, endpoint, sample.error).inc()
+
+
+    def request_retried(self, service, endpoint, attempt, delay):
+        self.retries.labels(service, endpoint).inc()
+
+
+class StatsdMetrics(MetricsHook):
+    """
+    Sends timings, counters and gauges through a statsd client exposing
+    timing(), incr() and gauge(), e.g. statsd.StatsClient.
+    """
+    def __init__(self, client, prefix='tornado_api'):
+        self.client = client
+        self.prefix = prefix
+
+
+    def _name(self, service, endpoint, metric):
+        endpoint = endpoint.strip('/').replace('/', '.').replace(':', '') or 'root'
+        return '.'.join([self.prefix, service.replace('.', '_'), endpoint, metric])
+
+
+    def request_started(self, service, endpoint, in_flight):
+        self.client.gauge(self._name(service, endpoint, 'in_flight'), in_flight)
+
+
+    def request_finished(self, sample):
+        name = lambda metric: self._name(sample.service, sample.endpoint, metric)
+
+        for phase, value in (('connect', sample.connect_time), ('ttfb', sample.ttfb), ('total', sample.total_time)):
+            if value is not None:
+                self.client.timing(name(phase), value * 1000)
+
+        self.client.incr(name('request_bytes'), sample.request_bytes)
+        self.client.incr(name('response_bytes'), sample.response_bytes)
+        if sample.error:
+            self.client.incr(name('errors.' + sample.error))
+
+
+    def request_retried(self, service, endpoint, attempt, delay):
+        self.client.incr(self._name(service, endpoint, 'retries'))
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Didip Kerabat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+URL building for the request hot paths.
+
+API paths, access tokens and argument names repeat from call to call, so
+the absolute URL and metrics label of a path and the quoted form of a
+string are computed once and memoized. The memos are bounded: once full
+they are cleared, so a stream of unique values costs no more than
+building each URL from scratch.
+"""
+
+import re
+import urllib
+
+from _metrics import endpoint_name
+
+MAX_ENTRIES = 10000
+
+_routes = {}
+_quoted = {}
+
+
+def route(service, base_url, path):
+    '''
+    Returns the URL of path under base_url and its metrics endpoint, e.g.
+    ("https://graph.facebook.com/1234/picture", ("facebook", "/:id/picture")).
+    '''
+    key = (service, base_url, path)
+    result = _routes.get(key)
+
+    if result is None:
+        if len(_routes) >= MAX_ENTRIES:
+            _routes.clear()
+        result = _routes[key] = (base_url + path, (service, endpoint_name(path)))
+
+    return result
+
+
+# quote_plus() of every byte: safe characters map to themselves.
+_QUOTED_BYTES = dict((chr(i), chr(i) if chr(i) in urllib.always_safe else '%%%02X' % i) for i in range(256))
+_QUOTED_BYTES[' '] = '+'
+_UNSAFE       = re.compile('[^%s]' % re.escape(urllib.always_safe))
+
+
+def quote_value(value):
+    '''
+    quote_plus() of a query string key or value, without memoizing it.
+    Unicode is sent as UTF-8.
+    '''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        value = str(value)
+
+    if _UNSAFE.search(value) is None:
+        return value
+    return ''.join(map(_QUOTED_BYTES.__getitem__, value))
+
+
+def quote(value):
+    '''
+    Memoized quote_value() for strings that repeat, like access tokens and argument names.
+    Only strings are memoized: True and 1 are equal dict keys but quote differently.
+    '''
+    if not isinstance(value, basestring):
+        return quote_value(value)
+
+    quoted = _quoted.get(value)
+
+    if quoted is None:
+        quoted = quote_value(value)
+
+        if len(_quoted) >= MAX_ENTRIES:
+            _quoted.clear()
+        _quoted[value] = quoted
+
+    return quoted
+
+
+def query_string(args):
+    '''
+    Same output as urllib.urlencode(args) for a flat dict.
+    '''
+    return '&'.join([quote(key) + '=' + quote(value) for key, value in args.iteritems()])
+
+
+def form_encode(params):
+    '''
+    Form encodes nested dicts and lists the way Stripe expects them:
+        {'metadata': {'order': 6735}, 'lines': [{'amount': 100}], 'expand': ['customer']}
+    becomes (before quoting)
+        metadata[order]=6735&lines[0][amount]=100&expand[0]=customer
+    Walks the structure with an explicit stack instead of recursing, and
+    builds each key once on the way down. Keys are memoized, values are
+    not. Empty dicts and lists send nothing.
+    '''
+    parts = []
+    stack = [(quote(key), params[key]) for key in reversed(params.keys())]
+
+    while stack:
+        key, value = stack.pop()
+
+        if isinstance(value, dict):
+            stack.extend([(key + '%5B' + quote(k) + '%5D', value[k]) for k in reversed(value.keys())])
+        elif isinstance(value, (list, tuple)):
+            stack.extend([(key + '%5B' + str(i) + '%5D', value[i]) for i in xrange(len(value) - 1, -1, -1)])
+        else:
+            parts.append(key + '=' + quote_value(value))
+
+    return '&'.join(parts)
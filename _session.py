@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Didip Kerabat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import hashlib
+import logging
+
+from tornado.ioloop import IOLoop
+
+import _codec
+from _cache import MemoryCache
+
+
+class SessionStore(object):
+    """
+    Keeps OAuth sessions between logins: the access token, when it
+    expires and the user profile returned by get_authenticated_user().
+
+    The backend is any cache backend (MemoryCache, RedisCache, ...);
+    sessions are stored as JSON under a hash of the service and the
+    session key. Sessions whose token has no expiry are kept for max_age
+    seconds. Tokens expiring within refresh_within seconds are refreshed
+    in the background by the mixin that stored them.
+
+    Example:
+        class LoginHandler(tornado.web.RequestHandler, tornado_api.FacebookGraphMixin):
+            facebook_sessions = tornado_api.SessionStore(tornado_api.RedisCache(redis.StrictRedis()))
+    """
+    def __init__(self, backend=None, max_age=30 * 24 * 3600, refresh_within=24 * 3600):
+        self.backend        = backend if backend is not None else MemoryCache()
+        self.max_age        = max_age
+        self.refresh_within = refresh_within
+
+        self._refreshing = set()
+
+
+    def key(self, service, session_key):
+        return 'session:' + hashlib.sha1('%s\0%s' % (service, session_key)).hexdigest()
+
+
+    def get(self, service, session_key):
+        '''
+        Returns the stored session, a dict with access_token, expires_at
+        (a Unix timestamp or None) and user, or None when there is no valid one.
+        '''
+        body = self.backend.get(self.key(service, session_key))
+        if body is None:
+            return None
+
+        session = _codec.loads(body)
+        if session['expires_at'] is not None and session['expires_at'] <= time.time():
+            self.delete(service, session_key)
+            return None
+        return session
+
+
+    def set(self, service, session_key, access_token, expires_in, user):
+        expires_at = time.time() + expires_in if expires_in is not None else None
+        session = {'access_token': access_token, 'expires_at': expires_at, 'user': user}
+        ttl = expires_in if expires_in is not None else self.max_age
+        self.backend.set(self.key(service, session_key), _codec.dumps(session), ttl)
+
+
+    def delete(self, service, session_key):
+        self.backend.delete(self.key(service, session_key))
+
+
+    def needs_refresh(self, session):
+        return session['expires_at'] is not None and session['expires_at'] - time.time() < self.refresh_within
+
+
+    def refresh(self, service, session_key, fn):
+        '''
+        Calls fn(), which returns a Future, without waiting for it.
+        Only one refresh per session runs at a time; failures are logged.
+        '''
+        key = (service, session_key)
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+
+        def on_done(future):
+            self._refreshing.discard(key)
+            if future.exception() is not None:
+                logging.warning('Refreshing the %s session failed: %s', service, future.exception())
+
+        IOLoop.current().add_future(fn(), on_done)
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Didip Kerabat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tornado.ioloop import IOLoop
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls that share a key.
+
+    While a call for a key is in flight, further calls for the same key get
+    the same Future instead of starting a new one. Once it resolves the key
+    is forgotten, so later calls start fresh. Nothing is cached.
+    """
+    def __init__(self):
+        self._calls = {}
+
+
+    def do(self, key, fn):
+        '''
+        Returns the in-flight Future for key, or starts one by calling fn().
+        '''
+        future = self._calls.get(key)
+
+        if future is None:
+            future = self._calls[key] = fn()
+            IOLoop.current().add_future(future, lambda f: self._forget(key, f))
+
+        return future
+
+
+    def _forget(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+
+
+    def __len__(self):
+        return len(self._calls)
@@ -14,11 +14,348 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import logging
-import urllib
-import functools
+import os
+import time
+import base64
+import hashlib
+import random
+import urlparse
+import threading
+import collections
+
+from tornado import httpclient, gen, locks
+from tornado.concurrent import Future
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+import _codec
+from _breaker import CircuitOpenError
+from _concurrent import with_callback
+from _httpclient import shared_pool
+from _jsonstream import fetch_json_items
+from _metrics import report_retry
+from _routes import MAX_ENTRIES, form_encode
+
+RETRYABLE_HTTP_CODES = frozenset([429, 500, 502, 503, 504, 599])
+
+
+class StripeError(httpclient.HTTPError):
+    """
+    Error reported by the Stripe API. As an HTTPError its code is the HTTP
+    status, also kept as http_code; None for errors raised before any
+    request, such as invalid webhook signatures.
+    """
+    def __init__(self, type, message, http_code=None, response=None):
+        httpclient.HTTPError.__init__(self, http_code, message, response)
+        self.type      = type
+        self.message   = message
+        self.http_code = http_code
+
+
+    def __str__(self):
+        return 'Error(%s): %s' % (self.type, self.message)
+
+    __repr__ = __str__
+
+
+class TokenBucket(object):
+    """
+    Token bucket shared by every Stripe instance using the same API key.
+
+    reserve() takes a token and returns how long the caller has to wait
+    before sending its request. Callers queue up by driving the balance
+    negative instead of polling. A rate of None never throttles.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate    = float(rate) if rate else None
+        self.burst   = float(burst or rate or 0)
+        self.tokens  = self.burst
+        self.updated = time.time()
+        self.lock    = threading.Lock()
+
+
+    def reserve(self):
+        if self.rate is None:
+            return 0
+
+        with self.lock:
+            now = time.time()
+            self.tokens  = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class StripeQuota(object):
+    """
+    Limits and counters of one API key or connected account.
+
+    At most `concurrency` calls are in flight at once, further calls wait
+    for a slot; blocking and non-blocking calls have separate slots. The
+    token bucket allows rate_limit requests per second, or any number with
+    rate_limit=None. counters holds:
+    requests, in_flight, queued, errors, retries and throttled_seconds (time
+    spent waiting on the token bucket).
+    """
+    def __init__(self, name, concurrency=10, rate_limit=None, rate_burst=None):
+        self.name        = name
+        self.concurrency = concurrency
+        self.bucket      = TokenBucket(rate_limit, rate_burst)
+        self.counters    = dict.fromkeys(['requests', 'in_flight', 'queued', 'errors', 'retries', 'throttled_seconds'], 0)
+
+        self._slots        = locks.Semaphore(concurrency)
+        self._thread_slots = threading.Semaphore(concurrency)
+        self._lock         = threading.Lock()
+
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+
+    @gen.coroutine
+    def acquire(self):
+        self.count('queued')
+        try:
+            yield self._slots.acquire()
+        finally:
+            self.count('queued', -1)
+        self._started()
+
+
+    def acquire_blocking(self):
+        self.count('queued')
+        try:
+            self._thread_slots.acquire()
+        finally:
+            self.count('queued', -1)
+        self._started()
+
+
+    def release(self, failed, blocking=False):
+        (self._thread_slots if blocking else self._slots).release()
+        with self._lock:
+            self.counters['in_flight'] -= 1
+            if failed:
+                self.counters['errors'] += 1
+
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, concurrency=self.concurrency)
+
+
+    def _started(self):
+        with self._lock:
+            self.counters['requests']  += 1
+            self.counters['in_flight'] += 1
+
+
+class StripeResource(object):
+    """
+    Immutable handle on a Stripe API URL.
+
+    Every attribute access or id() call returns a new StripeResource,
+    so a single Stripe instance can be shared by concurrent callers.
+    """
+    __slots__ = ('stripe', 'url')
+
+    def __init__(self, stripe, url):
+        object.__setattr__(self, 'stripe', stripe)
+        object.__setattr__(self, 'url', url)
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError('StripeResource is immutable')
+
+
+    def __getattr__(self, name):
+        if name in Stripe.resources:
+            return StripeResource(self.stripe, self.url + '/' + name)
+        else:
+            raise AttributeError(name)
+
+
+    def __repr__(self):
+        return '<StripeResource %s>' % self.url
+
+
+    def id(self, id):
+        return StripeResource(self.stripe, self.url + '/' + str(id))
+
+
+    def iterate(self, page_size=100, **kwargs):
+        '''
+        Walks every object of a list resource, one page at a time.
+        Example:
+            events = tornado_api.Stripe('api_key').events.iterate(type='charge.succeeded')
+            while (yield events.fetch_next):
+                event = events.next_object()
+        '''
+        return StripeListIterator(self, page_size, kwargs)
+
+
+    def stream(self, on_item, callback=None, **kwargs):
+        '''
+        Fetches a list resource in one response and passes each object to on_item
+        while the body is still downloading, without buffering the whole page.
+        Returns a Future of the number of objects streamed. Non-blocking clients only.
+        Example:
+            count = yield tornado_api.Stripe('api_key').events.stream(handle_event, limit=100)
+        '''
+        if self.stripe.blocking:
+            raise ValueError('stream() requires a non-blocking client, use iterate() instead')
+        return with_callback(self.stripe._stream(self.url, on_item, kwargs), callback)
+
+
+    def get(self, **kwargs):
+        return self.stripe._call_check_blocking_first('GET', self.url, **kwargs)
+
+
+    def post(self, **kwargs):
+        return self.stripe._call_check_blocking_first('POST', self.url, **kwargs)
+
+
+    def put(self, **kwargs):
+        return self.stripe._call_check_blocking_first('PUT', self.url, **kwargs)
+
+
+    def delete(self, **kwargs):
+        return self.stripe._call_check_blocking_first('DELETE', self.url, **kwargs)
+
+
+class StripeListIterator(object):
+    """
+    Cursor over a Stripe list resource.
+
+    Pages are requested with limit/starting_after. In non-blocking mode the
+    next page is fetched as soon as the current one arrives, so at most two
+    pages are held in memory while the caller consumes objects.
+
+    Non-blocking usage follows the fetch_next/next_object pattern:
+        while (yield iterator.fetch_next):
+            obj = iterator.next_object()
+
+    Blocking clients can simply iterate:
+        for obj in iterator: ...
+    """
+    def __init__(self, resource, page_size, params):
+        self.resource  = resource
+        self.page_size = page_size
+        self.params    = params
+
+        self._buffer   = collections.deque()
+        self._has_more = True
+        self._pending  = None
+        self._waiting  = None
+        self._last_id  = None
+
+
+    @property
+    def fetch_next(self):
+        '''
+        Future that resolves to True when next_object() has an object to return,
+        or to False when the list is exhausted.
+        '''
+        # Only one waiter per page, so a page is never buffered twice.
+        if self._waiting is not None:
+            return self._waiting
+
+        future = Future()
+
+        if self._buffer:
+            future.set_result(True)
+            return future
+
+        if self._pending is None:
+            if not self._has_more:
+                future.set_result(False)
+                return future
+            self._prefetch()
+
+        def on_page(page_future):
+            self._pending = None
+            self._waiting = None
+            if page_future.exception() is not None:
+                future.set_exc_info(page_future.exc_info())
+                return
+            self._add_page(page_future.result())
+            if self._has_more:
+                self._prefetch()
+            future.set_result(bool(self._buffer))
+
+        self._waiting = future
+        self._pending.add_done_callback(on_page)
+        return future
+
+
+    def next_object(self):
+        if not self._buffer:
+            return None
+        return self._buffer.popleft()
+
+
+    def __iter__(self):
+        while self._has_more:
+            self._add_page(self.resource.stripe._call_check_blocking_first('GET', self.resource.url, **self._page_params()))
+
+            while self._buffer:
+                yield self._buffer.popleft()
+
+
+    def _page_params(self):
+        params = dict(self.params)
+        params['limit'] = self.page_size
+        if self._last_id is not None:
+            params['starting_after'] = self._last_id
+        return params
+
+
+    def _add_page(self, page):
+        data = page.get('data') or []
+        self._buffer.extend(data)
+
+        if data:
+            self._last_id = data[-1]['id']
+
+        if 'has_more' in page:
+            self._has_more = bool(page['has_more']) and bool(data)
+        else:
+            self._has_more = len(data) >= self.page_size
+
+
+    def _prefetch(self):
+        self._pending = self.resource.stripe._fetch('GET', self.resource.url, self._page_params())
+
+
+class StripeBatchResult(object):
+    """
+    Outcome of Stripe.batch().
+
+    results and errors are aligned with the submitted operations: for every
+    index exactly one of results[i] / errors[i] is set. elapsed is the total
+    wall-clock time of the batch in seconds.
+    """
+    def __init__(self, results, errors, elapsed):
+        self.results = results
+        self.errors  = errors
+        self.elapsed = elapsed
+
+
+    @property
+    def failed(self):
+        return [i for i, error in enumerate(self.errors) if error is not None]
+
+
+    def __repr__(self):
+        return '<StripeBatchResult %d operations, %d failed, %.3fs>' % (len(self.results), len(self.failed), self.elapsed)
 
-from tornado import httpclient, escape
 
 class Stripe(object):
     api_hostname = 'api.stripe.com'
@@ -37,15 +374,46 @@ class Stripe(object):
         'incoming'
     ])
 
-    def __init__(self, api_key, blocking=False):
-        self.api_key  = api_key
-        self.blocking = blocking
-        self.url      = None
+    # Optional client-side throttle per API key, in requests per second.
+    # Off by default; Stripe's own limits are answered with 429 and retried.
+    rate_limit = None
+    rate_burst = None
 
-        if blocking:
-            self.httpclient_instance = httpclient.HTTPClient()
-        else:
-            self.httpclient_instance = httpclient.AsyncHTTPClient()
+    # Retries for 429, 5xx and connection errors.
+    max_retries       = 3
+    retry_backoff     = 0.5
+    retry_backoff_max = 8
+
+    _token_buckets      = {}
+    _token_buckets_lock = threading.Lock()
+
+    _auth_headers   = {}
+    _endpoint_names = {}
+
+    # Thread pool of run_many(), grown to the most workers asked for. Its
+    # threads, and the blocking HTTP client each of them holds, are kept
+    # between calls.
+    _executor         = None
+    _executor_workers = 0
+    _executor_lock    = threading.Lock()
+
+    def __init__(self, api_key, blocking=False, max_retries=None, stripe_account=None, quota=None):
+        '''
+        stripe_account makes calls on behalf of a connected account with the platform's api_key.
+        quota, a StripeQuota, replaces the token bucket shared by every instance using api_key.
+        '''
+        self.api_key        = api_key
+        self.blocking       = blocking
+        self.stripe_account = stripe_account
+        self.quota          = quota
+
+        if max_retries is not None:
+            self.max_retries = max_retries
+
+
+    @property
+    def httpclient_instance(self):
+        return shared_pool()
 
 
     def __getattr__(self, name):
@@ -55,15 +423,29 @@ class Stripe(object):
             tornado_api.Stripe('api_key').plans.get(callback=lambda x: x)
         '''
         if name in self.__class__.resources:
-            self.url = '/'.join([self.url or self.api_endpoint, name])
-            return self
+            # Resources are immutable, so keep this one as an instance
+            # attribute; later accesses no longer reach __getattr__.
+            resource = self.__dict__[name] = StripeResource(self, self.api_endpoint + '/' + name)
+            return resource
         else:
             raise AttributeError(name)
 
 
     @property
     def api_endpoint(self):
-        return 'https://%s:@%s/%s' % (self.api_key, self.__class__.api_hostname, self.__class__.api_version)
+        return 'https://%s/%s' % (self.__class__.api_hostname, self.__class__.api_version)
+
+
+    @property
+    def auth_header(self):
+        '''
+        HTTP Basic Authorization header of the API key, built once per key.
+        Sending it directly spares the HTTP client from parsing credentials out of every URL.
+        '''
+        header = self._auth_headers.get(self.api_key)
+        if header is None:
+            header = self._auth_headers[self.api_key] = 'Basic ' + base64.b64encode(self.api_key + ':')
+        return header
 
 
     def id(self, id):
@@ -73,92 +455,499 @@ class Stripe(object):
             customer_id = 'cus_xyz'
             tornado_api.Stripe('api_key').customers.id(customer_id).subscription.post(callback=lambda x: x)
         '''
-        self.url = '/'.join([self.url or self.api_endpoint, str(id)])
-        return self
+        return StripeResource(self, self.api_endpoint + '/' + str(id))
 
 
-    def reset_url(self):
-        self.url = None
+    def batch(self, operations, concurrency=10, callback=None):
+        '''
+        Runs many API calls with at most `concurrency` of them in flight.
+        Each operation is a (method, path, params) tuple, where path is either a
+        StripeResource or a path relative to api_endpoint. params may be omitted.
+        Example:
+            stripe = tornado_api.Stripe('api_key')
+            result = yield stripe.batch([('GET', stripe.customers.id(cid)) for cid in customer_ids], concurrency=20)
+            customers = result.results
+        Returns a StripeBatchResult (a Future resolving to one when non-blocking).
+        Blocking clients run the operations on run_many() threads when concurrent.futures is available.
+        '''
+        operations = [self._batch_operation(operation) for operation in operations]
 
+        if self.blocking:
+            if ThreadPoolExecutor is None:
+                return self._run_batch_blocking(operations)
+            return self._run_many(operations, concurrency)
 
-    def get(self, **kwargs):
-        return self._call_check_blocking_first('GET', **kwargs)
+        return with_callback(self._run_batch(operations, concurrency), callback)
 
 
-    def post(self, **kwargs):
-        return self._call_check_blocking_first('POST', **kwargs)
+    def run_many(self, operations, workers=8):
+        '''
+        Runs many API calls of a blocking client from `workers` threads.
+        Operations are (method, path, params) tuples, as for batch(). The
+        threads come from one pool shared by every call, sized for the most
+        workers requested so far; each reuses its own HTTP client. Requires
+        concurrent.futures (pip install futures on Python 2).
+        Example:
+            stripe = tornado_api.Stripe('api_key', blocking=True)
+            result = stripe.run_many([('POST', 'charges/%s/refund' % cid) for cid in charge_ids], workers=16)
+            for index in result.failed:
+                print charge_ids[index], result.errors[index]
+        Returns a StripeBatchResult, in the order of operations.
+        '''
+        if not self.blocking:
+            raise ValueError('run_many() requires a blocking client, use batch() instead')
+        if ThreadPoolExecutor is None:
+            raise ValueError('run_many() requires concurrent.futures, pip install futures')
 
+        operations = [self._batch_operation(operation) for operation in operations]
+        return self._run_many(operations, workers)
 
-    def put(self, **kwargs):
-        return self._call_check_blocking_first('PUT', **kwargs)
 
+    def _batch_operation(self, operation):
+        http_method, path = operation[0], operation[1]
+        params = operation[2] if len(operation) > 2 else {}
 
-    def delete(self, **kwargs):
-        return self._call_check_blocking_first('DELETE', **kwargs)
+        if isinstance(path, StripeResource):
+            url = path.url
+        else:
+            url = '/'.join([self.api_endpoint, path.lstrip('/')])
+
+        return http_method.upper(), url, params or {}
+
+
+    def _run_batch_blocking(self, operations):
+        results = [None] * len(operations)
+        errors  = [None] * len(operations)
+        start   = time.time()
+
+        for index, (http_method, url, params) in enumerate(operations):
+            try:
+                results[index] = self._call_check_blocking_first(http_method, url, **params)
+            except Exception, e:
+                errors[index] = e
+
+        return StripeBatchResult(results, errors, time.time() - start)
+
+
+    def _run_many(self, operations, workers):
+        results = [None] * len(operations)
+        errors  = [None] * len(operations)
+        start   = time.time()
+
+        pending = iter(enumerate(operations))
+        lock    = threading.Lock()
+
+        # Each worker takes the next operation, so at most `workers` run at once
+        # however large the shared pool is.
+        def worker():
+            while True:
+                with lock:
+                    item = next(pending, None)
+                if item is None:
+                    return
+
+                index, (http_method, url, params) = item
+                try:
+                    results[index] = self._call_check_blocking_first(http_method, url, **params)
+                except Exception, e:
+                    errors[index] = e
+
+        for future in self._submit(worker, min(max(workers, 1), len(operations))):
+            future.result()
+
+        return StripeBatchResult(results, errors, time.time() - start)
+
+
+    @staticmethod
+    def _submit(fn, workers):
+        '''
+        Runs fn on `workers` threads of the shared pool, replacing the pool by
+        a larger one when it has fewer threads. The old pool finishes its
+        queued work and its threads exit.
+        '''
+        if not workers:
+            return []
+
+        with Stripe._executor_lock:
+            if Stripe._executor_workers < workers:
+                if Stripe._executor is not None:
+                    Stripe._executor.shutdown(wait=False)
+                Stripe._executor         = ThreadPoolExecutor(workers)
+                Stripe._executor_workers = workers
+            return [Stripe._executor.submit(fn) for _ in range(workers)]
+
+
+    @gen.coroutine
+    def _run_batch(self, operations, concurrency):
+        results = [None] * len(operations)
+        errors  = [None] * len(operations)
+        pending = iter(enumerate(operations))
+        start   = time.time()
+
+        @gen.coroutine
+        def worker():
+            for index, (http_method, url, params) in pending:
+                try:
+                    results[index] = yield self._fetch(http_method, url, params)
+                except Exception, e:
+                    errors[index] = e
 
+        yield [worker() for _ in range(min(max(concurrency, 1), len(operations)))]
 
-    def _call_check_blocking_first(self, http_method, **kwargs):
+        raise gen.Return(StripeBatchResult(results, errors, time.time() - start))
+
+
+    def _call_check_blocking_first(self, http_method, url, **kwargs):
         if self.blocking:
-            http_response = self._call(http_method, **kwargs)
+            http_response = self._call(http_method, url, **kwargs)
             return self._parse_response(None, http_response)
         else:
-            return self._call(http_method, **kwargs)
+            return self._call(http_method, url, **kwargs)
 
 
-    def _call(self, http_method, callback=None, **kwargs):
-        copy_of_url = self.url
+    def _call(self, http_method, url, callback=None, **kwargs):
+        if self.blocking:
+            return self._fetch_blocking(http_method, url, kwargs)
 
-        # reset self.url
-        self.reset_url()
+        return with_callback(self._fetch(http_method, url, kwargs), callback)
 
-        httpclient_args = [copy_of_url]
 
-        if not self.blocking:
-            if not callback:
-                callback = lambda x: x
+    def _fetch_blocking(self, http_method, url, params):
+        url, httpclient_kwargs = self._request_args(http_method, url, params)
+        attempt = 0
+
+        quota = self.quota
+        if quota is not None:
+            quota.acquire_blocking()
+
+        failed = True
+        try:
+            while True:
+                delay = self._reserve()
+                if delay:
+                    time.sleep(delay)
+
+                try:
+                    response = self.httpclient_instance.fetch_blocking(url, **httpclient_kwargs)
+                    failed = False
+                    return response
+                except httpclient.HTTPError, e:
+                    delay = self._retry_delay(e.code, e.response, attempt)
+                    if delay is None:
+                        error = self._stripe_error(e.response.body, e.response) if e.response is not None else None
+                        if error is not None:
+                            raise error
+                        raise
+
+                attempt += 1
+                self._report_retry(httpclient_kwargs['endpoint'], attempt, delay)
+                time.sleep(delay)
+        finally:
+            if quota is not None:
+                quota.release(failed, blocking=True)
+
+
+    @gen.coroutine
+    def _fetch(self, http_method, url, params):
+        '''
+        Non-blocking request returning a Future of the parsed response.
+        Throttles per API key and retries transient failures; API errors are
+        set on the Future instead of being raised inside the IOLoop.
+        '''
+        url, httpclient_kwargs = self._request_args(http_method, url, params)
+        attempt = 0
+
+        quota = self.quota
+        if quota is not None:
+            yield quota.acquire()
+
+        failed = True
+        try:
+            while True:
+                delay = self._reserve()
+                if delay:
+                    yield gen.sleep(delay)
+
+                response = yield self.httpclient_instance.fetch(url, raise_error=False, **httpclient_kwargs)
+
+                delay = self._retry_delay(response.code, response, attempt)
+                if delay is None:
+                    break
+
+                attempt += 1
+                self._report_retry(httpclient_kwargs['endpoint'], attempt, delay)
+                yield gen.sleep(delay)
+
+            if response.error is not None:
+                self._raise_error(response.body, response)
+            result = self._parse_response(None, response)
+            failed = False
+        finally:
+            if quota is not None:
+                quota.release(failed)
+
+        raise gen.Return(result)
+
+
+    @gen.coroutine
+    def _stream(self, url, on_item, params):
+        url, httpclient_kwargs = self._request_args('GET', url, params)
+
+        quota = self.quota
+        if quota is not None:
+            yield quota.acquire()
+
+        failed = True
+        try:
+            delay = self._reserve()
+            if delay:
+                yield gen.sleep(delay)
+
+            response, error_body, items = yield fetch_json_items(self.httpclient_instance, url, ('data',), on_item, **httpclient_kwargs)
+
+            if response.error:
+                self._raise_error(error_body, response)
+            failed = False
+        finally:
+            if quota is not None:
+                quota.release(failed)
+
+        raise gen.Return(items)
+
+
+    @property
+    def token_bucket(self):
+        if self.quota is not None:
+            return self.quota.bucket
+
+        buckets = self.__class__._token_buckets
+        bucket  = buckets.get(self.api_key)
+
+        if bucket is None:
+            with self.__class__._token_buckets_lock:
+                bucket = buckets.setdefault(self.api_key, TokenBucket(self.rate_limit, self.rate_burst))
+
+        return bucket
+
+
+    def _reserve(self):
+        '''
+        Takes a token from the bucket. Returns the seconds to wait before sending the request.
+        '''
+        delay = self.token_bucket.reserve()
+        if delay and self.quota is not None:
+            self.quota.count('throttled_seconds', delay)
+        return delay
+
 
-            httpclient_args.append(functools.partial(self._parse_response, callback))
+    def _report_retry(self, endpoint, attempt, delay):
+        if self.quota is not None:
+            self.quota.count('retries')
+        report_retry(*endpoint, attempt=attempt, delay=delay)
 
-        httpclient_kwargs = { 'method': http_method }
 
-        if http_method != 'GET' and kwargs:
-            httpclient_kwargs['body'] = urllib.urlencode(self._nested_dict_to_url(kwargs))
+    def _retry_delay(self, http_code, response, attempt):
+        '''
+        Seconds to wait before retrying, or None when the request should not be retried.
+        Honors Retry-After, otherwise uses exponential backoff with jitter.
+        '''
+        if attempt >= self.max_retries or http_code not in RETRYABLE_HTTP_CODES:
+            return None
 
-        return self.httpclient_instance.fetch(*httpclient_args, **httpclient_kwargs)
+        # The host is known to be down; retrying would only delay the failure.
+        if response is not None and isinstance(response.error, CircuitOpenError):
+            return None
 
+        if response is not None and response.headers.get('Retry-After'):
+            try:
+                return max(float(response.headers['Retry-After']), 0)
+            except ValueError:
+                pass
 
-    def _nested_dict_to_url(self, d):
-        """
-        We want post vars of form:
-        {'foo': 'bar', 'nested': {'a': 'b', 'c': 'd'}}
-        to become (pre url-encoding):
-        foo=bar&nested[a]=b&nested[c]=d
-        """
-        stk = []
-        for key, value in d.items():
-            if isinstance(value, dict):
-                n = {}
-                for k, v in value.items():
-                    n["%s[%s]" % (key, k)] = v
-                stk.extend(self._nested_dict_to_url(n))
+        backoff = min(self.retry_backoff_max, self.retry_backoff * (2 ** attempt))
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+    def _endpoint_name(self, url):
+        '''
+        Metrics label of a URL: resource names are kept, IDs become ":id".
+        '''
+        name = self._endpoint_names.get(url)
+        if name is None:
+            segments = urlparse.urlsplit(url).path.split('/')[2:]
+            name = '/' + '/'.join(s if s in self.__class__.resources else ':id' for s in segments)
+
+            if len(self._endpoint_names) >= MAX_ENTRIES:
+                self._endpoint_names.clear()
+            self._endpoint_names[url] = name
+        return name
+
+
+    def _request_args(self, http_method, url, params):
+        httpclient_kwargs = {
+            'method':   http_method,
+            'endpoint': ('stripe', self._endpoint_name(url)),
+            'headers':  {'Authorization': self.auth_header},
+        }
+
+        if self.stripe_account:
+            httpclient_kwargs['headers']['Stripe-Account'] = self.stripe_account
+
+        if params:
+            encoded = form_encode(params)
+            if http_method == 'GET':
+                url += '?' + encoded
             else:
-                stk.append((key, value))
-        return stk
+                httpclient_kwargs['body'] = encoded
+
+        if http_method == 'POST':
+            # Retried POSTs must not create duplicate charges.
+            httpclient_kwargs['headers']['Idempotency-Key'] = os.urandom(16).encode('hex')
+
+        return url, httpclient_kwargs
 
 
     def _parse_response(self, callback, response):
         """Parse a response from the API"""
+        res = self._parse_body(response.body, response)
+
+        if callback:
+            callback(res)
+        else:
+            return res
+
+
+    def _raise_error(self, body, response):
+        '''
+        Raises the StripeError in the body of a failed response, or the
+        response's own error when the body is not a Stripe error, e.g. for
+        connection errors, timeouts or HTML error pages.
+        '''
+        error = self._stripe_error(body, response)
+        if error is not None:
+            raise error
+        response.rethrow()
+
+
+    def _stripe_error(self, body, response):
+        '''
+        The StripeError in the body of a failed response, or None.
+        '''
+        if not body:
+            return None
         try:
-            res = escape.json_decode(response.body)
+            res = _codec.loads(body)
+        except ValueError:
+            return None
+        if isinstance(res, dict) and isinstance(res.get('error'), dict):
+            return StripeError(res['error'].get('type'), res['error'].get('message'), response.code, response)
+        return None
+
+
+    def _parse_body(self, body, response):
+        try:
+            res = _codec.loads(body)
         except Exception, e:
             e.args += ('API response was: %s' % response,)
             raise e
 
         if res.get('error'):
-            raise Exception('Error(%s): %s' % (res['error']['type'], res['error']['message']))
+            raise StripeError(res['error']['type'], res['error']['message'], getattr(response, 'code', None))
 
-        if callback:
-            callback(res)
-        else:
-            return res
+        return res
+
+
+
+class StripeRegistry(object):
+    """
+    Stripe handles for many accounts, all sharing one HTTP client pool.
+
+    account(account_id) returns a handle acting on a connected account with
+    the platform key, through the Stripe-Account header; key(api_key)
+    returns one for an account's own key. Handles are built once and
+    reused. Every account or key gets its own StripeQuota: `concurrency`
+    calls in flight and rate_limit requests per second, unless set_quota()
+    gave it other limits. stats() returns the counters of every quota,
+    keyed by account ID, or by a digest for API keys.
 
+    Example:
+        registry = tornado_api.StripeRegistry('sk_live_platform', concurrency=5, rate_limit=10)
+        charges  = yield registry.account('acct_1032D82eZvKYlo2C').charges.get(limit=10)
+    """
+    def __init__(self, platform_key=None, concurrency=10, rate_limit=None, rate_burst=None, blocking=False, max_retries=None,
+                 stripe_class=None):
+        self.stripe_class = stripe_class or Stripe
+        self.platform_key = platform_key
+        self.concurrency  = concurrency
+        self.rate_limit   = rate_limit or Stripe.rate_limit
+        self.rate_burst   = rate_burst or rate_limit or Stripe.rate_burst
+        self.blocking     = blocking
+        self.max_retries  = max_retries
+
+        self._handles = {}
+        self._quotas  = {}
+        self._limits  = {}
+        self._lock    = threading.Lock()
+
+
+    def account(self, account_id):
+        '''
+        Handle on a connected account, authenticated with the platform key.
+        '''
+        if self.platform_key is None:
+            raise ValueError('StripeRegistry.account() requires a platform_key')
+        return self._handle(account_id, self.platform_key, account_id)
+
+
+    def key(self, api_key):
+        '''
+        Handle using an account's own API key.
+        '''
+        return self._handle(api_key, api_key, None)
+
+
+    def set_quota(self, name, concurrency=None, rate_limit=None, rate_burst=None):
+        '''
+        Overrides the limits of one account ID or API key. Applies to handles obtained afterwards.
+        '''
+        with self._lock:
+            self._limits[name] = (concurrency, rate_limit, rate_burst)
+            self._quotas.pop(name, None)
+            self._handles.pop(name, None)
+
+
+    def quota(self, name):
+        quota = self._quotas.get(name)
+        if quota is None:
+            with self._lock:
+                quota = self._quotas.get(name)
+                if quota is None:
+                    concurrency, rate_limit, rate_burst = self._limits.get(name, (None, None, None))
+                    quota = self._quotas[name] = StripeQuota(
+                        self._label(name),
+                        concurrency or self.concurrency,
+                        rate_limit or self.rate_limit,
+                        rate_burst or rate_limit or self.rate_burst
+                    )
+        return quota
+
+
+    def stats(self):
+        return dict((quota.name, quota.stats()) for quota in self._quotas.values())
+
+
+    def _handle(self, name, api_key, stripe_account):
+        handle = self._handles.get(name)
+        if handle is None:
+            quota  = self.quota(name)
+            handle = self.stripe_class(api_key, blocking=self.blocking, max_retries=self.max_retries, stripe_account=stripe_account, quota=quota)
+            with self._lock:
+                handle = self._handles.setdefault(name, handle)
+        return handle
+
+
+    def _label(self, name):
+        # API keys are secrets; do not expose them through stats().
+        if name.startswith('acct_'):
+            return name
+        return 'key_' + hashlib.sha1(name).hexdigest()[:12]
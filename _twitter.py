@@ -14,31 +14,62 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import ssl
+import time
+import urllib
 import logging
+import urlparse
+import datetime
 
 import twitter
-from tornado import httpclient, escape
+from tornado import gen, httputil, http1connection, iostream, locks, queues
+from tornado.ioloop import IOLoop
+from tornado.tcpclient import TCPClient
 
-class Twitter(twitter.Twitter):
-    """
-    Extension of twitter.Twitter to use tornado.httpclient().
-    Requirement:
-        - twitter egg. See: http://mike.verdone.ca/twitter/
+import _codec
+import _routes
+from _concurrent import with_callback
+from _httpclient import shared_pool
 
-    Why?
-        I want to perform Twitter request outside Tornado's request life-cycle.
-        Thus, the mixin is kind of useless.
-        But at the same time, I don't want blocking library.
+POST_ACTIONS = frozenset(twitter.twitter_globals.POST_ACTIONS)
+
+_methods = {}
+
+
+def method_for_uriparts(uriparts):
+    '''
+    HTTP method of an API path: POST when its last part, or its last two
+    parts, are one of twitter_globals.POST_ACTIONS. Trailing numeric IDs and
+    _placeholders are skipped, so statuses/destroy/123 is a POST. Memoized
+    per path.
+    '''
+    method = _methods.get(uriparts)
+
+    if method is None:
+        parts = list(uriparts)
+        while parts and (parts[-1].isdigit() or parts[-1].startswith('_')):
+            parts.pop()
+
+        post = bool(parts) and (parts[-1] in POST_ACTIONS or '/'.join(parts[-2:]) in POST_ACTIONS)
+
+        if len(_methods) >= _routes.MAX_ENTRIES:
+            _methods.clear()
+        method = _methods[uriparts] = 'POST' if post else 'GET'
+
+    return method
+
+
+class TwitterCall(twitter.api.TwitterCall):
+    """
+    twitter.api.TwitterCall making its request with tornado.httpclient.
+    Every attribute of a Twitter instance, e.g. twitter.statuses.home_timeline, is one of these.
     """
     def _http_protocol(self):
         return "https" if self.secure else "http"
 
 
     def _http_method_from_kwargs(self, kwargs):
-        method = kwargs.pop('_method', "GET")
-        for action in twitter.twitter_globals.POST_ACTIONS:
-            if re.search("%s(/\d+)?$" % action, uri):
-                method = "POST"
+        method = kwargs.pop('_method', None) or method_for_uriparts(self.uriparts)
         return method, kwargs
 
 
@@ -64,15 +95,22 @@ class Twitter(twitter.Twitter):
 
 
     def __call__(self, **kwargs):
-        protocol         = self._http_protocol()
+        """
+        Returns a Future of the decoded response, or of None if the request failed.
+        _callback, when given, is also called with that result.
+        """
         method, kwargs   = self._http_method_from_kwargs(kwargs)
         callback, kwargs = self._http_callback_from_kwargs(kwargs)
         uri, kwargs      = self._http_request_path_from_kwargs(kwargs)
 
-        url = "%s://%s/%s" %(protocol, self.domain, uri)
+        path = "/" + uri
         if self.format:
-            url += ".%s" %(self.format)
+            path += ".%s" %(self.format)
+
+        base_url = "%s://%s" %(self._http_protocol(), self.domain)
+        url, endpoint = _routes.route("twitter", base_url, path)
 
+        # The OAuth signature covers the URL, method and arguments; it is computed once, here.
         headers = self.auth.generate_headers() if self.auth else {}
 
         arg_data = self.auth.encode_params(url, method, kwargs)
@@ -82,29 +120,339 @@ class Twitter(twitter.Twitter):
         else:
             body = arg_data.encode('utf8')
 
-        return self._handle_response(url, headers, method=method, body=body, callback=callback)
+        return self._handle_response(url, headers, method=method, body=body, callback=callback, endpoint=endpoint)
+
+
+    def _handle_response(self, url, headers, method="GET", body=None, callback=None, endpoint=None):
+        return with_callback(self._twitter_fetch(url, headers, method, body, endpoint), callback)
+
+
+    @gen.coroutine
+    def _twitter_fetch(self, url, headers, method, body, endpoint):
+        http = shared_pool()
+        if method == "POST":
+            response = yield http.fetch(url, headers=headers, method=method, body=body, raise_error=False, endpoint=endpoint)
+        else:
+            response = yield http.fetch(url, headers=headers, raise_error=False, endpoint=endpoint)
+        raise gen.Return(self._on_twitter_request(response))
+
+
+    def _on_twitter_request(self, response):
+        if response.error:
+            logging.warning("Error response %s fetching %s", response.error, response.request.url)
+            return None
+
+        if self.format == "json":
+            return _codec.loads(response.body)
+        else:
+            return response.body
+
+
+class Twitter(TwitterCall, twitter.Twitter):
+    """
+    Extension of twitter.Twitter to use tornado.httpclient().
+    Requirement:
+        - twitter egg. See: http://mike.verdone.ca/twitter/
+
+    Why?
+        I want to perform Twitter request outside Tornado's request life-cycle.
+        Thus, the mixin is kind of useless.
+        But at the same time, I don't want blocking library.
+    """
+    def __init__(self, *args, **kwargs):
+        twitter.Twitter.__init__(self, *args, **kwargs)
+
+        # twitter.Twitter builds its children, e.g. twitter.statuses, as blocking TwitterCalls.
+        self.callable_cls = TwitterCall
+
+
+# Responses a stream cannot recover from by reconnecting.
+FATAL_STREAM_CODES = frozenset([400, 401, 403, 404, 406, 413, 416])
+
+
+class MessageFramer(object):
+    """
+    Splits the body of a streaming response into its messages.
+
+    Messages are delimited by CRLF and may arrive split across any number
+    of chunks; a partial message is kept until its end arrives. Blank
+    keep-alive lines and the length prefixes sent with delimited=length are
+    skipped.
+    """
+    def __init__(self):
+        self._pending = []
+
+
+    def feed(self, chunk):
+        '''
+        Returns the messages completed by chunk.
+        '''
+        self._pending.append(chunk)
+        if '\n' not in chunk:
+            return []
+
+        lines = ''.join(self._pending).split('\n')
+        tail  = lines.pop()
+        self._pending = [tail] if tail else []
+
+        messages = []
+        for line in lines:
+            line = line.strip()
+            if line and not line.isdigit():
+                messages.append(line)
+        return messages
+
+
+class _StreamDelegate(httputil.HTTPMessageDelegate):
+    def __init__(self, stream):
+        self.stream = stream
+        self.code   = None
+        self.error  = []
+
+
+    def headers_received(self, start_line, headers):
+        self.code = start_line.code
+
+
+    def data_received(self, chunk):
+        if self.code == 200:
+            self.stream._on_chunk(chunk)
+        elif sum(map(len, self.error)) < 4096:
+            self.error.append(chunk)
+
+
+class TwitterStream(object):
+    """
+    Consumer of a Twitter streaming endpoint, e.g. statuses/filter or statuses/sample.
+
+    The connection stays open for as long as Twitter keeps it: messages are
+    framed incrementally as chunks arrive, each chunk's messages are decoded
+    together, and the results are put on a bounded queue read with next().
+    When the consumer falls behind and max_queue messages are waiting, new
+    messages are dropped and counted in `dropped`.
+
+    Dropped connections are reopened following Twitter's guidelines: network
+    errors and stalls (nothing received for stall_timeout seconds, keep-alives
+    included) back off linearly from 250ms up to 16s, HTTP errors
+    exponentially from 5s up to 320s, and rate limiting (420, 429)
+    exponentially from one minute. The stream stops on errors that
+    reconnecting cannot fix, such as 401.
+
+    Each stream holds its own connection rather than a slot of the shared
+    client pool, so one process can keep many of them open.
+
+    Example:
+        stream = tornado_api.TwitterStream('statuses/filter', auth=auth, track='tornado,python').start()
+        while True:
+            tweet = yield stream.next()
+            if tweet is None:
+                break
+    """
+    def __init__(self, path, auth=None, domain='stream.twitter.com', api_version='1.1', secure=True, method=None,
+                 max_queue=1000, stall_timeout=90, connect_timeout=10, **params):
+        self.path            = path
+        self.auth            = auth
+        self.params          = params
+        self.method          = method or ('POST' if path.endswith('filter') else 'GET')
+        self.url             = '%s://%s/%s/%s.json' % ('https' if secure else 'http', domain, api_version, path)
+        self.max_queue       = max_queue
+        self.stall_timeout   = stall_timeout
+        self.connect_timeout = connect_timeout
+
+        self.queue      = queues.Queue(maxsize=max_queue + 1)     # one slot is kept for the end marker
+        self.messages   = 0
+        self.dropped    = 0
+        self.reconnects = 0
+        self.error      = None
+
+        self._stopped   = locks.Event()
+        self._iostream  = None
+        self._attempt   = 0
+        self._last_data = None
+        self._framer    = None
+
+
+    def start(self):
+        '''
+        Connects on the current IOLoop. Returns the stream.
+        '''
+        IOLoop.current().spawn_callback(self._run)
+        return self
+
+
+    def stop(self):
+        '''
+        Closes the connection. next() returns None once the queued messages have been read.
+        '''
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._iostream is not None:
+            self._iostream.close()
+        self.queue.put_nowait(None)
+
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+
+    @gen.coroutine
+    def next(self, timeout=None):
+        '''
+        Returns a Future of the next message, or of None when the stream has stopped.
+        '''
+        message = yield self.queue.get(timeout)
+        if message is None:
+            self.queue.put_nowait(None)
+        raise gen.Return(message)
+
+
+    @gen.coroutine
+    def _run(self):
+        tcp_client = TCPClient()
+
+        while not self.stopped:
+            code, error = yield self._connect(tcp_client)
+            if self.stopped:
+                break
+
+            if code in FATAL_STREAM_CODES:
+                self.error = 'HTTP %d: %s' % (code, error)
+                logging.error("Twitter stream %s stopped: %s", self.path, self.error)
+                self.stop()
+                break
+
+            delay = self._backoff(code)
+            self.reconnects += 1
+            logging.warning("Twitter stream %s disconnected (%s), reconnecting in %.2fs", self.path, code or error, delay)
+            try:
+                yield self._stopped.wait(datetime.timedelta(seconds=delay))
+            except gen.TimeoutError:
+                pass
+
+
+    @gen.coroutine
+    def _connect(self, tcp_client):
+        '''
+        Runs one connection until it ends. Returns (status code or None, error description).
+        '''
+        url, headers, body = self._signed_request()
+        parts = urlparse.urlsplit(url)
+        https = parts.scheme == 'https'
+
+        try:
+            stream = yield gen.with_timeout(datetime.timedelta(seconds=self.connect_timeout),
+                tcp_client.connect(parts.hostname, parts.port or (443 if https else 80),
+                                   ssl_options=ssl.create_default_context() if https else None))
+        except (gen.TimeoutError, iostream.StreamClosedError, IOError), e:
+            raise gen.Return((None, str(e) or e.__class__.__name__))
+
+        if self.stopped:
+            stream.close()
+            raise gen.Return((None, 'stopped'))
+
+        self._iostream  = stream
+        self._framer    = MessageFramer()
+        self._last_data = time.time()
+        self._watch(stream)
+
+        delegate   = _StreamDelegate(self)
+        connection = http1connection.HTTP1Connection(stream, True, http1connection.HTTP1ConnectionParameters(
+            no_keep_alive=True, decompress=True))
+        try:
+            connection.write_headers(httputil.RequestStartLine(self.method, parts.path + ('?' + parts.query if parts.query else ''), 'HTTP/1.1'), headers)
+            if body:
+                connection.write(body)
+            connection.finish()
+            yield connection.read_response(delegate)
+        except iostream.StreamClosedError, e:
+            error = str(e.real_error or 'connection closed')
+        else:
+            error = ''.join(delegate.error) or 'connection closed'
+        finally:
+            stream.close()
+            self._iostream = None
+
+        raise gen.Return((delegate.code, error))
+
+
+    def _signed_request(self):
+        '''
+        Signs the request again for every connection, as OAuth signatures include a timestamp and nonce.
+        '''
+        url     = self.url
+        headers = httputil.HTTPHeaders({'Host': urlparse.urlsplit(url).netloc, 'Accept-Encoding': 'gzip', 'Connection': 'close'})
+
+        if self.auth:
+            headers.update(self.auth.generate_headers())
+            arg_data = self.auth.encode_params(url, self.method, self.params)
+        else:
+            arg_data = urllib.urlencode(self.params)
+
+        body = None
+        if self.method == 'GET':
+            if arg_data:
+                url += '?' + arg_data
+        else:
+            body = arg_data.encode('utf8')
+            headers['Content-Type']   = 'application/x-www-form-urlencoded'
+            headers['Content-Length'] = str(len(body))
+
+        return url, headers, body
+
 
+    def _watch(self, stream):
+        if stream.closed():
+            return
 
-    def _handle_response(self, url, headers, method="GET", body=None, callback=None):
-        http = httpclient.AsyncHTTPClient()
-        if req.method == "POST":
-            http.fetch(url, headers=headers, method=method, body=body, callback=self._on_twitter_request(callback))
+        idle = time.time() - self._last_data
+        if idle >= self.stall_timeout:
+            logging.warning("Twitter stream %s stalled for %ds", self.path, idle)
+            stream.close()
         else:
-            http.fetch(url, headers=req.headers, callback=self._on_twitter_request(callback))
+            IOLoop.current().call_later(self.stall_timeout - idle, self._watch, stream)
+
+
+    def _on_chunk(self, chunk):
+        self._last_data = time.time()
+        self._attempt   = 0
+
+        messages = self._framer.feed(chunk)
+        if not messages:
+            return
+
+        for message in self._decode(messages):
+            if self.queue.qsize() >= self.max_queue:
+                self.dropped += 1
+                continue
+            self.messages += 1
+            self.queue.put_nowait(message)
 
 
-    def _on_twitter_request(self, callback):
-        if not callback: callback = lambda x: x
+    def _decode(self, messages):
+        '''
+        Decodes the messages of one chunk with a single call to the JSON codec,
+        falling back to one call per message when one of them is malformed.
+        '''
+        try:
+            return _codec.loads('[' + ','.join(messages) + ']')
+        except ValueError:
+            decoded = []
+            for message in messages:
+                try:
+                    decoded.append(_codec.loads(message))
+                except ValueError:
+                    logging.warning("Dropping malformed Twitter stream message: %.200r", message)
+            return decoded
 
-        def call_me_later(response):
-            if response.error:
-                logging.warning("Error response %s fetching %s", response.error, response.request.url)
-                callback(None)
-                return
 
-            if self.format == "json":
-                callback(escape.json_decode(response.body))
-            else:
-                callback(response.body)
-        return call_me_later
+    def _backoff(self, code):
+        attempt = self._attempt
+        self._attempt += 1
 
+        if code in (420, 429):
+            return min(60 * 2 ** attempt, 960)
+        if code is None or code == 200:
+            return min(0.25 * (attempt + 1), 16)
+        return min(5 * 2 ** attempt, 320)
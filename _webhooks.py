@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2012 Didip Kerabat
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import hmac
+import hashlib
+import logging
+import collections
+
+from tornado import gen, queues, web
+from tornado.ioloop import IOLoop
+
+import _codec
+from _stripe import StripeError
+
+
+def verify_stripe_signature(payload, header, secret, tolerance=300):
+    '''
+    Checks the Stripe-Signature header of a webhook request, e.g.
+    "t=1492774577,v1=5257a869...". The signed payload is "<t>.<body>",
+    signed with HMAC-SHA256 under the endpoint secret. Raises StripeError
+    when no v1 signature matches or the timestamp is more than tolerance
+    seconds away from now.
+    '''
+    timestamp  = None
+    signatures = []
+    for item in (header or '').split(','):
+        name, _, value = item.strip().partition('=')
+        if name == 't':
+            timestamp = value
+        elif name == 'v1':
+            signatures.append(value)
+
+    if timestamp is None or not signatures:
+        raise StripeError('invalid_signature', 'Malformed Stripe-Signature header')
+
+    try:
+        age = abs(time.time() - int(timestamp))
+    except ValueError:
+        raise StripeError('invalid_signature', 'Malformed Stripe-Signature timestamp')
+    if tolerance and age > tolerance:
+        raise StripeError('invalid_signature', 'Stripe-Signature timestamp outside the tolerance zone')
+
+    expected = hmac.new(secret, '%s.%s' % (timestamp, payload), hashlib.sha256).hexdigest()
+    if not any(hmac.compare_digest(expected, str(signature)) for signature in signatures):
+        raise StripeError('invalid_signature', 'No Stripe-Signature matches the payload')
+
+
+class StripeEventPipeline(object):
+    """
+    Hands Stripe events to a pool of workers through a bounded queue.
+
+    on_event(event) is called once per event, by one of `workers`
+    coroutines; it may return a Future. Events already seen are dropped
+    using an LRU of the last `dedupe_size` event IDs, since Stripe delivers
+    at least once. When max_queue events are waiting, submit() refuses new
+    ones so the webhook can ask Stripe to retry later instead of buffering
+    without limit.
+    """
+    def __init__(self, on_event, workers=4, max_queue=1000, dedupe_size=10000):
+        self.on_event    = on_event
+        self.workers     = workers
+        self.dedupe_size = dedupe_size
+
+        self.queue   = queues.Queue(maxsize=max_queue)
+        self.seen    = collections.OrderedDict()
+        self.started = False
+
+
+    def start(self):
+        '''
+        Starts the workers on the current IOLoop. Called by the first submit().
+        '''
+        if not self.started:
+            self.started = True
+            for _ in range(self.workers):
+                IOLoop.current().spawn_callback(self._worker)
+
+
+    def submit(self, event):
+        '''
+        Queues an event. Returns "queued", "duplicate" or "full".
+        '''
+        self.start()
+
+        event_id = event.get('id')
+        if event_id is not None and event_id in self.seen:
+            return 'duplicate'
+
+        try:
+            self.queue.put_nowait(event)
+        except queues.QueueFull:
+            return 'full'
+
+        if event_id is not None:
+            self.seen[event_id] = True
+            if len(self.seen) > self.dedupe_size:
+                self.seen.popitem(last=False)
+        return 'queued'
+
+
+    def join(self, timeout=None):
+        '''
+        Returns a Future resolved once every queued event has been processed.
+        '''
+        return self.queue.join(timeout)
+
+
+    @gen.coroutine
+    def _worker(self):
+        while True:
+            event = yield self.queue.get()
+            try:
+                yield gen.maybe_future(self.on_event(event))
+            except Exception:
+                logging.exception('Processing Stripe event %s failed', event.get('id'))
+            finally:
+                self.queue.task_done()
+
+
+class StripeWebhookHandler(web.RequestHandler):
+    """
+    Receives Stripe webhooks and feeds them to a StripeEventPipeline.
+
+    Requests with an invalid signature or body get a 400. When the pipeline
+    is full the handler answers 503, and Stripe retries the delivery later.
+    Example:
+        pipeline = tornado_api.StripeEventPipeline(handle_event, workers=8, max_queue=5000)
+        application = tornado.web.Application([
+            (r'/stripe/webhook', tornado_api.StripeWebhookHandler, dict(secret='whsec_...', pipeline=pipeline)),
+        ])
+    """
+    def initialize(self, secret, pipeline, tolerance=300):
+        self.secret    = secret
+        self.pipeline  = pipeline
+        self.tolerance = tolerance
+
+
+    def check_xsrf_cookie(self):
+        # Stripe cannot send an XSRF token; the signature authenticates the request.
+        pass
+
+
+    def post(self):
+        try:
+            verify_stripe_signature(self.request.body, self.request.headers.get('Stripe-Signature'), self.secret, self.tolerance)
+            event = _codec.loads(self.request.body)
+        except StripeError, e:
+            logging.warning('Rejected Stripe webhook: %s', e.message)
+            raise web.HTTPError(400)
+        except ValueError:
+            raise web.HTTPError(400)
+
+        if not isinstance(event, dict):
+            raise web.HTTPError(400)
+
+        status = self.pipeline.submit(event)
+        if status == 'full':
+            self.set_status(503)
+            self.set_header('Retry-After', '30')
+
+        self.write({'received': status != 'full', 'status': status})
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+"""
+Throughput, latency and memory of every client against a local mock API.
+
+Starts benchmarks/mock_server.py in a child process, then runs each
+scenario at every concurrency level and reports requests/sec, p50/p95/p99
+latency, errors and peak RSS. Every scenario runs in a process of its own,
+so its peak RSS is not inflated by the scenarios before it. Nothing leaves
+the machine, so it can run in CI. Usage:
+
+    python benchmarks/clients.py [--concurrency 1,10,50,100] [--requests 1000]
+                                 [--latency 0.02] [--error-rate 0] [--items 100]
+                                 [--backend simple] [--max-clients-per-host 50]
+                                 [--cache] [--no-coalesce]
+                                 [--save results.json] [--baseline results.json --tolerance 0.2]
+
+Run it twice with different pool or cache options to compare them side by
+side; --baseline exits with status 1 when a scenario got slower than the
+saved results by more than --tolerance.
+"""
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import gc
+import json
+import logging
+import time
+import socket
+import resource
+import optparse
+import tempfile
+import subprocess
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import tornado_api
+from tornado_api import Stripe, FacebookGraphMixin, FoursquareMixin, Twitter, ResponseCache, MemoryCache
+
+MOCK_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_server.py')
+
+
+class BenchStripe(Stripe):
+    # The mock server is the only upstream; do not throttle against it.
+    rate_limit = 1e9
+    rate_burst = 1e9
+
+    base_url = None
+
+    @property
+    def api_endpoint(self):
+        return self.base_url
+
+
+def stripe_list(base_url, options):
+    stripe = BenchStripe('sk_bench', max_retries=0)
+    stripe.base_url = base_url + '/stripe/v1'
+    return lambda: stripe.events.get(limit=100)
+
+
+def stripe_create(base_url, options):
+    stripe = BenchStripe('sk_bench', max_retries=0)
+    stripe.base_url = base_url + '/stripe/v1'
+    return lambda: stripe.charges.post(amount=1000, currency='usd', card={'number': '4242424242424242', 'exp_month': 12, 'exp_year': 2030})
+
+
+def facebook_feed(base_url, options):
+    class Graph(FacebookGraphMixin):
+        _BASE_URL = base_url + '/facebook'
+        facebook_cache = ResponseCache(MemoryCache()) if options.cache else None
+    if not options.coalesce:
+        Graph.facebook_inflight = None
+
+    graph = Graph()
+    return lambda: graph.facebook_request('/me/feed', access_token='bench')
+
+
+def foursquare_venues(base_url, options):
+    class Foursquare(FoursquareMixin):
+        _BASE_URL = base_url + '/foursquare/v2'
+        foursquare_cache = ResponseCache(MemoryCache()) if options.cache else None
+    if not options.coalesce:
+        Foursquare.foursquare_inflight = None
+
+    foursquare = Foursquare()
+    return lambda: foursquare.foursquare_request('/venues/search', access_token='bench', ll='47.6,-122.3')
+
+
+def twitter_timeline(base_url, options):
+    twitter = Twitter(domain=base_url.split('://', 1)[1] + '/twitter', secure=False, api_version='1.1')
+    return lambda: twitter.statuses.home_timeline(count=20)
+
+
+SCENARIOS = [
+    ('stripe-list',       stripe_list),
+    ('stripe-create',     stripe_create),
+    ('facebook-feed',     facebook_feed),
+    ('foursquare-venues', foursquare_venues),
+    ('twitter-timeline',  twitter_timeline),
+]
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(q / 100.0 * len(values)))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on OS X.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+@gen.coroutine
+def run(call, requests, concurrency):
+    '''
+    Issues requests calls from concurrency workers.
+    Returns (elapsed seconds, sorted latencies, error count).
+    '''
+    latencies = []
+    errors    = [0]
+    remaining = [requests]
+
+    @gen.coroutine
+    def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            started = time.time()
+            try:
+                result = yield gen.maybe_future(call())
+                if result is None:
+                    errors[0] += 1
+            except Exception:
+                errors[0] += 1
+            latencies.append(time.time() - started)
+
+    started = time.time()
+    yield [worker() for _ in xrange(concurrency)]
+    raise gen.Return((time.time() - started, sorted(latencies), errors[0]))
+
+
+@gen.coroutine
+def run_scenarios(base_url, options):
+    results = []
+    for name, factory in SCENARIOS:
+        if options.scenarios and name not in options.scenarios:
+            continue
+
+        call = factory(base_url, options)
+        yield run(call, options.warmup, min(options.warmup, 10) or 1)
+
+        for concurrency in options.concurrency:
+            gc.collect()
+            elapsed, latencies, errors = yield run(call, options.requests, concurrency)
+            result = {
+                'scenario':    name,
+                'concurrency': concurrency,
+                'rps':         len(latencies) / elapsed,
+                'p50':         percentile(latencies, 50) * 1000,
+                'p95':         percentile(latencies, 95) * 1000,
+                'p99':         percentile(latencies, 99) * 1000,
+                'errors':      errors,
+                'rss_mb':      peak_rss_mb(),
+            }
+            results.append(result)
+            print '%(scenario)-20s %(concurrency)11d %(rps)10.1f %(p50)9.1f %(p95)9.1f %(p99)9.1f %(errors)7d %(rss_mb)9.1f' % result
+            sys.stdout.flush()
+
+    raise gen.Return(results)
+
+
+def compare(results, baseline, tolerance):
+    '''
+    Returns a description of every scenario that got slower than baseline by more than tolerance.
+    '''
+    previous = dict(((r['scenario'], r['concurrency']), r) for r in baseline)
+    regressions = []
+    for result in results:
+        before = previous.get((result['scenario'], result['concurrency']))
+        if before is None:
+            continue
+        if result['rps'] < before['rps'] * (1 - tolerance):
+            regressions.append('%(scenario)s @%(concurrency)d: rps' % result + ' %.1f -> %.1f' % (before['rps'], result['rps']))
+        if result['p99'] > before['p99'] * (1 + tolerance):
+            regressions.append('%(scenario)s @%(concurrency)d: p99' % result + ' %.1fms -> %.1fms' % (before['p99'], result['p99']))
+    return regressions
+
+
+def unused_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_mock_server(options):
+    port = unused_port()
+    args = [sys.executable, MOCK_SERVER, '--port', str(port),
+            '--latency', str(options.latency), '--jitter', str(options.jitter),
+            '--error-rate', str(options.error_rate), '--error-code', str(options.error_code)]
+    if options.items is not None:
+        args += ['--items', str(options.items)]
+
+    server = subprocess.Popen(args, stdout=subprocess.PIPE)
+    server.stdout.readline()    # wait until it listens
+    return server, 'http://127.0.0.1:%d' % port
+
+
+def run_isolated(options, base_url):
+    '''
+    Runs each scenario in a child process against the running mock server.
+    Children print their rows as they go; their results are collected from --save files.
+    '''
+    results = []
+    for name, _ in SCENARIOS:
+        if options.scenarios and name not in options.scenarios:
+            continue
+
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__)] + sys.argv[1:] +
+                                  ['--scenarios', name, '--mock-url', base_url, '--save', path])
+            with open(path) as f:
+                results.extend(json.load(f))
+        finally:
+            os.remove(path)
+    return results
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--scenarios', default='', help='comma separated subset of: ' + ', '.join(name for name, _ in SCENARIOS))
+    parser.add_option('--concurrency', default='1,10,50,100', help='comma separated concurrency levels')
+    parser.add_option('--requests', type='int', default=1000, help='requests per concurrency level')
+    parser.add_option('--warmup', type='int', default=50, help='requests before measuring each scenario')
+    parser.add_option('--latency', type='float', default=0.02, help='mock server latency in seconds')
+    parser.add_option('--jitter', type='float', default=0.0)
+    parser.add_option('--error-rate', type='float', default=0.0)
+    parser.add_option('--error-code', type='int', default=500)
+    parser.add_option('--items', type='int', default=None, help='items per list response')
+    parser.add_option('--backend', default=None, help='curl or simple (default: curl when pycurl is installed)')
+    parser.add_option('--max-clients', type='int', default=100)
+    parser.add_option('--max-clients-per-host', type='int', default=50)
+    parser.add_option('--cache', action='store_true', default=False, help='enable the Graph and Foursquare response caches')
+    parser.add_option('--no-coalesce', dest='coalesce', action='store_false', default=True, help='disable coalescing of identical GETs')
+    parser.add_option('--save', help='write the results to this JSON file')
+    parser.add_option('--baseline', help='JSON file from a previous --save to compare against')
+    parser.add_option('--tolerance', type='float', default=0.2, help='allowed slowdown against --baseline')
+    parser.add_option('--mock-url', help=optparse.SUPPRESS_HELP)    # set on the per-scenario child processes
+    options, _ = parser.parse_args()
+
+    # Failed requests are counted in the results; do not log each of them.
+    logging.getLogger().setLevel(logging.ERROR)
+
+    options.scenarios   = [name for name in options.scenarios.split(',') if name]
+    options.concurrency = [int(level) for level in options.concurrency.split(',')]
+
+    pool = tornado_api.configure_httpclient(backend=options.backend, max_clients=options.max_clients,
+                                            max_clients_per_host=options.max_clients_per_host)
+
+    if options.mock_url:
+        results = IOLoop.current().run_sync(lambda: run_scenarios(options.mock_url, options))
+        with open(options.save, 'w') as f:
+            json.dump(results, f)
+        return
+
+    server, base_url = start_mock_server(options)
+    try:
+        print 'backend=%s max_clients=%d max_clients_per_host=%d cache=%s coalesce=%s latency=%.3fs' % (
+            pool.backend, pool.max_clients, pool.max_clients_per_host, options.cache, options.coalesce, options.latency
+        )
+        print '%-20s %11s %10s %9s %9s %9s %7s %9s' % ('scenario', 'concurrency', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors', 'rss MB')
+        sys.stdout.flush()
+        results = run_isolated(options, base_url)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for regression in regressions:
+            print 'REGRESSION', regression
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
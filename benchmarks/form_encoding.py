@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cost of form encoding Stripe request parameters.
+
+Compares _routes.form_encode with the recursive _nested_dict_to_url +
+urllib.urlencode it replaced, on payloads shaped like bulk invoice item
+creation with growing metadata. As in a real import, every payload has
+the same keys but its own values. The old encoder cannot encode lists,
+so list payloads are only timed with the new one. Usage:
+
+    python benchmarks/form_encoding.py [--number 2000]
+"""
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import urllib
+import timeit
+import optparse
+
+from tornado_api._routes import form_encode
+
+
+def nested_dict_to_url(d):
+    stk = []
+    for key, value in d.items():
+        if isinstance(value, dict):
+            n = {}
+            for k, v in value.items():
+                n["%s[%s]" % (key, k)] = v
+            stk.extend(nested_dict_to_url(n))
+        else:
+            stk.append((key, value))
+    return stk
+
+
+def legacy_encode(params):
+    return urllib.urlencode(nested_dict_to_url(params))
+
+
+def invoice_item(metadata_keys, n):
+    return {
+        'customer': 'cus_%014d' % n,
+        'amount': 2500 + n,
+        'currency': 'usd',
+        'description': 'Bulk import line item %d' % n,
+        'metadata': dict(('key_%d' % i, 'value %d-%d / with & special chars' % (n, i)) for i in range(metadata_keys)),
+        'period': {'start': 1380000000 + n, 'end': 1382592000 + n},
+    }
+
+
+def bench(fn, payloads):
+    return min(timeit.repeat(lambda: map(fn, payloads), number=1, repeat=5)) / len(payloads)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--number', type='int', default=2000, help='payloads encoded per measurement')
+    options, _ = parser.parse_args()
+
+    print '%-36s %12s %12s %9s' % ('payload', 'before usec', 'after usec', 'speedup')
+    for metadata_keys in (5, 20, 50):
+        payloads = [invoice_item(metadata_keys, n) for n in range(options.number)]
+        assert sorted(form_encode(payloads[0]).split('&')) == sorted(legacy_encode(payloads[0]).split('&'))
+
+        before = bench(legacy_encode, payloads)
+        after  = bench(form_encode, payloads)
+        print '%-36s %12.1f %12.1f %8.2fx' % ('invoice item, %d metadata keys' % metadata_keys, before * 1e6, after * 1e6, before / after)
+
+    invoices = [{'lines': [invoice_item(5, n * 20 + i) for i in range(20)], 'expand': ['customer', 'lines']} for n in range(options.number / 20)]
+    print '%-36s %12s %12.1f' % ('invoice, 20 lines (lists)', '-', bench(form_encode, invoices) * 1e6)
+
+
+if __name__ == '__main__':
+    main()
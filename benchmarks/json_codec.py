@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+"""
+Decoding cost per response for each available JSON codec.
+
+Uses recorded Stripe, Graph and Foursquare list responses from
+benchmarks/payloads. Usage:
+
+    python benchmarks/json_codec.py [--number 200]
+"""
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import timeit
+import optparse
+
+from tornado import escape
+
+from tornado_api import _codec
+
+PAYLOADS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payloads')
+
+
+def load_payloads():
+    payloads = []
+    for filename in sorted(os.listdir(PAYLOADS)):
+        if filename.endswith('.json'):
+            with open(os.path.join(PAYLOADS, filename), 'rb') as f:
+                payloads.append((filename, f.read()))
+    return payloads
+
+
+def bench(fn, body, number):
+    return min(timeit.repeat(lambda: fn(body), number=number, repeat=3)) / number
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--number', type='int', default=200, help='decodes per measurement')
+    options, _ = parser.parse_args()
+
+    codecs = [('tornado.escape', escape.json_decode)]
+    for codec_name in _codec.available_codecs():
+        _codec.use_codec(codec_name)
+        codecs.append((codec_name, _codec.loads))
+    _codec.use_codec()
+
+    print '%-24s %-16s %12s %10s %10s' % ('payload', 'codec', 'usec/decode', 'MB/s', 'speedup')
+    for filename, body in load_payloads():
+        baseline = None
+        for codec_name, loads in codecs:
+            seconds  = bench(loads, body, options.number)
+            baseline = baseline or seconds
+            print '%-24s %-16s %12.1f %10.1f %9.2fx' % (
+                filename, codec_name, seconds * 1e6, len(body) / seconds / 1e6, baseline / seconds
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the Stripe, Graph, Foursquare and Twitter APIs.
+
+Serves the recorded responses from benchmarks/payloads under one prefix
+per service, with configurable latency, error rate and list sizes:
+
+    /stripe/v1/events, /stripe/v1/charges, /stripe/v1/customers/<id>
+    /facebook/me, /facebook/me/feed
+    /foursquare/v2/venues/search, /foursquare/v2/users/self
+    /twitter/1.1/statuses/home_timeline.json
+
+Usage:
+
+    python benchmarks/mock_server.py [--port 8900] [--latency 0.05] [--jitter 0.02]
+                                     [--error-rate 0.01] [--error-code 500] [--items 100]
+"""
+
+import os, os.path, sys
+import json
+import random
+import optparse
+
+from tornado import gen, web
+from tornado.ioloop import IOLoop
+
+PAYLOADS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'payloads')
+
+ERRORS = {
+    'stripe':     lambda code: {'error': {'type': 'api_error', 'message': 'Mock failure'}},
+    'facebook':   lambda code: {'error': {'type': 'OAuthException', 'message': 'Mock failure', 'code': 2}},
+    'foursquare': lambda code: {'meta': {'code': code, 'errorType': 'server_error', 'errorDetail': 'Mock failure'}, 'response': {}},
+    'twitter':    lambda code: {'errors': [{'code': 131, 'message': 'Mock failure'}]},
+}
+
+
+def load_payload(filename):
+    with open(os.path.join(PAYLOADS, filename), 'rb') as f:
+        return json.load(f)
+
+
+def resize(items, count):
+    '''
+    Repeats or truncates items to count entries. count None keeps them as they are.
+    '''
+    if count is None or not items:
+        return items
+    return [items[i % len(items)] for i in xrange(count)]
+
+
+def build_bodies(items=None):
+    '''
+    Serializes every response once up front, so the server spends its time
+    on I/O rather than on encoding.
+    '''
+    events = load_payload('stripe_events.json')
+    charge = events['data'][0]['data']['object']
+    events['data'] = resize(events['data'], items)
+
+    feed = load_payload('facebook_feed.json')
+    feed['data'] = resize(feed['data'], items)
+
+    venues = load_payload('foursquare_venues.json')
+    venues['response']['venues'] = resize(venues['response']['venues'], items)
+
+    tweets = [{
+        'id': 380000000000000000 + i,
+        'id_str': str(380000000000000000 + i),
+        'created_at': 'Tue Sep 24 10:00:00 +0000 2013',
+        'text': 'Mock tweet number %d with a link http://t.co/abcdefg' % i,
+        'user': {'id': 1000 + i % 50, 'screen_name': 'user%d' % (i % 50), 'followers_count': 42},
+        'retweet_count': i % 7,
+        'favorite_count': i % 5,
+        'entities': {'hashtags': [], 'urls': [{'url': 'http://t.co/abcdefg', 'expanded_url': 'http://example.com/'}]},
+    } for i in xrange(items or 20)]
+
+    bodies = {
+        'stripe/events':        events,
+        'stripe/charge':        charge,
+        'stripe/customer':      {'id': 'cus_00000000000000', 'object': 'customer', 'email': 'bench@example.com', 'livemode': False},
+        'facebook/me':          {'id': '102454', 'name': 'User 102454', 'first_name': 'User', 'last_name': '102454', 'locale': 'en_US'},
+        'facebook/feed':        feed,
+        'foursquare/venues':    venues,
+        'foursquare/user':      {'meta': {'code': 200}, 'response': {'user': {'id': '102454', 'firstName': 'User', 'homeCity': 'Seattle, WA'}}},
+        'twitter/home_timeline': tweets,
+    }
+    return dict((name, json.dumps(body)) for name, body in bodies.iteritems())
+
+
+class MockHandler(web.RequestHandler):
+    def initialize(self, service, body):
+        self.service = service
+        self.body    = body
+
+
+    @gen.coroutine
+    def respond(self):
+        settings = self.application.settings
+        delay = settings['latency'] + random.uniform(0, settings['jitter'])
+        if delay > 0:
+            yield gen.sleep(delay)
+
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        if random.random() < settings['error_rate']:
+            code = settings['error_code']
+            self.set_status(code)
+            self.finish(json.dumps(ERRORS[self.service](code)))
+        else:
+            self.finish(self.application.bodies[self.body])
+
+
+    def get(self, *args):
+        return self.respond()
+
+
+    def post(self, *args):
+        return self.respond()
+
+
+def make_app(latency=0.0, jitter=0.0, error_rate=0.0, error_code=500, items=None):
+    routes = [
+        (r'/stripe/v1/events',                        'stripe',     'stripe/events'),
+        (r'/stripe/v1/charges',                       'stripe',     'stripe/charge'),
+        (r'/stripe/v1/customers/([^/]+)',             'stripe',     'stripe/customer'),
+        (r'/facebook/me',                             'facebook',   'facebook/me'),
+        (r'/facebook/me/feed',                        'facebook',   'facebook/feed'),
+        (r'/foursquare/v2/venues/search',             'foursquare', 'foursquare/venues'),
+        (r'/foursquare/v2/users/self',                'foursquare', 'foursquare/user'),
+        (r'/twitter/1\.1/statuses/home_timeline\.json', 'twitter', 'twitter/home_timeline'),
+    ]
+    app = web.Application(
+        [(pattern, MockHandler, dict(service=service, body=body)) for pattern, service, body in routes],
+        latency=latency, jitter=jitter, error_rate=error_rate, error_code=error_code,
+        log_function=lambda handler: None
+    )
+    app.bodies = build_bodies(items)
+    return app
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=8900)
+    parser.add_option('--latency', type='float', default=0.0, help='seconds added to every response')
+    parser.add_option('--jitter', type='float', default=0.0, help='up to this many more seconds, uniformly distributed')
+    parser.add_option('--error-rate', type='float', default=0.0, help='fraction of requests answered with an error')
+    parser.add_option('--error-code', type='int', default=500, help='HTTP status of error responses')
+    parser.add_option('--items', type='int', default=None, help='items per list response (default: as recorded)')
+    options, _ = parser.parse_args()
+
+    app = make_app(options.latency, options.jitter, options.error_rate, options.error_code, options.items)
+    app.listen(options.port, '127.0.0.1')
+    print 'Mock API listening on http://127.0.0.1:%d' % options.port
+    sys.stdout.flush()
+    IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
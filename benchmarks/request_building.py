@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-call cost of building requests, before any I/O.
+
+Compares the current URL, query string and header building of Stripe,
+Graph, Foursquare and Twitter with the straightforward version they
+replaced: string joins, urllib.urlencode of a fresh dict, uuid4
+idempotency keys, API keys embedded in the URL and a regex search per
+POST action for every Twitter call. Twitter calls are signed with OAuth
+in both versions. Usage:
+
+    python benchmarks/request_building.py [--number 100000]
+"""
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import re
+import uuid
+import urllib
+import urlparse
+import timeit
+import optparse
+
+import twitter
+
+from tornado_api import Stripe, FacebookGraphMixin, FoursquareMixin, Twitter
+from tornado_api._stripe import StripeResource
+from tornado_api._twitter import TwitterCall
+from tornado_api._metrics import endpoint_name
+
+API_KEY = 'sk_test_4eC39HqLyjWDarjtT1zdp7dc'
+TOKEN   = 'CAAGm0PX4ZCpsBAOZBZB1dKZCZAZC' * 4
+
+
+def legacy_stripe_resource(stripe, customer_id):
+    endpoint  = 'https://%s:@%s/%s' % (API_KEY, Stripe.api_hostname, Stripe.api_version)
+    customers = StripeResource(stripe, '/'.join([endpoint, 'customers']))
+    customer  = StripeResource(stripe, '/'.join([customers.url, customer_id]))
+    return StripeResource(stripe, '/'.join([customer.url, 'subscription'])).url
+
+
+def legacy_stripe_request_args(http_method, url):
+    segments = urlparse.urlsplit(url).path.split('/')[2:]
+    endpoint = '/' + '/'.join(s if s in Stripe.resources else ':id' for s in segments)
+    httpclient_kwargs = {'method': http_method, 'endpoint': ('stripe', endpoint)}
+    if http_method == 'POST':
+        httpclient_kwargs['headers'] = {'Idempotency-Key': uuid.uuid4().hex}
+    return url, httpclient_kwargs
+
+
+def legacy_facebook_url(path, access_token, args):
+    url = 'https://graph.facebook.com' + path
+    all_args = {}
+    if access_token:
+        all_args['access_token'] = access_token
+        all_args.update(args)
+    if all_args: url += '?' + urllib.urlencode(all_args)
+    return url, ('facebook', endpoint_name(path))
+
+
+def legacy_foursquare_url(path, access_token, args):
+    url = 'https://api.foursquare.com/v2' + path
+    all_args = {}
+    if access_token:
+        all_args['access_token'] = access_token
+        all_args['oauth_token'] = access_token
+        all_args.update(args)
+    if all_args: url += '?' + urllib.urlencode(all_args)
+    return url, ('foursquare', endpoint_name(path))
+
+
+def legacy_twitter_call(call, kwargs):
+    method = 'GET'
+    uri = '/'.join([str(kwargs.pop(uripart, uripart)) for uripart in call.uriparts])
+    id = kwargs.pop('id', None)
+    if id: uri += '/%s' % id
+    for action in twitter.twitter_globals.POST_ACTIONS:
+        if re.search('%s(/\\d+)?$' % action, uri):
+            method = 'POST'
+
+    url = 'https://%s/%s.%s' % (call.domain, uri, call.format)
+    headers = call.auth.generate_headers()
+    arg_data = call.auth.encode_params(url, method, kwargs)
+    if method == 'GET':
+        url += '?' + arg_data
+        body = None
+    else:
+        body = arg_data.encode('utf8')
+    return url, headers, body, ('twitter', endpoint_name(urlparse.urlsplit(url).path))
+
+
+class NoIOTwitterCall(TwitterCall):
+    def _handle_response(self, url, headers, method='GET', body=None, callback=None, endpoint=None):
+        return url, headers, body, endpoint
+
+
+def bench(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--number', type='int', default=100000, help='calls per measurement')
+    options, _ = parser.parse_args()
+
+    stripe     = Stripe(API_KEY)
+    graph      = FacebookGraphMixin()
+    foursquare = FoursquareMixin()
+    charges    = stripe.charges.url
+
+    tweets = Twitter(auth=twitter.OAuth(TOKEN, 'token-secret', 'consumer-key', 'consumer-secret'))
+    tweets.callable_cls = NoIOTwitterCall
+
+    cases = [
+        ('stripe resource chain',
+            lambda: legacy_stripe_resource(stripe, 'cus_123'),
+            lambda: stripe.customers.id('cus_123').subscription.url),
+        ('stripe POST request args',
+            lambda: legacy_stripe_request_args('POST', charges),
+            lambda: stripe._request_args('POST', charges, None)),
+        ('graph /me/feed url',
+            lambda: legacy_facebook_url('/me/feed', TOKEN, {'limit': 25}),
+            lambda: graph._facebook_url('/me/feed', TOKEN, {'limit': 25})),
+        ('foursquare /venues/search url',
+            lambda: legacy_foursquare_url('/venues/search', TOKEN, {'ll': '47.6,-122.3'}),
+            lambda: foursquare._foursquare_url('/venues/search', TOKEN, {'ll': '47.6,-122.3'})),
+        ('twitter GET home_timeline',
+            lambda: legacy_twitter_call(tweets.statuses.home_timeline, {'count': 20}),
+            lambda: tweets.statuses.home_timeline(count=20)),
+        ('twitter POST statuses/update',
+            lambda: legacy_twitter_call(tweets.statuses.update, {'status': 'Hello world'}),
+            lambda: tweets.statuses.update(status='Hello world')),
+    ]
+
+    print '%-32s %12s %12s %9s' % ('case', 'before usec', 'after usec', 'speedup')
+    for name, before, after in cases:
+        before_seconds = bench(before, options.number)
+        after_seconds  = bench(after, options.number)
+        print '%-32s %12.2f %12.2f %8.2fx' % (name, before_seconds * 1e6, after_seconds * 1e6, before_seconds / after_seconds)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from tornado import gen, web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from tornado_api import HTTPClientPool, CircuitBreaker, CircuitOpenError, FoursquareMixin
+
+
+class FlakyHandler(web.RequestHandler):
+    @gen.coroutine
+    def get(self):
+        app = self.application
+        app.hits += 1
+        if app.slow_hits and app.hits in app.slow_hits:
+            yield gen.sleep(1)
+        self.set_status(503 if app.failing else 200)
+        self.write('hit %d' % app.hits)
+
+
+class CircuitBreakerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/flaky', FlakyHandler)])
+        app.hits      = 0
+        app.failing   = False
+        app.slow_hits = ()
+        return app
+
+
+    @gen_test
+    def circuit_opens_and_recovers_test(self):
+        breaker = CircuitBreaker(window=4, min_requests=4, failure_rate=0.5, open_seconds=0.2)
+        pool    = HTTPClientPool(backend='simple', circuit_breaker=breaker)
+        host    = '127.0.0.1:%d' % self.get_http_port()
+
+        self._app.failing = True
+        for _ in range(4):
+            response = yield pool.fetch(self.get_url('/flaky'), raise_error=False)
+            self.assertEqual(response.code, 503)
+        self.assertEqual(breaker.state(host), 'open')
+
+        # Fails fast without reaching the server.
+        response = yield pool.fetch(self.get_url('/flaky'), raise_error=False)
+        self.assertEqual(response.code, 599)
+        self.assertTrue(isinstance(response.error, CircuitOpenError))
+        with self.assertRaises(CircuitOpenError):
+            yield pool.fetch(self.get_url('/flaky'))
+        self.assertRaises(CircuitOpenError, pool.fetch_blocking, self.get_url('/flaky'))
+        self.assertEqual(self._app.hits, 4)
+
+        # After open_seconds a single probe goes through and closes the circuit.
+        yield gen.sleep(0.25)
+        self._app.failing = False
+        response = yield pool.fetch(self.get_url('/flaky'))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(breaker.state(host), 'closed')
+
+
+    @gen_test
+    def open_circuit_fails_foursquare_request_test(self):
+        class Foursquare(FoursquareMixin):
+            _BASE_URL           = self.get_url('')
+            httpclient_instance = HTTPClientPool(backend='simple', circuit_breaker=CircuitBreaker(window=2, min_requests=2))
+
+        self._app.failing = True
+        foursquare = Foursquare()
+        for _ in range(3):
+            result = yield foursquare.foursquare_request('/flaky')
+            self.assertEqual(result, None)
+        self.assertEqual(self._app.hits, 2)
+
+
+    @gen_test
+    def hedged_get_beats_slow_response_test(self):
+        pool = HTTPClientPool(backend='simple', hedge_gets=True, hedge_percentile=90,
+                              circuit_breaker=CircuitBreaker(failure_rate=None, min_samples=5))
+
+        for _ in range(5):
+            yield pool.fetch(self.get_url('/flaky'))
+
+        self._app.slow_hits = (6,)
+        response = yield pool.fetch(self.get_url('/flaky'))
+
+        self.assertEqual(response.body, 'hit 7')
+        self.assertTrue(response.request_time < 0.5)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import unittest
+
+from tornado import gen, web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from tornado_api import FacebookGraphMixin, ResponseCache, MemoryCache
+
+
+class MemoryCacheTest(unittest.TestCase):
+    def lru_eviction_test(self):
+        cache = MemoryCache(max_entries=2)
+        cache.set('a', 'A', 60)
+        cache.set('b', 'B', 60)
+        cache.get('a')
+        cache.set('c', 'C', 60)
+
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 'C')
+
+
+    def memory_cap_test(self):
+        cache = MemoryCache(max_bytes=10)
+        cache.set('a', 'x' * 6, 60)
+        cache.set('b', 'y' * 6, 60)
+
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 'y' * 6)
+        self.assertEqual(cache.size, 6)
+
+        cache.set('c', 'z' * 11, 60)
+        self.assertEqual(cache.get('c'), None)
+
+
+    def ttl_test(self):
+        cache = MemoryCache()
+        cache.set('a', 'A', -1)
+
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.size, 0)
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def key_test(self):
+        cache = ResponseCache()
+
+        self.assertEqual(cache.key('/me', {'a': 1, 'b': 2}, 'token'), cache.key('/me', {'b': 2, 'a': 1}, 'token'))
+        self.assertNotEqual(cache.key('/me', {}, 'token'), cache.key('/me', {}, 'other-token'))
+        self.assertTrue('token' not in cache.key('/me', {}, 'token'))
+        self.assertEqual(cache.key('/search', {'q': u'café'}, 't'), cache.key('/search', {'q': u'café'.encode('utf-8')}, 't'))
+
+
+    def ttl_test(self):
+        cache = ResponseCache(default_ttl=60, ttls={'/me': 300, '/me/feed': 0})
+
+        self.assertEqual(cache.ttl('/me'), 300)
+        self.assertEqual(cache.ttl('/me/friends'), 300)
+        self.assertEqual(cache.ttl('/me/feed'), 0)
+        self.assertEqual(cache.ttl('/btaylor'), 60)
+
+
+class FakeGraphHandler(web.RequestHandler):
+    @gen.coroutine
+    def get(self, path):
+        self.application.hits += 1
+        yield gen.sleep(0.01)
+        self.write({'id': path, 'hits': self.application.hits})
+
+
+class FacebookCacheTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/(.+)', FakeGraphHandler)])
+        app.hits = 0
+        return app
+
+
+    def request(self, graph, path, **kwargs):
+        return graph.facebook_request(path, access_token='token', **kwargs)
+
+
+    @gen_test
+    def cached_get_test(self):
+        class CachedGraph(FacebookGraphMixin):
+            _BASE_URL      = self.get_url('')
+            facebook_cache = ResponseCache(MemoryCache(), ttls={'/me/feed': 0})
+
+        graph = CachedGraph()
+
+        first  = yield self.request(graph, '/me')
+        second = yield self.request(graph, '/me')
+        other  = yield self.request(graph, '/me', fields='name')
+
+        self.assertEqual(first, second)
+        self.assertEqual(self._app.hits, 2)
+        self.assertEqual(other['hits'], 2)
+
+        yield self.request(graph, '/me/feed')
+        yield self.request(graph, '/me/feed')
+        self.assertEqual(self._app.hits, 4)
+
+
+    @gen_test
+    def single_flight_test(self):
+        class Graph(FacebookGraphMixin):
+            _BASE_URL = self.get_url('')
+
+        graph = Graph()
+        results = yield [self.request(graph, '/venue') for _ in range(5)] + [self.request(graph, '/other')]
+
+        self.assertEqual(self._app.hits, 2)
+        self.assertTrue(all(result is results[0] for result in results[:5]))
+        self.assertEqual(len(graph.facebook_inflight), 0)
+
+        yield self.request(graph, '/venue')
+        self.assertEqual(self._app.hits, 3)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import time
+import shutil
+import tempfile
+
+from tornado import gen, web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from tornado_api import HTTPClientPool, Cassette, CassetteMiss
+from tornado_api._jsonstream import fetch_json_items
+
+
+class CounterHandler(web.RequestHandler):
+    @gen.coroutine
+    def get(self):
+        app = self.application
+        app.hits += 1
+        yield gen.sleep(float(self.get_argument('sleep', 0)))
+        self.set_header('X-Hit', str(app.hits))
+        self.write({'data': [app.hits, self.get_argument('q', None)]})
+
+
+    def post(self):
+        self.application.hits += 1
+        self.set_status(402)
+        self.write({'error': self.get_argument('amount')})
+
+
+class CassetteTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/counter', CounterHandler)])
+        app.hits = 0
+        return app
+
+
+    def setUp(self):
+        super(CassetteTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path      = os.path.join(self.directory, 'test.cassette')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(CassetteTest, self).tearDown()
+
+
+    @gen.coroutine
+    def record(self, *urls):
+        cassette = Cassette(self.path, mode='record')
+        pool     = HTTPClientPool(backend='simple', cassette=cassette)
+        for url in urls:
+            yield pool.fetch(self.get_url(url), raise_error=False)
+        yield pool.fetch(self.get_url('/counter'), method='POST', body='currency=usd&amount=100', raise_error=False)
+        cassette.save()
+
+
+    @gen_test
+    def replay_test(self):
+        yield self.record('/counter?q=a&oauth_nonce=1', '/counter?q=a&oauth_nonce=2', '/counter?q=b')
+        hits = self._app.hits
+
+        pool = HTTPClientPool(backend='simple', cassette=Cassette(self.path))
+
+        # Repeated requests replay in recorded order, then keep replaying the last response.
+        bodies = []
+        for nonce in range(3):
+            response = yield pool.fetch(self.get_url('/counter?oauth_nonce=%d&q=a' % (nonce + 7)))
+            bodies.append(response.body)
+        self.assertEqual(bodies, ['{"data": [1, "a"]}', '{"data": [2, "a"]}', '{"data": [2, "a"]}'])
+        self.assertEqual(response.headers['X-Hit'], '2')
+
+        error = yield pool.fetch(self.get_url('/counter'), method='POST', body='amount=100&currency=usd', raise_error=False)
+        self.assertEqual((error.code, error.body), (402, '{"error": "100"}'))
+
+        self.assertRaises(CassetteMiss, pool.fetch_blocking, self.get_url('/counter?q=c'))
+        self.assertEqual(pool.fetch_blocking(self.get_url('/counter?q=b')).body, '{"data": [3, "b"]}')
+
+        self.assertEqual(self._app.hits, hits)
+
+
+    @gen_test
+    def streamed_response_test(self):
+        cassette = Cassette(self.path, mode='record')
+        items    = []
+        yield fetch_json_items(HTTPClientPool(backend='simple', cassette=cassette), self.get_url('/counter?q=s'), ('data',), items.append)
+        cassette.save()
+
+        pool = HTTPClientPool(backend='simple', cassette=Cassette(self.path))
+        response, error_body, count = yield fetch_json_items(pool, self.get_url('/counter?q=s'), ('data',), items.append)
+
+        self.assertEqual(response.code, 200)
+        self.assertEqual(items, [1, 's', 1, 's'])
+
+
+    @gen_test
+    def keep_latency_test(self):
+        yield self.record('/counter?sleep=0.2')
+
+        for keep_latency in (False, True):
+            pool = HTTPClientPool(backend='simple', cassette=Cassette(self.path, keep_latency=keep_latency))
+            started = time.time()
+            yield pool.fetch(self.get_url('/counter?sleep=0.2'))
+            self.assertEqual(time.time() - started >= 0.2, keep_latency)
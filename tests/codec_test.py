@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import unittest
+
+from tornado_api import _codec
+
+
+class CodecTest(unittest.TestCase):
+    def tearDown(self):
+        _codec.use_codec()
+
+
+    def stdlib_fallback_test(self):
+        self.assertTrue('json' in _codec.available_codecs())
+        self.assertEqual(_codec.use_codec('json'), 'json')
+        self.assertEqual(_codec.loads('{"id": "ch_1", "name": "caf\\u00e9"}'), {'id': 'ch_1', 'name': u'caf\xe9'})
+        self.assertEqual(_codec.loads(_codec.dumps({'a': [1, 2]})), {'a': [1, 2]})
+
+
+    def fastest_by_default_test(self):
+        self.assertEqual(_codec.use_codec(), _codec.available_codecs()[0])
+
+
+    def unknown_codec_test(self):
+        self.assertRaises(ValueError, _codec.use_codec, 'yaml')
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import urlparse
+
+from tornado import escape, gen, web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+import time
+
+from tornado_api import FacebookGraphMixin, SessionStore
+
+
+class FakeBatchHandler(web.RequestHandler):
+    def post(self):
+        batch = escape.json_decode(self.get_argument('batch'))
+        self.application.batches.append(batch)
+
+        results = []
+        for operation in batch:
+            if operation['relative_url'] == 'missing':
+                results.append({'code': 404, 'headers': [], 'body': escape.json_encode({'error': {'message': 'Not found'}})})
+            elif operation['method'] == 'POST':
+                body = dict(urlparse.parse_qsl(operation['body']))
+                results.append({'code': 200, 'headers': [], 'body': escape.json_encode({'posted': body['message']})})
+            else:
+                results.append({'code': 200, 'headers': [], 'body': escape.json_encode({'id': operation['relative_url']})})
+
+        self.write(escape.json_encode(results))
+
+
+class BatchRequestTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/', FakeBatchHandler)])
+        app.batches = []
+        return app
+
+
+    @gen_test
+    def batch_request_test(self):
+        class Graph(FacebookGraphMixin):
+            _BASE_URL = self.get_url('/')
+
+        operations = ['/friend_%d' % i for i in range(120)]
+        operations[60] = '/missing'
+        operations.append({'method': 'post', 'relative_url': '/me/feed', 'body': {'message': 'Hi'}})
+
+        results = yield Graph().facebook_batch_request(operations, access_token='token')
+
+        self.assertEqual([len(batch) for batch in self._app.batches], [50, 50, 21])
+        self.assertEqual(len(results), 121)
+        self.assertEqual(results[0], {'id': 'friend_0'})
+        self.assertEqual(results[60], None)
+        self.assertEqual(results[119], {'id': 'friend_119'})
+        self.assertEqual(results[120], {'posted': 'Hi'})
+
+
+class FakeGraphHandler(web.RequestHandler):
+    def get(self, path):
+        getattr(self.application, 'paths', []).append(path)
+        if path == 'oauth/access_token' and self.get_argument('grant_type', None) == 'fb_exchange_token':
+            self.write('access_token=refreshed_%s&expires=5183999' % self.get_argument('fb_exchange_token'))
+        elif path == 'oauth/access_token':
+            self.write('access_token=token_for_%s&expires=5183999' % self.get_argument('code'))
+        else:
+            self.write({'id': path, 'access_token': self.get_argument('access_token')})
+
+
+class FutureApiTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return web.Application([(r'/(.+)', FakeGraphHandler)])
+
+
+    def graph(self):
+        class Graph(FacebookGraphMixin):
+            _BASE_URL               = self.get_url('')
+            _OAUTH_ACCESS_TOKEN_URL = self.get_url('/oauth/access_token')
+        return Graph()
+
+
+    @gen_test
+    def parallel_requests_test(self):
+        graph = self.graph()
+        me, friends = yield [graph.facebook_request('/me', access_token='token'), graph.facebook_request('/me/friends', access_token='token')]
+
+        self.assertEqual(me['id'], 'me')
+        self.assertEqual(friends['id'], 'me/friends')
+
+
+    @gen_test
+    def callback_still_supported_test(self):
+        results = []
+        result = yield self.graph().facebook_request('/me', callback=results.append, access_token='token')
+        yield gen.moment
+
+        self.assertEqual(results, [result])
+
+
+    @gen_test
+    def get_authenticated_user_test(self):
+        user = yield self.graph().get_authenticated_user('/auth', 'client_id', 'client_secret', 'abc')
+
+        self.assertEqual(user['id'], 'me')
+        self.assertEqual(user['access_token'], 'token_for_abc')
+        self.assertEqual(user['session_expires'], ['5183999'])
+
+
+    @gen_test
+    def prefetch_test(self):
+        user = yield self.graph().get_authenticated_user('/auth', 'client_id', 'client_secret', 'abc', prefetch=['/me/friends', '/me/permissions'])
+
+        self.assertEqual(user['id'], 'me')
+        self.assertEqual(user['prefetched'], {
+            '/me/friends':     {'id': 'me/friends', 'access_token': 'token_for_abc'},
+            '/me/permissions': {'id': 'me/permissions', 'access_token': 'token_for_abc'},
+        })
+
+
+class SessionStoreTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/(.+)', FakeGraphHandler)])
+        app.paths = []
+        return app
+
+
+    def graph(self, sessions):
+        class Graph(FacebookGraphMixin):
+            _BASE_URL               = self.get_url('')
+            _OAUTH_ACCESS_TOKEN_URL = self.get_url('/oauth/access_token')
+            facebook_sessions       = sessions
+        return Graph()
+
+
+    @gen_test
+    def returning_user_skips_profile_test(self):
+        graph = self.graph(SessionStore())
+
+        first  = yield graph.get_authenticated_user('/auth', 'client_id', 'client_secret', 'abc', session_key='visitor')
+        second = yield graph.get_authenticated_user('/auth', 'client_id', 'client_secret', 'abc', session_key='visitor')
+
+        self.assertEqual(second, first)
+        self.assertEqual(self._app.paths, ['oauth/access_token', 'me', 'oauth/access_token'])
+
+
+    @gen_test
+    def new_code_is_honoured_test(self):
+        graph = self.graph(SessionStore())
+
+        yield graph.get_authenticated_user('/auth', 'client_id', 'client_secret', 'abc', session_key='visitor')
+        user = yield graph.get_authenticated_user('/auth', 'client_id', 'client_secret', 'def', session_key='visitor')
+
+        self.assertEqual(user['access_token'], 'token_for_def')
+        self.assertEqual(graph.get_session_user('visitor')['access_token'], 'token_for_def')
+        self.assertEqual(self._app.paths, ['oauth/access_token', 'me', 'oauth/access_token', 'me'])
+
+
+    @gen_test
+    def token_near_expiry_is_refreshed_in_background_test(self):
+        sessions = SessionStore(refresh_within=5184000)
+        graph = self.graph(sessions)
+
+        yield graph.get_authenticated_user('/auth', 'client_id', 'client_secret', 'abc', session_key='visitor')
+        user = graph.get_session_user('visitor', 'client_id', 'client_secret')
+        self.assertEqual(user['access_token'], 'token_for_abc')
+
+        while len(self._app.paths) < 3:
+            yield gen.sleep(0.01)
+        yield gen.sleep(0.01)
+
+        session = sessions.get('facebook', 'visitor')
+        self.assertEqual(session['access_token'], 'refreshed_token_for_abc')
+        self.assertEqual(session['user']['access_token'], 'refreshed_token_for_abc')
+        self.assertEqual(session['user']['id'], 'me')
+
+
+    @gen_test
+    def expired_session_is_ignored_test(self):
+        sessions = SessionStore()
+        sessions.set('facebook', 'visitor', 'old_token', -1, {'id': 'me', 'access_token': 'old_token'})
+
+        user = yield self.graph(sessions).get_authenticated_user('/auth', 'client_id', 'client_secret', 'abc', session_key='visitor')
+
+        self.assertEqual(user['access_token'], 'token_for_abc')
+        self.assertTrue(sessions.get('facebook', 'visitor')['expires_at'] > time.time())
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import socket
+import urlparse
+
+from tornado import escape, web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from tornado_api import FoursquareMixin
+
+
+class FakeMultiHandler(web.RequestHandler):
+    def post(self):
+        requests = self.get_argument('requests').split(',')
+        self.application.calls.append(requests)
+
+        if '/venues/broken' in requests:
+            self.set_status(502)
+            self.write('<html><body>Bad Gateway</body></html>')
+            return
+
+        responses = []
+        for request in requests:
+            path, _, query = request.partition('?')
+            if path == '/venues/missing':
+                responses.append({'meta': {'code': 400, 'errorType': 'param_error', 'errorDetail': 'Value missing is invalid for venue id'}, 'response': {}})
+            else:
+                responses.append({'meta': {'code': 200}, 'response': {'path': path, 'args': dict(urlparse.parse_qsl(query))}})
+
+        self.write(escape.json_encode({'meta': {'code': 200}, 'response': {'responses': responses}}))
+
+
+class MultiRequestTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/multi', FakeMultiHandler)])
+        app.calls = []
+        return app
+
+
+    @gen_test
+    def multi_request_test(self):
+        class Foursquare(FoursquareMixin):
+            _BASE_URL = self.get_url('')
+
+        requests = ['/venues/%d' % i for i in range(11)]
+        requests[3] = '/venues/missing'
+        requests.append(('/venues/search', {'ll': '40.7,-74.0', 'limit': 5}))
+
+        results = yield Foursquare().foursquare_multi_request(requests, access_token='token')
+
+        self.assertEqual([len(call) for call in self._app.calls], [5, 5, 2])
+        self.assertEqual(len(results), 12)
+        self.assertEqual(results[0]['response']['path'], '/venues/0')
+        self.assertEqual(results[3], None)
+        self.assertEqual(results[10]['response']['path'], '/venues/10')
+        self.assertEqual(results[11]['response'], {'path': '/venues/search', 'args': {'ll': '40.7,-74.0', 'limit': '5'}})
+
+
+    @gen_test
+    def failed_multi_call_test(self):
+        class Foursquare(FoursquareMixin):
+            _BASE_URL = self.get_url('')
+
+        requests = ['/venues/%d' % i for i in range(7)]
+        requests[6] = '/venues/broken'
+
+        results = yield Foursquare().foursquare_multi_request(requests, access_token='token')
+
+        self.assertEqual(results[0]['response']['path'], '/venues/0')
+        self.assertEqual(results[5:], [None, None])
+
+
+    @gen_test
+    def unreachable_host_test(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        class Foursquare(FoursquareMixin):
+            _BASE_URL = 'http://127.0.0.1:%d' % port
+
+        results = yield Foursquare().foursquare_multi_request(['/venues/1', '/venues/2'], access_token='token')
+
+        self.assertEqual(results, [None, None])
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import threading
+
+from tornado import gen, web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from tornado_api import HTTPClientPool
+
+
+class SlowHandler(web.RequestHandler):
+    @gen.coroutine
+    def get(self):
+        app = self.application
+        app.in_flight += 1
+        app.max_in_flight = max(app.max_in_flight, app.in_flight)
+        yield gen.sleep(0.01)
+        app.in_flight -= 1
+        self.write('ok')
+
+
+class HTTPClientPoolTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/slow', SlowHandler)])
+        app.in_flight = app.max_in_flight = 0
+        return app
+
+
+    @gen_test
+    def per_host_limit_test(self):
+        pool = HTTPClientPool(backend='simple', max_clients=20, max_clients_per_host=3)
+        responses = yield [pool.fetch(self.get_url('/slow')) for _ in range(12)]
+
+        self.assertEqual([r.body for r in responses], ['ok'] * 12)
+        self.assertTrue(self._app.max_in_flight <= 3)
+
+
+    @gen_test
+    def client_reused_per_ioloop_test(self):
+        pool = HTTPClientPool(backend='simple')
+        self.assertTrue(pool.async_client() is pool.async_client())
+        self.assertEqual(pool.async_client()[0].defaults['request_timeout'], 30)
+
+
+    def blocking_client_per_thread_test(self):
+        pool = HTTPClientPool(backend='simple')
+        clients = []
+        thread = threading.Thread(target=lambda: clients.append(pool.blocking_client()))
+        thread.start()
+        thread.join()
+
+        self.assertTrue(pool.blocking_client() is pool.blocking_client())
+        self.assertFalse(pool.blocking_client() is clients[0])
+
+
+    def unknown_backend_test(self):
+        self.assertRaises(ValueError, HTTPClientPool, backend='carrier-pigeon')
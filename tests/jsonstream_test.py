@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import json
+import unittest
+
+from tornado_api._jsonstream import JSONArrayStreamer
+
+DOCUMENT = json.dumps({
+    'object': 'list',
+    'url': '/v1/events?a=[1,2]',
+    'meta': {'data': ['not', 'this', 'one']},
+    'data': [
+        {'id': 'evt_1', 'nested': {'list': [1, 2, {'x': '}]'}]}},
+        {'id': 'evt_2', 'text': u'quote \\" and \\\\ and unicode é'},
+        [],
+        42,
+        'plain string',
+        None
+    ],
+    'has_more': False
+})
+
+
+class JSONArrayStreamerTest(unittest.TestCase):
+    def stream(self, document, path, chunk_size):
+        items = []
+        streamer = JSONArrayStreamer(path, items.append)
+        for i in range(0, len(document), chunk_size):
+            streamer.feed(document[i:i + chunk_size])
+        streamer.close()
+        return items
+
+
+    def every_chunk_size_test(self):
+        expected = json.loads(DOCUMENT)['data']
+        for chunk_size in range(1, 40):
+            self.assertEqual(self.stream(DOCUMENT, ('data',), chunk_size), expected)
+
+
+    def nested_path_test(self):
+        document = json.dumps({'meta': {'code': 200}, 'response': {'venues': [{'id': 1}, {'id': 2}]}})
+
+        self.assertEqual(self.stream(document, ('response', 'venues'), 3), [{'id': 1}, {'id': 2}])
+        self.assertEqual(self.stream(document, ('venues',), 3), [])
+
+
+    def top_level_array_test(self):
+        self.assertEqual(self.stream('[{"id": 1}, {"id": 2}]', (), 5), [{'id': 1}, {'id': 2}])
+        self.assertEqual(self.stream('[]', (), 1), [])
+
+
+    def bounded_buffer_test(self):
+        streamer = JSONArrayStreamer(('data',), lambda item: None)
+        streamer.feed('{"data": [')
+        for i in range(1000):
+            streamer.feed('{"id": %d, "padding": "%s"},' % (i, 'x' * 100))
+            self.assertTrue(len(streamer._buf) < 200)
+        streamer.feed('{"id": "last"}]}')
+
+        self.assertEqual(streamer.items, 1001)
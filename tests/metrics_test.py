@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import unittest
+
+from tornado import web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from tornado_api import Stripe, FacebookGraphMixin, InMemoryMetrics, StatsdMetrics, add_metrics_hook, remove_metrics_hook
+from tornado_api._metrics import endpoint_name
+
+
+class FlakyHandler(web.RequestHandler):
+    def get(self, path):
+        self.application.hits += 1
+        if self.application.hits == 1:
+            self.set_status(503)
+            self.write({'error': {'type': 'api_error', 'message': 'Try again'}})
+        else:
+            self.write({'id': path})
+
+
+class LocalStripe(Stripe):
+    base_url = None
+
+    @property
+    def api_endpoint(self):
+        return self.base_url
+
+
+class FakeStatsd(object):
+    def __init__(self):
+        self.calls = []
+
+    def timing(self, name, value):
+        self.calls.append(('timing', name))
+
+    def incr(self, name, count=1):
+        self.calls.append(('incr', name))
+
+    def gauge(self, name, value):
+        self.calls.append(('gauge', name))
+
+
+class MetricsTest(AsyncHTTPTestCase):
+    def setUp(self):
+        AsyncHTTPTestCase.setUp(self)
+        self.metrics = InMemoryMetrics()
+        self.statsd  = FakeStatsd()
+        self.hooks   = [self.metrics, StatsdMetrics(self.statsd)]
+        for hook in self.hooks:
+            add_metrics_hook(hook)
+
+
+    def tearDown(self):
+        for hook in self.hooks:
+            remove_metrics_hook(hook)
+        AsyncHTTPTestCase.tearDown(self)
+
+
+    def get_app(self):
+        app = web.Application([(r'/v1/(.+)', FlakyHandler), (r'/(.+)', FlakyHandler)])
+        app.hits = 0
+        return app
+
+
+    @gen_test
+    def stripe_test(self):
+        stripe = LocalStripe('metrics_api_key')
+        stripe.base_url = self.get_url('/v1')
+        stripe.retry_backoff = 0.01
+
+        yield stripe.customers.id('cus_123').subscription.get()
+
+        key = ('stripe', '/customers/:id/subscription')
+        self.assertEqual([sample.error for sample in self.metrics.samples], ['http_5xx', None])
+        self.assertEqual([sample.code for sample in self.metrics.samples], [503, 200])
+        self.assertEqual(self.metrics.retries[key], 1)
+        self.assertEqual(self.metrics.errors[key + ('http_5xx',)], 1)
+        self.assertEqual(self.metrics.in_flight[key], 0)
+        self.assertTrue(self.metrics.samples[-1].response_bytes > 0)
+        self.assertTrue(self.metrics.samples[-1].ttfb is not None)
+        self.assertTrue(self.metrics.percentile('stripe', '/customers/:id/subscription', 99) > 0)
+        self.assertTrue(('incr', 'tornado_api.stripe.customers.id.subscription.retries') in self.statsd.calls)
+
+
+    @gen_test
+    def facebook_test(self):
+        class Graph(FacebookGraphMixin):
+            _BASE_URL = self.get_url('')
+
+        self._app.hits = 1
+        yield Graph().facebook_request('/1234567/picture', access_token='token')
+
+        self.assertEqual(self.metrics.samples[-1].service, 'facebook')
+        self.assertEqual(self.metrics.samples[-1].endpoint, '/:id/picture')
+
+
+class EndpointNameTest(unittest.TestCase):
+    def endpoint_name_test(self):
+        self.assertEqual(endpoint_name('/venues/4b5f6a7cf964a520/tips'), '/venues/:id/tips')
+        self.assertEqual(endpoint_name('/me/friends'), '/me/friends')
+        self.assertEqual(endpoint_name('/statuses/show/210462857140252672.json'), '/statuses/show/:id')
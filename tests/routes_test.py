@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import unittest
+import urllib
+import urlparse
+
+from tornado_api import FacebookGraphMixin, FoursquareMixin
+from tornado_api._routes import route, quote, query_string, form_encode
+
+
+class RoutesTest(unittest.TestCase):
+    def route_test(self):
+        self.assertEqual(route('facebook', 'https://graph.facebook.com', '/1234/picture'),
+                         ('https://graph.facebook.com/1234/picture', ('facebook', '/:id/picture')))
+
+
+    def query_string_matches_urlencode_test(self):
+        args = {'q': 'coffee & tea', 'limit': 25, 'flag': True, 'page': 1, 'ids': 'a,b'}
+        self.assertEqual(query_string(args), urllib.urlencode(args))
+
+
+    def form_encode_test(self):
+        params = {
+            'amount': 100,
+            'metadata': {'order': 'A&B', 'tags': ['x', 'y']},
+            'lines': [{'amount': 100, 'period': {'start': 1}}, {'amount': 200}],
+            'expand': ('customer',),
+            'discounts': [],
+        }
+        self.assertEqual(sorted(urlparse.parse_qsl(form_encode(params))), sorted([
+            ('amount', '100'),
+            ('metadata[order]', 'A&B'),
+            ('metadata[tags][0]', 'x'),
+            ('metadata[tags][1]', 'y'),
+            ('lines[0][amount]', '100'),
+            ('lines[0][period][start]', '1'),
+            ('lines[1][amount]', '200'),
+            ('expand[0]', 'customer'),
+        ]))
+        self.assertEqual(form_encode({'lines': [{'a': 1}, {'a': 2}, {'a': 3}]}), 'lines%5B0%5D%5Ba%5D=1&lines%5B1%5D%5Ba%5D=2&lines%5B2%5D%5Ba%5D=3')
+
+
+    def quote_unicode_test(self):
+        self.assertEqual(quote(u'caf\xe9'), 'caf%C3%A9')
+
+
+    def request_urls_test(self):
+        graph_url, endpoint = FacebookGraphMixin()._facebook_url('/me/feed', 'token', {'limit': 5})
+        self.assertEqual(endpoint, ('facebook', '/me/feed'))
+        self.assertEqual(urlparse.parse_qs(urlparse.urlsplit(graph_url).query), {'access_token': ['token'], 'limit': ['5']})
+
+        foursquare_url, _ = FoursquareMixin()._foursquare_url('/venues/search', 'token', {'ll': '1,2'})
+        self.assertEqual(urlparse.parse_qs(urlparse.urlsplit(foursquare_url).query),
+                         {'access_token': ['token'], 'oauth_token': ['token'], 'll': ['1,2']})
+
+        self.assertEqual(FacebookGraphMixin()._facebook_url('/me', None, {'limit': 5})[0], 'https://graph.facebook.com/me')
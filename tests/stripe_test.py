@@ -3,9 +3,14 @@
 import os, os.path, sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 
+import socket
 import unittest
+import threading
 
-from tornado_api import Stripe
+from tornado import gen, httpclient, web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from tornado_api import Stripe, StripeError, StripeRegistry
 
 DUMMY_PLAN = {
     'amount': 2000,
@@ -22,70 +27,460 @@ class UrlGenerationTest(unittest.TestCase):
 
     def resource_without_id_test(self):
         '''
-        self.stripe.charges.url      should == https://api_key:@api.stripe.com/v1/charges
-        self.stripe.customers.url    should == https://api_key:@api.stripe.com/v1/customers
-        self.stripe.invoices.url     should == https://api_key:@api.stripe.com/v1/invoices
-        self.stripe.invoiceitems.url should == https://api_key:@api.stripe.com/v1/invoiceitems
-        self.stripe.tokens.url       should == https://api_key:@api.stripe.com/v1/tokens
-        self.stripe.events.url       should == https://api_key:@api.stripe.com/v1/events
-        self.stripe.plans.url        should == https://api_key:@api.stripe.com/v1/plans
-        self.stripe.coupons.url      should == https://api_key:@api.stripe.com/v1/coupons
+        self.stripe.charges.url      should == https://api.stripe.com/v1/charges
+        self.stripe.customers.url    should == https://api.stripe.com/v1/customers
+        self.stripe.invoices.url     should == https://api.stripe.com/v1/invoices
+        self.stripe.invoiceitems.url should == https://api.stripe.com/v1/invoiceitems
+        self.stripe.tokens.url       should == https://api.stripe.com/v1/tokens
+        self.stripe.events.url       should == https://api.stripe.com/v1/events
+        self.stripe.plans.url        should == https://api.stripe.com/v1/plans
+        self.stripe.coupons.url      should == https://api.stripe.com/v1/coupons
         '''
         for resource in ['charges', 'customers', 'invoices', 'invoiceitems', 'tokens', 'events', 'plans', 'coupons']:
             expectation = '%s/%s' % (self.stripe.api_endpoint, resource)
 
-            getattr(self.stripe, resource)  # Equivalent of self.stripe.charges
-            self.assertEqual(self.stripe.url, expectation)
-            self.stripe.reset_url()
+            resource = getattr(self.stripe, resource)  # Equivalent of self.stripe.charges
+            self.assertEqual(resource.url, expectation)
 
 
     def resource_with_id_test(self):
         '''
-        self.stripe.charges.id('charge_id').url        should == https://api_key:@api.stripe.com/v1/charges/charge_id
-        self.stripe.customers.id('customer_id').url    should == https://api_key:@api.stripe.com/v1/customers/customer_id
-        self.stripe.invoices.id('invoice_id').url      should == https://api_key:@api.stripe.com/v1/invoices/invoice_id
-        self.stripe.invoiceitems.id('invoiceitem').url should == https://api_key:@api.stripe.com/v1/invoiceitems/invoiceitem_id
-        self.stripe.tokens.id('token_id').url          should == https://api_key:@api.stripe.com/v1/tokens/token_id
-        self.stripe.events.id('event_id').url          should == https://api_key:@api.stripe.com/v1/events/event_id
-        self.stripe.plans.id('plan_id').url            should == https://api_key:@api.stripe.com/v1/plans/plan_id
-        self.stripe.coupons.id('coupon_id').url        should == https://api_key:@api.stripe.com/v1/coupons/coupon_id
+        self.stripe.charges.id('charge_id').url        should == https://api.stripe.com/v1/charges/charge_id
+        self.stripe.customers.id('customer_id').url    should == https://api.stripe.com/v1/customers/customer_id
+        self.stripe.invoices.id('invoice_id').url      should == https://api.stripe.com/v1/invoices/invoice_id
+        self.stripe.invoiceitems.id('invoiceitem').url should == https://api.stripe.com/v1/invoiceitems/invoiceitem_id
+        self.stripe.tokens.id('token_id').url          should == https://api.stripe.com/v1/tokens/token_id
+        self.stripe.events.id('event_id').url          should == https://api.stripe.com/v1/events/event_id
+        self.stripe.plans.id('plan_id').url            should == https://api.stripe.com/v1/plans/plan_id
+        self.stripe.coupons.id('coupon_id').url        should == https://api.stripe.com/v1/coupons/coupon_id
         '''
         for resource in ['charges', 'customers', 'invoices', 'invoiceitems', 'tokens', 'events']:
             id = resource[:-1] + '_id'
             expectation = '%s/%s/%s' % (self.stripe.api_endpoint, resource, id)
 
-            getattr(self.stripe, resource)  # Equivalent of self.stripe.charges
-            self.stripe.id(id)
+            resource = getattr(self.stripe, resource).id(id)  # Equivalent of self.stripe.charges.id(id)
 
-            self.assertEqual(self.stripe.url, expectation)
-            self.stripe.reset_url()
+            self.assertEqual(resource.url, expectation)
 
 
     def resource_after_id_test(self):
         '''
         self.stripe.customers.id('customer_id').subscription.url
-            should == https://api_key:@api.stripe.com/v1/customers/customer_id/subscription
+            should == https://api.stripe.com/v1/customers/customer_id/subscription
         '''
         id = 'customer_id'
         expectation = '%s/customers/%s/subscription' % (self.stripe.api_endpoint, id)
 
-        self.stripe.customers.id(id).subscription
+        resource = self.stripe.customers.id(id).subscription
 
-        self.assertEqual(self.stripe.url, expectation)
-        self.stripe.reset_url()
+        self.assertEqual(resource.url, expectation)
 
 
     def nested_resource_test(self):
         '''
         self.stripe.invoices.incoming.url
-            should == https://api_key:@api.stripe.com/v1/invoices/incoming
+            should == https://api.stripe.com/v1/invoices/incoming
         '''
         expectation = '%s/invoices/incoming' % (self.stripe.api_endpoint)
 
-        self.stripe.invoices.incoming
+        resource = self.stripe.invoices.incoming
+
+        self.assertEqual(resource.url, expectation)
+
+
+    def interleaved_resources_test(self):
+        '''
+        Building one URL must not leak into another built from the same Stripe instance.
+        '''
+        customers = self.stripe.customers
+        customer  = customers.id('customer_id')
+        charges   = self.stripe.charges
+
+        self.assertEqual(customers.url, '%s/customers' % self.stripe.api_endpoint)
+        self.assertEqual(customer.url, '%s/customers/customer_id' % self.stripe.api_endpoint)
+        self.assertEqual(customer.subscription.url, '%s/customers/customer_id/subscription' % self.stripe.api_endpoint)
+        self.assertEqual(customer.url, '%s/customers/customer_id' % self.stripe.api_endpoint)
+        self.assertEqual(charges.url, '%s/charges' % self.stripe.api_endpoint)
+
+
+    def immutable_resource_test(self):
+        customers = self.stripe.customers
+        self.assertRaises(AttributeError, setattr, customers, 'url', 'http://example.com')
+        self.assertRaises(AttributeError, getattr, customers, 'not_a_resource')
+
+
+    def top_level_resources_are_built_once_test(self):
+        self.assertTrue(self.stripe.customers is self.stripe.customers)
+        self.assertTrue(Stripe('another_key').customers is not self.stripe.customers)
+
+
+    def api_key_sent_in_header_test(self):
+        url, kwargs = self.stripe._request_args('POST', self.stripe.charges.url, {'amount': 100})
+
+        self.assertEqual(url, 'https://api.stripe.com/v1/charges')
+        self.assertEqual(kwargs['headers']['Authorization'], 'Basic YXBpX2tleTo=')    # base64('api_key:')
+        self.assertEqual(len(kwargs['headers']['Idempotency-Key']), 32)
+        self.assertEqual(kwargs['endpoint'], ('stripe', '/charges'))
+
+
+class FakeEventsHandler(web.RequestHandler):
+    EVENTS = [{'id': 'evt_%03d' % i} for i in range(250)]
+
+    def get(self):
+        limit = int(self.get_argument('limit', 10))
+        start = 0
+
+        starting_after = self.get_argument('starting_after', None)
+        if starting_after:
+            start = [e['id'] for e in self.EVENTS].index(starting_after) + 1
+
+        data = self.EVENTS[start:start + limit]
+        self.application.pages_served += 1
+        self.write({'object': 'list', 'data': data, 'has_more': start + limit < len(self.EVENTS)})
+
+
+class LocalStripe(Stripe):
+    base_url = None
+
+    @property
+    def api_endpoint(self):
+        return self.base_url
+
+
+class ListIteratorTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/v1/events', FakeEventsHandler)])
+        app.pages_served = 0
+        return app
+
+
+    def stripe(self, blocking=False):
+        stripe = LocalStripe('api_key', blocking=blocking)
+        stripe.base_url = self.get_url('/v1')
+        return stripe
+
+
+    @gen_test
+    def fetch_next_test(self):
+        events = self.stripe().events.iterate(page_size=100)
+        ids = []
+        while (yield events.fetch_next):
+            ids.append(events.next_object()['id'])
+
+        self.assertEqual(ids, [e['id'] for e in FakeEventsHandler.EVENTS])
+        self.assertEqual(self._app.pages_served, 3)
+
 
-        self.assertEqual(self.stripe.url, expectation)
-        self.stripe.reset_url()
+    @gen_test
+    def concurrent_fetch_next_test(self):
+        events = self.stripe().events.iterate(page_size=100)
+        first, second = events.fetch_next, events.fetch_next
+
+        self.assertTrue(first is second)
+        yield first
+        self.assertEqual(len(events._buffer), 100)
+
+
+    def blocking_iteration_test(self):
+        events = self.stripe(blocking=True).events.iterate(page_size=100)
+
+        # The blocking client runs its own IOLoop, so serve the test app from a thread.
+        thread = threading.Thread(target=self.io_loop.start)
+        thread.start()
+        try:
+            ids = [event['id'] for event in events]
+        finally:
+            self.io_loop.add_callback(self.io_loop.stop)
+            thread.join()
+
+        self.assertEqual(ids, [e['id'] for e in FakeEventsHandler.EVENTS])
+
+
+class StreamTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/v1/events', FakeEventsHandler)])
+        app.pages_served = 0
+        return app
+
+
+    @gen_test
+    def stream_test(self):
+        stripe = LocalStripe('api_key')
+        stripe.base_url = self.get_url('/v1')
+
+        events = []
+        count = yield stripe.events.stream(events.append, limit=250)
+
+        self.assertEqual(count, 250)
+        self.assertEqual(events, FakeEventsHandler.EVENTS)
+
+
+    @gen_test
+    def stream_error_test(self):
+        stripe = LocalStripe('api_key')
+        stripe.base_url = self.get_url('/v1')
+
+        try:
+            yield stripe.events.id('evt_1').stream(lambda item: None)
+            self.fail('HTTPError not raised')
+        except Exception, e:
+            self.assertTrue('404' in str(e))
+
+
+class FakeCustomerHandler(web.RequestHandler):
+    @gen.coroutine
+    def get(self, customer_id):
+        app = self.application
+        app.in_flight += 1
+        app.max_in_flight = max(app.max_in_flight, app.in_flight)
+        yield gen.sleep(0.01)
+        app.in_flight -= 1
+
+        if customer_id == 'missing':
+            self.set_status(404)
+            self.write({'error': {'type': 'invalid_request_error', 'message': 'No such customer: missing'}})
+        else:
+            self.write({'id': customer_id, 'object': 'customer', 'account': self.request.headers.get('Stripe-Account')})
+
+
+class BatchTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/v1/customers/(.+)', FakeCustomerHandler)])
+        app.in_flight = app.max_in_flight = 0
+        return app
+
+
+    @gen_test
+    def batch_test(self):
+        stripe = LocalStripe('api_key')
+        stripe.base_url = self.get_url('/v1')
+
+        ids = ['cus_%d' % i for i in range(20)]
+        ids[7] = 'missing'
+        operations = [('GET', stripe.customers.id(cid)) for cid in ids[:10]] + [('GET', 'customers/%s' % cid, {}) for cid in ids[10:]]
+
+        result = yield stripe.batch(operations, concurrency=4)
+
+        self.assertEqual(result.failed, [7])
+        self.assertTrue('No such customer' in str(result.errors[7]))
+        self.assertEqual([r and r['id'] for r in result.results], ids[:7] + [None] + ids[8:])
+        self.assertTrue(self._app.max_in_flight <= 4)
+        self.assertTrue(result.elapsed > 0)
+
+
+    def run_many_test(self):
+        stripe = LocalStripe('api_key', blocking=True)
+        stripe.base_url = self.get_url('/v1')
+
+        ids = ['cus_%d' % i for i in range(20)]
+        ids[3] = 'missing'
+
+        # The blocking clients run their own IOLoops, so serve the test app from a thread.
+        thread = threading.Thread(target=self.io_loop.start)
+        thread.start()
+        try:
+            result = stripe.run_many([('GET', stripe.customers.id(cid)) for cid in ids], workers=5)
+            first_max_in_flight, self._app.max_in_flight = self._app.max_in_flight, 0
+            pool = Stripe._executor
+
+            # Fewer workers reuse the pool without running more calls at once.
+            stripe.run_many([('GET', stripe.customers.id(cid)) for cid in ids], workers=2)
+        finally:
+            self.io_loop.add_callback(self.io_loop.stop)
+            thread.join()
+
+        self.assertEqual(result.failed, [3])
+        self.assertTrue(isinstance(result.errors[3], StripeError))
+        self.assertEqual(result.errors[3].type, 'invalid_request_error')
+        self.assertEqual(result.errors[3].code, 404)
+        self.assertEqual([r and r['id'] for r in result.results], ids[:3] + [None] + ids[4:])
+        self.assertTrue(1 < first_max_in_flight <= 5)
+        self.assertTrue(self._app.max_in_flight <= 2)
+        self.assertTrue(Stripe._executor is pool)
+        self.assertRaises(ValueError, LocalStripe('api_key').run_many, [])
+
+
+class RegistryTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/v1/customers/(.+)', FakeCustomerHandler)])
+        app.in_flight = app.max_in_flight = 0
+        return app
+
+
+    def registry(self, **kwargs):
+        stripe_class = type('RegistryStripe', (LocalStripe,), {'base_url': self.get_url('/v1')})
+        return StripeRegistry('sk_platform', stripe_class=stripe_class, **kwargs)
+
+
+    def handles_are_reused_test(self):
+        registry = self.registry()
+
+        self.assertTrue(registry.account('acct_1') is registry.account('acct_1'))
+        self.assertFalse(registry.account('acct_1') is registry.account('acct_2'))
+        self.assertEqual(registry.account('acct_1').api_key, 'sk_platform')
+        self.assertTrue(registry.account('acct_1').httpclient_instance is registry.key('sk_other').httpclient_instance)
+
+
+    @gen_test
+    def per_account_quota_test(self):
+        registry = self.registry(concurrency=2)
+        registry.set_quota('acct_big', concurrency=6)
+
+        small, big = registry.account('acct_small'), registry.account('acct_big')
+
+        results = yield [small.customers.id('cus_%d' % i).get() for i in range(6)]
+        self.assertEqual(set(r['account'] for r in results), set(['acct_small']))
+        self.assertEqual(self._app.max_in_flight, 2)
+
+        yield [big.customers.id('cus_%d' % i).get() for i in range(6)]
+        self.assertEqual(self._app.max_in_flight, 6)
+
+        with self.assertRaises(StripeError):
+            yield small.customers.id('missing').get()
+
+        stats = registry.stats()
+        self.assertEqual((stats['acct_small']['requests'], stats['acct_small']['errors'], stats['acct_small']['in_flight']), (7, 1, 0))
+        self.assertEqual(stats['acct_big']['concurrency'], 6)
+
+
+    @gen_test
+    def api_keys_are_not_exposed_test(self):
+        registry = self.registry()
+        customer = yield registry.key('sk_test_secret').customers.id('cus_1').get()
+
+        self.assertEqual(customer['account'], None)
+        self.assertEqual(len(registry.stats()), 1)
+        self.assertFalse('sk_test_secret' in str(registry.stats()))
+
+
+class FlakyChargesHandler(web.RequestHandler):
+    def post(self):
+        app = self.application
+        app.idempotency_keys.append(self.request.headers.get('Idempotency-Key'))
+
+        if len(app.idempotency_keys) == 1:
+            self.set_status(503)
+            self.write({'error': {'type': 'api_error', 'message': 'Try again'}})
+        elif len(app.idempotency_keys) == 2:
+            self.set_status(429)
+            self.set_header('Retry-After', '0')
+            self.write({'error': {'type': 'rate_limit_error', 'message': 'Too many requests'}})
+        else:
+            self.write({'id': 'ch_1', 'amount': self.get_argument('amount')})
+
+
+    def get(self):
+        self.set_status(400)
+        self.write({'error': {'type': 'invalid_request_error', 'message': 'Bad request'}})
+
+
+class DeclinedHandler(web.RequestHandler):
+    def post(self):
+        self.set_status(402)
+        self.write({'error': {'type': 'card_error', 'message': 'Your card was declined.'}})
+
+
+class ErrorPageHandler(web.RequestHandler):
+    def get(self):
+        self.set_status(502)
+        self.write('<html><body>Bad Gateway</body></html>')
+
+
+def closed_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class RetryTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/v1/charges', FlakyChargesHandler), (r'/v1/invoices', ErrorPageHandler), (r'/v1/tokens', DeclinedHandler)])
+        app.idempotency_keys = []
+        return app
+
+
+    def stripe(self, **kwargs):
+        stripe = LocalStripe('retry_api_key', **kwargs)
+        stripe.base_url = self.get_url('/v1')
+        stripe.retry_backoff = 0.01
+        return stripe
+
+
+    @gen_test
+    def retry_with_same_idempotency_key_test(self):
+        charge = yield self.stripe().charges.post(amount=100)
+
+        self.assertEqual(charge['id'], 'ch_1')
+        self.assertEqual(len(self._app.idempotency_keys), 3)
+        self.assertEqual(len(set(self._app.idempotency_keys)), 1)
+        self.assertTrue(self._app.idempotency_keys[0])
+
+
+    @gen_test
+    def retries_exhausted_test(self):
+        try:
+            yield self.stripe(max_retries=0).charges.post(amount=100)
+            self.fail('StripeError not raised')
+        except StripeError, e:
+            self.assertEqual(e.type, 'api_error')
+            self.assertEqual(e.http_code, 503)
+
+
+    @gen_test
+    def client_error_is_not_retried_test(self):
+        try:
+            yield self.stripe().charges.get()
+            self.fail('StripeError not raised')
+        except StripeError, e:
+            self.assertEqual(e.type, 'invalid_request_error')
+
+
+    def blocking_api_error_raises_stripe_error_test(self):
+        stripe = self.stripe(blocking=True)
+
+        # The blocking client runs its own IOLoop, so serve the test app from a thread.
+        thread = threading.Thread(target=self.io_loop.start)
+        thread.start()
+        try:
+            with self.assertRaises(StripeError) as context:
+                stripe.tokens.post(card='tok_declined')
+        finally:
+            self.io_loop.add_callback(self.io_loop.stop)
+            thread.join()
+
+        self.assertEqual(context.exception.type, 'card_error')
+        self.assertEqual(context.exception.message, 'Your card was declined.')
+        self.assertEqual(context.exception.code, 402)
+
+
+    @gen_test
+    def error_page_raises_http_error_test(self):
+        with self.assertRaises(httpclient.HTTPError) as context:
+            yield self.stripe(max_retries=0).invoices.get()
+        self.assertEqual(context.exception.code, 502)
+
+
+    @gen_test
+    def connection_error_raises_transport_error_test(self):
+        stripe = self.stripe(max_retries=1)
+        stripe.base_url = 'http://127.0.0.1:%d/v1' % closed_port()
+
+        with self.assertRaises((httpclient.HTTPError, IOError)):
+            yield stripe.charges.get()
+
+
+    def blocking_connection_error_is_retried_test(self):
+        registry = StripeRegistry(blocking=True, max_retries=2, stripe_class=LocalStripe)
+        stripe   = registry.key('retry_api_key')
+        stripe.base_url      = 'http://127.0.0.1:%d/v1' % closed_port()
+        stripe.retry_backoff = 0.01
+
+        with self.assertRaises(httpclient.HTTPError) as context:
+            stripe.charges.get()
+        self.assertEqual(context.exception.code, 599)
+        self.assertEqual(registry.stats().values()[0]['retries'], 2)
 
 
 class BadApiKeyTest(unittest.TestCase):
@@ -98,9 +493,10 @@ class BadApiKeyTest(unittest.TestCase):
         try:
             self.stripe.plans.get()
         except Exception, e:
-            self.assertEqual(e.__class__.__name__, 'HTTPError')
-            self.assertTrue(str(e).find('401') > -1)
-            self.assertTrue(str(e).find('Unauthorized') > -1)
+            self.assertTrue(isinstance(e, StripeError))
+            self.assertTrue(isinstance(e, httpclient.HTTPError))
+            self.assertEqual(e.code, 401)
+            self.assertEqual(e.type, 'invalid_request_error')
 
 
 class GoodApiKeyTest(unittest.TestCase):
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import unittest
+
+from tornado import gen, iostream, web
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from tornado_api import Twitter, TwitterStream
+from tornado_api._twitter import MessageFramer, method_for_uriparts
+
+
+class StatusesHandler(web.RequestHandler):
+    def get(self, path):
+        self.write({'method': 'GET', 'path': path, 'count': self.get_argument('count', None)})
+
+
+    def post(self, path):
+        self.write({'method': 'POST', 'path': path, 'status': self.get_argument('status', None)})
+
+
+class FilterHandler(web.RequestHandler):
+    @gen.coroutine
+    def post(self):
+        app = self.application
+        app.connections.append(self.get_argument('track'))
+        if app.status != 200:
+            raise web.HTTPError(app.status)
+
+        # Messages split across chunks, with keep-alives in between.
+        n = len(app.connections)
+        for chunk in ['{"id": %d, "text": "a"}\r\n{"id"' % (n * 10 + 1), ': %d, "te' % (n * 10 + 2), 'xt": "b"}\r\n', '\r\n']:
+            self.write(chunk)
+            try:
+                yield self.flush()
+            except iostream.StreamClosedError:
+                return
+            yield gen.sleep(0.01)
+
+
+class TwitterTest(AsyncHTTPTestCase):
+    def get_app(self):
+        return web.Application([(r'/1.1/statuses/(.*)\.json', StatusesHandler)])
+
+
+    def method_for_uriparts_test(self):
+        self.assertEqual(method_for_uriparts(('1.1', 'statuses', 'home_timeline')), 'GET')
+        self.assertEqual(method_for_uriparts(('1.1', 'statuses', 'update')), 'POST')
+        self.assertEqual(method_for_uriparts(('1.1', 'statuses', 'destroy', '123')), 'POST')
+        self.assertEqual(method_for_uriparts(('1.1', 'statuses', 'lookup')), 'POST')
+        self.assertEqual(method_for_uriparts(('1.1', 'geo', 'lookup')), 'GET')
+        self.assertEqual(method_for_uriparts(('1.1', 'users', 'lookup', '_id')), 'POST')
+
+
+    @gen_test
+    def calls_return_futures_test(self):
+        twitter = Twitter(domain='127.0.0.1:%d' % self.get_http_port(), secure=False)
+
+        timeline, update, destroy = yield [
+            twitter.statuses.home_timeline(count=5),
+            twitter.statuses.update(status='Hello world'),
+            twitter.statuses.destroy(id=123),
+        ]
+
+        self.assertEqual(timeline, {'method': 'GET', 'path': 'home_timeline', 'count': '5'})
+        self.assertEqual(update, {'method': 'POST', 'path': 'update', 'status': 'Hello world'})
+        self.assertEqual(destroy, {'method': 'POST', 'path': 'destroy/123', 'status': None})
+
+
+class MessageFramerTest(unittest.TestCase):
+    def framing_test(self):
+        framer = MessageFramer()
+
+        self.assertEqual(framer.feed('{"a": 1}\r\n{"b"'), ['{"a": 1}'])
+        self.assertEqual(framer.feed(': 2'), [])
+        self.assertEqual(framer.feed('}\r\n\r\n12\r\n{"c": 3}\r'), ['{"b": 2}'])
+        self.assertEqual(framer.feed('\n'), ['{"c": 3}'])
+
+
+class TwitterStreamTest(AsyncHTTPTestCase):
+    def get_app(self):
+        app = web.Application([(r'/1.1/statuses/filter.json', FilterHandler)])
+        app.connections = []
+        app.status      = 200
+        return app
+
+
+    def stream(self, **kwargs):
+        return TwitterStream('statuses/filter', domain='127.0.0.1:%d' % self.get_http_port(), secure=False, track='tornado', **kwargs)
+
+
+    @gen_test
+    def messages_and_reconnect_test(self):
+        stream = self.stream().start()
+
+        ids = []
+        for _ in range(4):
+            message = yield stream.next()
+            ids.append(message['id'])
+        stream.stop()
+
+        self.assertEqual(ids, [11, 12, 21, 22])
+        self.assertEqual(self._app.connections, ['tornado', 'tornado'])
+        self.assertEqual(stream.reconnects, 1)
+
+        message = yield stream.next()
+        self.assertEqual(message, None)
+
+
+    @gen_test
+    def full_queue_drops_messages_test(self):
+        stream = self.stream(max_queue=1).start()
+        while stream.messages + stream.dropped < 2:
+            yield gen.sleep(0.01)
+        stream.stop()
+
+        self.assertEqual((stream.messages, stream.dropped), (1, 1))
+        message = yield stream.next()
+        self.assertEqual(message['id'], 11)
+
+
+    @gen_test
+    def unauthorized_stops_stream_test(self):
+        self._app.status = 401
+        stream = self.stream().start()
+
+        message = yield stream.next()
+        self.assertEqual(message, None)
+        self.assertTrue(stream.error.startswith('HTTP 401'))
+        self.assertEqual(len(self._app.connections), 1)
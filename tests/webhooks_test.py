@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import os, os.path, sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import time
+import hmac
+import unittest
+import hashlib
+
+from tornado import escape, gen, web
+from tornado.concurrent import Future
+from tornado.testing import AsyncHTTPTestCase, gen_test
+
+from tornado_api import StripeWebhookHandler, StripeEventPipeline, StripeError, verify_stripe_signature
+
+SECRET = 'whsec_test_secret'
+
+
+def sign(body, timestamp=None, secret=SECRET):
+    timestamp = int(timestamp or time.time())
+    signature = hmac.new(secret, '%d.%s' % (timestamp, body), hashlib.sha256).hexdigest()
+    return 't=%d,v1=%s,v0=ignored' % (timestamp, signature)
+
+
+class SignatureTest(unittest.TestCase):
+    def signature_test(self):
+        body = '{"id": "evt_1"}'
+        verify_stripe_signature(body, sign(body), SECRET)
+
+        self.assertRaises(StripeError, verify_stripe_signature, body, sign(body, secret='whsec_other'), SECRET)
+        self.assertRaises(StripeError, verify_stripe_signature, body + ' ', sign(body), SECRET)
+        self.assertRaises(StripeError, verify_stripe_signature, body, sign(body, time.time() - 600), SECRET)
+        self.assertRaises(StripeError, verify_stripe_signature, body, 'garbage', SECRET)
+
+
+class WebhookHandlerTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.events  = []
+        self.release = Future()
+
+        @gen.coroutine
+        def on_event(event):
+            if event['type'] == 'slow':
+                yield self.release
+            self.events.append(event['id'])
+
+        self.pipeline = StripeEventPipeline(on_event, workers=1, max_queue=1)
+        return web.Application([(r'/webhook', StripeWebhookHandler, dict(secret=SECRET, pipeline=self.pipeline))])
+
+
+    def post_event(self, event_id, type='charge.succeeded', signature=None):
+        body = escape.json_encode({'id': event_id, 'type': type})
+        return self.http_client.fetch(self.get_url('/webhook'), method='POST', body=body,
+                                      headers={'Stripe-Signature': signature or sign(body)}, raise_error=False)
+
+
+    @gen_test
+    def events_are_processed_once_test(self):
+        first     = yield self.post_event('evt_1')
+        duplicate = yield self.post_event('evt_1')
+        yield self.pipeline.join()
+
+        self.assertEqual(first.code, 200)
+        self.assertEqual(escape.json_decode(duplicate.body)['status'], 'duplicate')
+        self.assertEqual(self.events, ['evt_1'])
+
+
+    @gen_test
+    def invalid_signature_test(self):
+        response = yield self.post_event('evt_1', signature=sign('something else'))
+
+        self.assertEqual(response.code, 400)
+        self.assertEqual(self.events, [])
+
+
+    @gen_test
+    def full_queue_applies_backpressure_test(self):
+        yield self.post_event('evt_slow', type='slow')     # taken by the only worker
+        yield gen.moment
+        yield self.post_event('evt_queued')                 # fills the queue
+        rejected = yield self.post_event('evt_rejected')
+
+        self.assertEqual(rejected.code, 503)
+        self.assertEqual(rejected.headers.get('Retry-After'), '30')
+
+        self.release.set_result(None)
+        yield self.pipeline.join()
+        retried = yield self.post_event('evt_rejected')
+        yield self.pipeline.join()
+
+        self.assertEqual(retried.code, 200)
+        self.assertEqual(self.events, ['evt_slow', 'evt_queued', 'evt_rejected'])